@@ -0,0 +1,4 @@
+"""性能测试
+
+在仓库根目录下以模块方式运行，例如 python3 -m bench.handshake
+"""
@@ -0,0 +1,85 @@
+"""
+Filename: bench/connect.py
+
+对比只连接第一个地址和多地址竞速两种模式的连接建立耗时
+
+在127.0.0.2上放置一个积压队列已满的监听端口来模拟不响应的地址，
+发往该地址的SYN会被内核丢弃，连接会一直挂起直到超时
+"""
+import asyncio
+import socket
+import statistics
+import time
+from typing import List
+
+import connector
+
+CONNECT_TIMEOUT = 2.0  # 单个地址模式下，不响应的地址会耗尽整个超时时间
+DEAD_ADDRESS = "127.0.0.2"
+LIVE_ADDRESS = "127.0.0.1"
+
+
+def percentile(samples: List[float], p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def blackhole(port: int) -> List[socket.socket]:
+    """占满积压队列，之后的连接请求不会被响应"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((DEAD_ADDRESS, port))
+    listener.listen(0)
+    fillers = [listener]
+    for _ in range(4):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setblocking(False)
+        s.connect_ex((DEAD_ADDRESS, port))
+        fillers.append(s)
+    time.sleep(0.1)
+    return fillers
+
+
+async def measure(addresses: List[str], port: int, delay: float, n: int) -> List[float]:
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        try:
+            _, writer = await asyncio.wait_for(
+                connector.open_connection(addresses, port, delay), CONNECT_TIMEOUT
+            )
+            writer.close()
+        except (OSError, asyncio.TimeoutError):
+            pass
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+async def bench(n: int = 20) -> None:
+    server = await asyncio.start_server(lambda r, w: w.close(), LIVE_ADDRESS, 0)
+    port = server.sockets[0].getsockname()[1]
+    fillers = blackhole(port)
+
+    cases = [
+        ("单地址，正常", [LIVE_ADDRESS], 0),
+        ("竞速，正常", [LIVE_ADDRESS], 0.25),
+        ("单地址，首个地址不响应", [DEAD_ADDRESS, LIVE_ADDRESS], 0),
+        ("竞速，首个地址不响应", [DEAD_ADDRESS, LIVE_ADDRESS], 0.25),
+    ]
+    print(f"{'场景':<16}{'p50(ms)':>10}{'p99(ms)':>10}{'平均(ms)':>10}")
+    try:
+        for name, addresses, delay in cases:
+            samples = await measure(addresses, port, delay, n)
+            print(
+                f"{name:<16}{percentile(samples, 0.5) * 1000:>10.1f}"
+                f"{percentile(samples, 0.99) * 1000:>10.1f}"
+                f"{statistics.mean(samples) * 1000:>10.1f}"
+            )
+    finally:
+        server.close()
+        for s in fillers:
+            s.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(bench())
@@ -0,0 +1,141 @@
+"""
+Filename: bench/direct.py
+
+测试pyxy.py直连代理
+
+1. 两种转发方式的吞吐量和每GB数据消耗的CPU时间
+2. 建立并保持IDLE_CONNECTIONS个空闲连接时，代理进程每个连接占用的内存、线程数和上下文切换次数
+
+数据源、代理和接收端分别运行在不同的进程中，只统计代理进程
+"""
+import asyncio
+import multiprocessing
+import time
+
+import psutil
+
+import pyxy
+from bench.relay import TOTAL, free_port, run_source
+from bench.scaling import socks_download
+
+IDLE_CONNECTIONS = 1000
+
+
+def run_proxy(splice: bool, port: int) -> None:
+    proxy = pyxy.DirectProxy("127.0.0.1", port, splice=splice)
+    proxy.logger.set_level("WARNING")
+    proxy.serve_forever()
+
+
+def run_idle_target(port: int) -> None:
+    """接受连接后不发送任何数据"""
+
+    async def handler(reader, writer):
+        await reader.read()
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handler, "127.0.0.1", port, backlog=4096)
+        await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def start(target, *args) -> multiprocessing.Process:
+    process = multiprocessing.Process(target=target, args=args, daemon=True)
+    process.start()
+    time.sleep(0.5)
+    return process
+
+
+def context_switches(process: psutil.Process) -> int:
+    """所有线程的上下文切换次数之和，已经退出的线程不计入"""
+    total = 0
+    for thread in process.threads():
+        try:
+            total += sum(psutil.Process(thread.id).num_ctx_switches())
+        except psutil.Error:
+            pass
+    return total
+
+
+def bench_bulk(name: str, splice: bool, source_port: int) -> None:
+    port = free_port()
+    process = start(run_proxy, splice, port)
+
+    proxy = psutil.Process(process.pid)
+    cpu_before = sum(proxy.cpu_times()[:2])
+    start_time = time.perf_counter()
+    received = asyncio.run(
+        socks_download("127.0.0.1", port, "username", "password", source_port)
+    )
+    elapsed = time.perf_counter() - start_time
+    cpu = sum(proxy.cpu_times()[:2]) - cpu_before
+    process.kill()
+
+    gigabytes = received / 1024**3
+    print(f"{name:<10}{received / 1024**2 / elapsed:>12.1f}{cpu / gigabytes:>14.2f}")
+
+
+async def open_idle(port: int, target_port: int, n: int) -> list:
+    """通过代理建立n个连接，完成Socks5协商后保持空闲"""
+
+    async def one():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"\x05\x01\x02\x01\x08username\x08password")
+        writer.write(
+            b"\x05\x01\x00\x01\x7f\x00\x00\x01" + target_port.to_bytes(2, "big")
+        )
+        await reader.readexactly(2 + 2 + 10)
+        return writer
+
+    writers = []
+    for i in range(0, n, 100):
+        writers += await asyncio.gather(*(one() for _ in range(min(100, n - i))))
+    return writers
+
+
+def bench_idle(target_port: int) -> None:
+    port = free_port()
+    process = start(run_proxy, pyxy.SPLICE_AVAILABLE, port)
+    proxy = psutil.Process(process.pid)
+    rss_before = proxy.memory_info().rss
+    switches_before = context_switches(proxy)
+
+    async def main():
+        writers = await open_idle(port, target_port, IDLE_CONNECTIONS)
+        await asyncio.sleep(1)
+        result = (
+            proxy.memory_info().rss,
+            proxy.num_threads(),
+            context_switches(proxy),
+        )
+        for w in writers:
+            w.close()
+        return result
+
+    rss, threads, switches = asyncio.run(main())
+    process.kill()
+    n = IDLE_CONNECTIONS
+    print(
+        f"{n}个空闲连接: 每个连接内存{(rss - rss_before) / n / 1024:.1f}KB，"
+        f"上下文切换{(switches - switches_before) / n:.1f}次，线程数{threads}"
+    )
+
+
+if __name__ == "__main__":
+    source_port = free_port()
+    source = start(run_source, source_port)
+    idle_port = free_port()
+    idle_target = start(run_idle_target, idle_port)
+
+    print(f"每轮传输{TOTAL // 1024**2}MB")
+    print(f"{'方式':<10}{'吞吐(MB/s)':>12}{'CPU(秒/GB)':>14}")
+    try:
+        bench_bulk("copy", False, source_port)
+        if pyxy.SPLICE_AVAILABLE:
+            bench_bulk("splice", True, source_port)
+        bench_idle(idle_port)
+    finally:
+        source.kill()
+        idle_target.kill()
@@ -0,0 +1,374 @@
+"""
+Filename: bench/e2e.py
+
+本机端到端性能回归测试
+
+生成自签名证书和临时配置文件，在本机启动Server、SockRelay和测试目标，
+所有流量都经过Socks5端口和TLS隧道，不依赖外部网络。分别在开启和关闭uvloop时测量
+1. 每秒完成的短连接数，每个连接发送一个HTTP请求并读取完整的响应
+2. 短连接从发起到Socks5响应成功的延迟p50/p99
+3. 多个连接同时下载的总吞吐量
+4. 保持IDLE_CONNECTIONS个空闲连接时，服务端和客户端进程平均每个连接占用的内存
+
+结果保存为JSON，与基准文件比较，超过容差的变化视为退化，退出码为1。
+需要在仓库根目录运行，并且系统中有openssl命令
+
+python3 -m bench.e2e                 运行并与基准比较
+python3 -m bench.e2e --save-baseline 运行并保存为新的基准
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+import psutil
+import toml
+
+import xybase
+from bench.relay import free_port
+from bench.scaling import socks_connect
+from config_parse import EXAMPLE_FILE, PyxyConfig
+from proxy_broker import SockRelay
+from safe_block import Key
+from server import Server
+
+CONNECTIONS = 2000  # 短连接的总数
+CONCURRENCY = 50  # 同时进行的短连接数
+BULK_CONNECTIONS = 4  # 同时下载的连接数
+BULK_SIZE = 64 * 1024 * 1024  # 每个连接下载的数据量
+IDLE_CONNECTIONS = 500
+TOLERANCE = 0.15  # 默认容差，相对基准变差超过该比例视为退化
+
+RESULT_FILE = "bench/e2e_result.json"
+BASELINE_FILE = "bench/e2e_baseline.json"
+
+# 指标名称和方向，True表示越大越好
+METRICS = {
+    "connections_per_second": True,
+    "connect_p50_ms": False,
+    "connect_p99_ms": False,
+    "throughput_mb_per_second": True,
+    "rss_per_connection_kb": False,
+}
+
+HTTP_REQUEST = b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n"
+HTTP_RESPONSE = (
+    b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok"
+)
+CHUNK = b"\0" * 65536
+
+
+def make_certificate(directory: str) -> Tuple[str, str]:
+    """用openssl生成localhost的自签名证书，返回证书和密钥的路径"""
+    crt_file = os.path.join(directory, "crt.pem")
+    key_file = os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "ec",
+            "-pkeyopt",
+            "ec_paramgen_curve:prime256v1",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=localhost",
+            "-addext",
+            "subjectAltName=DNS:localhost",
+            "-keyout",
+            key_file,
+            "-out",
+            crt_file,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return crt_file, key_file
+
+
+def make_config(directory: str) -> str:
+    """以config.example为模板生成本机测试的配置文件，返回路径"""
+    crt_file, key_file = make_certificate(directory)
+    config = toml.load(EXAMPLE_FILE)
+
+    general = config["general"]
+    general["key"] = Key().key_string
+    general["domain"] = "localhost"
+    general["log_level"] = "WARNING"
+    general["drain_timeout"] = 1  # 测量结束后尽快退出
+
+    server = config["server"]
+    server["crt_file"] = crt_file
+    server["key_file"] = key_file
+    server["ipv4_address"] = "127.0.0.1"
+    server["port"] = free_port()
+
+    client = config["client"]
+    client["socks5_address"] = "127.0.0.1"
+    client["socks5_port"] = free_port()
+    client["ca_file"] = crt_file
+    client["workers"] = 1
+
+    path = os.path.join(directory, "config.toml")
+    with open(path, "wt", encoding="utf-8") as f:
+        toml.dump(config, f)
+    return path
+
+
+def use_uvloop(enabled: bool) -> None:
+    """xybase导入时已经设置了uvloop，关闭时恢复默认的事件循环"""
+    if not enabled:
+        asyncio.set_event_loop_policy(None)
+
+
+def run_server(path: str, uvloop: bool) -> None:
+    use_uvloop(uvloop)
+    asyncio.run(Server(PyxyConfig(path)).start())
+
+
+def run_client(path: str, uvloop: bool) -> None:
+    use_uvloop(uvloop)
+    config = PyxyConfig(path)
+    SockRelay(
+        config, remote_addr=config.general["domain"], remote_port=config.server["port"]
+    ).run()
+
+
+def run_targets(http_port: int, bulk_port: int, echo_port: int) -> None:
+    """HTTP、大文件和回显三种目标"""
+
+    async def http(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(HTTP_RESPONSE)
+        writer.close()
+
+    async def bulk(reader, writer):
+        sent = 0
+        while sent < BULK_SIZE:
+            writer.write(CHUNK)
+            await writer.drain()
+            sent += len(CHUNK)
+        writer.close()
+
+    async def echo(reader, writer):
+        while 1:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+
+    async def main():
+        targets = ((http, http_port), (bulk, bulk_port), (echo, echo_port))
+        for handler, port in targets:
+            await asyncio.start_server(handler, "127.0.0.1", port, backlog=4096)
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def start(target, *args) -> multiprocessing.Process:
+    process = multiprocessing.Process(target=target, args=args, daemon=True)
+    process.start()
+    return process
+
+
+async def wait_listening(port: int, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while 1:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+def percentile(samples: List[float], p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+class Runner:
+    """对一组已经启动的服务端和客户端进行测量"""
+
+    def __init__(self, config: PyxyConfig, ports: Dict[str, int], pids: List[int]):
+        client = config.client
+        self.proxy = (
+            client["socks5_address"],
+            client["socks5_port"],
+            client["username"],
+            client["password"],
+        )
+        self.ports = ports
+        self.processes = [psutil.Process(pid) for pid in pids]
+
+    async def connect(self, target: str):
+        return await socks_connect(*self.proxy, self.ports[target])
+
+    async def short_connections(self) -> Dict[str, float]:
+        semaphore = asyncio.Semaphore(CONCURRENCY)
+        latencies = []
+
+        async def one():
+            async with semaphore:
+                start = time.perf_counter()
+                reader, writer = await self.connect("http")
+                latencies.append(time.perf_counter() - start)
+                writer.write(HTTP_REQUEST)
+                response = await reader.read()
+                writer.close()
+                if not response.endswith(b"ok"):
+                    raise ConnectionError("HTTP响应不完整")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(CONNECTIONS)))
+        elapsed = time.perf_counter() - start
+        return {
+            "connections_per_second": CONNECTIONS / elapsed,
+            "connect_p50_ms": percentile(latencies, 0.5) * 1000,
+            "connect_p99_ms": percentile(latencies, 0.99) * 1000,
+        }
+
+    async def throughput(self) -> Dict[str, float]:
+        async def one() -> int:
+            reader, writer = await self.connect("bulk")
+            received = 0
+            while 1:
+                data = await reader.read(262144)
+                if not data:
+                    break
+                received += len(data)
+            writer.close()
+            return received
+
+        start = time.perf_counter()
+        received = sum(await asyncio.gather(*(one() for _ in range(BULK_CONNECTIONS))))
+        elapsed = time.perf_counter() - start
+        return {"throughput_mb_per_second": received / 1024**2 / elapsed}
+
+    def rss(self) -> int:
+        return sum(p.memory_info().rss for p in self.processes)
+
+    async def idle_memory(self) -> Dict[str, float]:
+        before = self.rss()
+        writers = []
+        for i in range(0, IDLE_CONNECTIONS, CONCURRENCY):
+            n = min(CONCURRENCY, IDLE_CONNECTIONS - i)
+            opened = await asyncio.gather(*(self.connect("echo") for _ in range(n)))
+            writers += [w for _, w in opened]
+        await asyncio.sleep(1)
+        after = self.rss()
+        for writer in writers:
+            writer.close()
+        return {"rss_per_connection_kb": (after - before) / IDLE_CONNECTIONS / 1024}
+
+    async def run(self) -> Dict[str, float]:
+        result = {}
+        result.update(await self.short_connections())
+        result.update(await self.throughput())
+        result.update(await self.idle_memory())
+        return result
+
+
+def bench(path: str, uvloop: bool, ports: Dict[str, int]) -> Dict[str, float]:
+    config = PyxyConfig(path)
+    server = start(run_server, path, uvloop)
+    client = start(run_client, path, uvloop)
+    try:
+        asyncio.run(wait_listening(config.server["port"]))
+        asyncio.run(wait_listening(config.client["socks5_port"]))
+        time.sleep(1)  # 等待客户端的连接池预热
+        runner = Runner(config, ports, [server.pid, client.pid])
+        return asyncio.run(runner.run())
+    finally:
+        for process in (server, client):
+            process.terminate()
+            process.join(10)
+            if process.is_alive():
+                process.kill()
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> List[str]:
+    """输出与基准的对比，返回退化的指标"""
+    regressions = []
+    print(f"\n{'模式':<10}{'指标':<28}{'基准':>12}{'本次':>12}{'变化':>10}")
+    for mode, values in result["modes"].items():
+        base_values = baseline["modes"].get(mode)
+        if base_values is None:
+            continue
+        for name, higher_is_better in METRICS.items():
+            if name not in base_values or not base_values[name]:
+                continue
+            change = values[name] / base_values[name] - 1
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > tolerance:
+                flag = " 退化"
+                regressions.append(f"{mode}.{name}")
+            print(
+                f"{mode:<10}{name:<28}{base_values[name]:>12.2f}"
+                f"{values[name]:>12.2f}{change:>+10.1%}{flag}"
+            )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本机端到端性能回归测试")
+    parser.add_argument("--output", default=RESULT_FILE, help="结果的保存路径")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="基准文件的路径")
+    parser.add_argument("--save-baseline", action="store_true", help="将结果保存为基准")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="退化的容差")
+    args = parser.parse_args()
+
+    modes = {"asyncio": False}
+    if xybase.ENABLE_UVLOOP:
+        modes["uvloop"] = True
+
+    ports = {"http": free_port(), "bulk": free_port(), "echo": free_port()}
+    targets = start(run_targets, ports["http"], ports["bulk"], ports["echo"])
+    result = {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "modes": {},
+    }
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            path = make_config(directory)
+            print(f"{'模式':<10}" + "".join(f"{name:>26}" for name in METRICS))
+            for mode, uvloop in modes.items():
+                values = result["modes"][mode] = bench(path, uvloop, ports)
+                print(f"{mode:<10}" + "".join(f"{values[n]:>26.2f}" for n in METRICS))
+    finally:
+        targets.kill()
+
+    with open(args.output, "wt", encoding="utf-8") as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+
+    if args.save_baseline:
+        with open(args.baseline, "wt", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        print(f"\n基准已保存到{args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "rt", encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n性能退化: {', '.join(regressions)}")
+            sys.exit(1)
+    else:
+        print(f"\n没有找到基准文件{args.baseline}，使用--save-baseline保存")
@@ -0,0 +1,74 @@
+"""
+Filename: bench/handshake.py
+
+对比预协商区块各个格式的体积和编解码耗时
+
+最后一列为编码加解码的总耗时相对原实现的比例，二进制格式的比例大于1时以非零状态退出
+"""
+import sys
+import json
+import time
+import timeit
+import uuid
+from typing import Callable
+
+from safe_block import Block, Crypto, Key, BLOCK_VERSION_JSON, BLOCK_VERSION_BINARY
+
+PAYLOADS = {
+    "connect": {"ip": "", "domain": "www.example.com", "port": 443},
+    "reply": {"bind_address": "203.0.113.7", "bind_port": 51234},
+}
+
+
+def best_of(func: Callable[[], object], n: int, repeat: int = 5) -> float:
+    """多轮测试取最快的一轮，返回每次调用的平均耗时，单位微秒"""
+    return min(timeit.repeat(func, number=n, repeat=repeat)) / n * 1e6
+
+
+def original_encode(key: Key, payload: dict) -> bytes:
+    """引入版本号之前的实现：每个区块重新构造加密对象"""
+    return Crypto(key.key_bytes).encrypt(
+        json.dumps(
+            {
+                "uuid": uuid.uuid4().hex,
+                "key": key.key_string,
+                "payload": payload,
+                "timestamp": int(time.time()),
+            }
+        ).encode("utf-8")
+    )
+
+
+def original_decode(key: Key, b: bytes) -> dict:
+    return json.loads(Crypto(key.key_bytes).decrypt(b).decode("utf-8"))
+
+
+def bench(n: int = 5000) -> bool:
+    """输出对比结果，返回二进制格式是否在所有负载上都比原实现快"""
+    key = Key("0123456789abcdef0123456789abcdef")
+    faster = True
+    print(
+        f"{'负载':<10}{'格式':<8}{'字节':>6}{'编码(us)':>12}{'解码(us)':>12}{'相对原实现':>10}"
+    )
+    for name, payload in PAYLOADS.items():
+        raw = original_encode(key, payload)
+        encode = best_of(lambda: original_encode(key, payload), n)
+        decode = best_of(lambda: original_decode(key, raw), n)
+        original = encode + decode
+        print(f"{name:<10}{'原实现':<8}{len(raw):>6}{encode:>12.2f}{decode:>12.2f}{1:>10.2f}")
+
+        for version in (BLOCK_VERSION_JSON, BLOCK_VERSION_BINARY):
+            raw = Block(key, payload, version).block_bytes
+            encode = best_of(lambda: Block(key, payload, version).block_bytes, n)
+            decode = best_of(lambda: Block.from_bytes(key, raw), n)
+            ratio = (encode + decode) / original
+            print(
+                f"{name:<10}{version:<8}{len(raw):>6}{encode:>12.2f}{decode:>12.2f}{ratio:>10.2f}"
+            )
+            if version == BLOCK_VERSION_BINARY and ratio > 1:
+                faster = False
+    return faster
+
+
+if __name__ == "__main__":
+    sys.exit(0 if bench() else 1)
@@ -0,0 +1,117 @@
+"""
+Filename: bench/idle.py
+
+空闲连接的内存预算检查
+
+和bench.e2e一样在本机启动服务端、客户端和回显目标，通过Socks5端口建立CONNECTIONS个连接后保持空闲，
+分别统计客户端和服务端进程平均每个连接增加的常驻内存。超过预算时退出码为1，
+修改连接相关的代码后运行，防止每个连接的开销增长
+
+python3 -m bench.idle [--connections N] [--mux]
+"""
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+from typing import Dict
+
+import psutil
+import toml
+
+from bench.e2e import (
+    CONCURRENCY,
+    make_config,
+    run_client,
+    run_server,
+    run_targets,
+    start,
+    wait_listening,
+)
+from bench.relay import free_port
+from bench.scaling import socks_connect
+from config_parse import PyxyConfig
+
+CONNECTIONS = 2000
+# 每个空闲连接的内存预算，单位KB，按照当前的实测值留出少量余量
+# tls模式下主要是每条TLS连接在事件循环和OpenSSL中的缓冲，Python对象只占其中很小一部分
+CLIENT_BUDGET = {"tls": 64, "mux": 12}
+SERVER_BUDGET = {"tls": 40, "mux": 12}
+
+
+async def hold_idle(
+    config: PyxyConfig, target_port: int, n: int, pids: Dict[str, int]
+) -> Dict[str, float]:
+    """建立n个空闲连接，返回每个进程平均每个连接增加的内存，单位KB"""
+    client = config.client
+    proxy = (
+        client["socks5_address"],
+        client["socks5_port"],
+        client["username"],
+        client["password"],
+    )
+    processes = {name: psutil.Process(pid) for name, pid in pids.items()}
+    before = {name: p.memory_info().rss for name, p in processes.items()}
+
+    writers = []
+    for i in range(0, n, CONCURRENCY):
+        batch = min(CONCURRENCY, n - i)
+        opened = await asyncio.gather(
+            *(socks_connect(*proxy, target_port) for _ in range(batch))
+        )
+        writers += [w for _, w in opened]
+    await asyncio.sleep(2)
+
+    after = {name: p.memory_info().rss for name, p in processes.items()}
+    for writer in writers:
+        writer.close()
+    return {name: (after[name] - before[name]) / n / 1024 for name in processes}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="空闲连接的内存预算检查")
+    parser.add_argument("--connections", type=int, default=CONNECTIONS)
+    parser.add_argument("--mux", action="store_true", help="客户端使用多路复用")
+    args = parser.parse_args()
+    mode = "mux" if args.mux else "tls"
+
+    echo_port = free_port()
+    targets = start(run_targets, free_port(), free_port(), echo_port)
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_config(directory)
+        raw = toml.load(path)
+        raw["client"]["mux"] = args.mux
+        raw["server"]["backlog"] = raw["client"]["backlog"] = 4096
+        with open(path, "wt", encoding="utf-8") as f:
+            toml.dump(raw, f)
+
+        config = PyxyConfig(path)
+        server = start(run_server, path, True)
+        client = start(run_client, path, True)
+        try:
+            asyncio.run(wait_listening(config.server["port"]))
+            asyncio.run(wait_listening(config.client["socks5_port"]))
+            time.sleep(1)
+            result = asyncio.run(
+                hold_idle(
+                    config,
+                    echo_port,
+                    args.connections,
+                    {"client": client.pid, "server": server.pid},
+                )
+            )
+        finally:
+            for process in (server, client, targets):
+                process.kill()
+
+    budgets = {"client": CLIENT_BUDGET[mode], "server": SERVER_BUDGET[mode]}
+    print(f"{args.connections}个空闲连接，{mode}模式")
+    failed = False
+    for name, kilobytes in result.items():
+        over = kilobytes > budgets[name]
+        failed = failed or over
+        print(
+            f"{name:<8}{kilobytes:>8.1f}KB/连接  预算{budgets[name]}KB"
+            f"{'  超出预算' if over else ''}"
+        )
+    sys.exit(1 if failed else 0)
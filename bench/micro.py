@@ -0,0 +1,211 @@
+"""
+Filename: bench/micro.py
+
+预协商和Socks5协商热路径的微基准
+
+对每个函数测量每秒调用次数，以及tracemalloc统计的单次调用的内存分配峰值和调用结束后仍然保留的内存。
+结果保存在RESULT_FILE中，再次运行时和上一次的结果对比，用于判断safe_block.py和协商代码的修改效果。
+不需要网络，在仓库根目录运行
+
+python3 -m bench.micro [名称 ...]
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+from struct import pack
+from typing import Callable, Dict, Tuple
+
+import toml
+
+from bench.handshake import best_of
+from config_parse import EXAMPLE_FILE, PyxyConfig
+from proxy_broker import SockRelay
+from safe_block import BLOCK_VERSION_BINARY, BLOCK_VERSION_JSON, Block, Crypto, Key
+
+RESULT_FILE = "bench/micro_result.json"
+KEY_STRING = "0123456789abcdef0123456789abcdef"
+CONNECT = {"ip": "", "domain": "www.example.com", "port": 443}
+REPLY = {"bind_address": "203.0.113.7", "bind_port": 51234}
+ROUNDS = 2000  # 测量内存时的调用次数
+
+# Socks5客户端一次发送的认证和请求
+SOCKS_GREETING = pack("!BBB", 5, 1, 2)
+SOCKS_AUTH = b"\x01\x08username\x08password"
+SOCKS_REQUEST = b"\x05\x01\x00\x03\x0fwww.example.com" + pack("!H", 443)
+
+
+class NullWriter:
+    """丢弃所有写入的StreamWriter"""
+
+    def write(self, data: bytes) -> None:
+        pass
+
+    async def drain(self) -> None:
+        pass
+
+
+def make_relay() -> SockRelay:
+    """使用config.example的默认值创建SockRelay，不启动服务"""
+    config = toml.load(EXAMPLE_FILE)
+    config["general"]["key"] = KEY_STRING
+    config["general"]["log_level"] = "WARNING"
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "config.toml")
+        with open(path, "wt", encoding="utf-8") as f:
+            toml.dump(config, f)
+        config = PyxyConfig(path)
+    return SockRelay(config, remote_addr="localhost", remote_port=0)
+
+
+class ReplyWriter(NullWriter):
+    """模拟等待每个回复再发送下一段的客户端，每次写入时向reader追加下一段数据"""
+
+    def __init__(self, reader: asyncio.StreamReader, segments: Tuple[bytes, ...]):
+        self.reader = reader
+        self.segments = iter(segments)
+
+    def write(self, data: bytes) -> None:
+        segment = next(self.segments, None)
+        if segment is not None:
+            self.reader.feed_data(segment)
+
+
+def socks_case(relay: SockRelay, loop: asyncio.AbstractEventLoop) -> Callable[[], object]:
+    """从已经收到全部数据的StreamReader完成一次协商，即客户端连续发送认证和请求"""
+    data = SOCKS_GREETING + SOCKS_AUTH + SOCKS_REQUEST
+    writer = NullWriter()
+
+    async def negotiate():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        return await relay.negotiate(reader, writer)
+
+    return lambda: loop.run_until_complete(negotiate())
+
+
+def socks_stepwise_case(
+    relay: SockRelay, loop: asyncio.AbstractEventLoop
+) -> Callable[[], object]:
+    """客户端收到每个回复之后才发送下一段"""
+
+    async def negotiate():
+        reader = asyncio.StreamReader()
+        reader.feed_data(SOCKS_GREETING)
+        writer = ReplyWriter(reader, (SOCKS_AUTH, SOCKS_REQUEST))
+        return await relay.negotiate(reader, writer)
+
+    return lambda: loop.run_until_complete(negotiate())
+
+
+def cases(loop: asyncio.AbstractEventLoop) -> Dict[str, Callable[[], object]]:
+    key = Key(KEY_STRING)
+    crypto = Crypto(key.key_bytes)
+    plain = json.dumps({"payload": CONNECT}).encode("utf-8")
+    cipher = crypto.encrypt(plain)
+    binary = Block(key, CONNECT, BLOCK_VERSION_BINARY).block_bytes
+    legacy = Block(key, CONNECT, BLOCK_VERSION_JSON).block_bytes
+    reply = Block(key, REPLY, BLOCK_VERSION_BINARY).block_bytes
+    relay = make_relay()
+
+    return {
+        "key": lambda: Key(KEY_STRING),
+        "key.random": lambda: Key(),
+        "crypto.encrypt": lambda: crypto.encrypt(plain),
+        "crypto.decrypt": lambda: crypto.decrypt(cipher),
+        "block_bytes.connect": lambda: Block(key, CONNECT).block_bytes,
+        "block_bytes.reply": lambda: Block(key, REPLY).block_bytes,
+        "block_bytes.json": lambda: Block(key, CONNECT, BLOCK_VERSION_JSON).block_bytes,
+        "from_bytes.connect": lambda: Block.from_bytes(key, binary),
+        "from_bytes.reply": lambda: Block.from_bytes(key, reply),
+        "from_bytes.json": lambda: Block.from_bytes(key, legacy),
+        "socks.negotiate": socks_case(relay, loop),
+        "socks.negotiate.stepwise": socks_stepwise_case(relay, loop),
+    }
+
+
+def measure_memory(func: Callable[[], object]) -> Tuple[float, float]:
+    """返回单次调用的内存分配峰值和平均每次调用保留的内存，单位字节"""
+    func()  # 预热，排除首次调用的缓存
+    tracemalloc.start()
+    try:
+        peak = 0
+        for _ in range(10):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            func()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+
+        before = tracemalloc.get_traced_memory()[0]
+        for _ in range(ROUNDS):
+            func()
+        retained = (tracemalloc.get_traced_memory()[0] - before) / ROUNDS
+    finally:
+        tracemalloc.stop()
+    return peak, retained
+
+
+def calls_for(func: Callable[[], object]) -> int:
+    """让每轮测量持续大约0.2秒"""
+    seconds = best_of(func, 10, repeat=1) / 1e6
+    return max(10, int(0.2 / max(seconds, 1e-9)))
+
+
+def bench(selected) -> Dict[str, Dict[str, float]]:
+    loop = asyncio.new_event_loop()
+    try:
+        results = {}
+        for name, func in cases(loop).items():
+            if selected and name not in selected:
+                continue
+            microseconds = best_of(func, calls_for(func))
+            peak, retained = measure_memory(func)
+            results[name] = {
+                "ops_per_second": 1e6 / microseconds,
+                "peak_bytes": peak,
+                "retained_bytes": retained,
+            }
+        return results
+    finally:
+        loop.close()
+
+
+def load_previous() -> Dict[str, Dict[str, float]]:
+    try:
+        with open(RESULT_FILE, "rt", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def report(results: Dict[str, Dict[str, float]], previous: Dict[str, Dict[str, float]]):
+    print(
+        f"{'名称':<22}{'次/秒':>12}{'上次':>12}{'变化':>9}"
+        f"{'峰值(B)':>10}{'上次':>9}{'保留(B)':>9}"
+    )
+    for name, result in results.items():
+        ops = result["ops_per_second"]
+        last = previous.get(name)
+        if last:
+            change = f"{ops / last['ops_per_second'] - 1:>+9.1%}"
+            last_ops = f"{last['ops_per_second']:>12.0f}"
+            last_peak = f"{last['peak_bytes']:>9.0f}"
+        else:
+            change, last_ops, last_peak = f"{'-':>9}", f"{'-':>12}", f"{'-':>9}"
+        print(
+            f"{name:<22}{ops:>12.0f}{last_ops}{change}"
+            f"{result['peak_bytes']:>10.0f}{last_peak}{result['retained_bytes']:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    selected = set(sys.argv[1:])
+    previous = load_previous()
+    results = bench(selected)
+    report(results, previous)
+
+    previous.update(results)
+    with open(RESULT_FILE, "wt", encoding="utf-8") as f:
+        json.dump(previous, f, indent=2)
@@ -0,0 +1,120 @@
+"""
+Filename: bench/relay.py
+
+对比两种转发引擎的吞吐量和每GB数据消耗的CPU时间
+
+数据源、转发进程和接收端分别运行在三个进程中，只统计转发进程的CPU时间
+"""
+import asyncio
+import multiprocessing
+import socket
+import time
+
+import psutil
+
+from xybase import StreamBase
+
+TOTAL = 256 * 1024 * 1024  # 每轮传输的数据量
+CHUNK = b"\0" * 65536
+
+
+class BenchRelay(StreamBase):
+    """只做转发的StreamBase"""
+
+    def __init__(self, engine: str, target_port: int) -> None:
+        super().__init__("0" * 32)
+        self.logger.set_level("WARNING")
+        self.relay_engine = engine
+        self.target_port = target_port
+
+    async def handler(self, reader, writer) -> None:
+        remote_reader, remote_writer = await asyncio.open_connection(
+            "127.0.0.1", self.target_port, limit=self.stream_limit
+        )
+        await self.exchange_stream(reader, writer, remote_reader, remote_writer)
+        await self.try_close(writer)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_source(port: int) -> None:
+    """连接建立后发送TOTAL字节然后关闭"""
+
+    async def handler(reader, writer):
+        sent = 0
+        while sent < TOTAL:
+            writer.write(CHUNK)
+            await writer.drain()
+            sent += len(CHUNK)
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handler, "127.0.0.1", port)
+        await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def run_relay(engine: str, port: int, target_port: int) -> None:
+    async def main():
+        relay = BenchRelay(engine, target_port)
+        server = await asyncio.start_server(
+            relay.handler, "127.0.0.1", port, limit=relay.stream_limit
+        )
+        await server.serve_forever()
+
+    asyncio.run(main())
+
+
+async def sink(port: int) -> int:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    received = 0
+    while 1:
+        data = await reader.read(262144)
+        if not data:
+            break
+        received += len(data)
+    writer.close()
+    return received
+
+
+def bench(engine: str, source_port: int) -> None:
+    port = free_port()
+    process = multiprocessing.Process(
+        target=run_relay, args=(engine, port, source_port), daemon=True
+    )
+    process.start()
+    time.sleep(0.5)
+
+    relay = psutil.Process(process.pid)
+    cpu_before = sum(relay.cpu_times()[:2])
+    start = time.perf_counter()
+    received = asyncio.run(sink(port))
+    elapsed = time.perf_counter() - start
+    cpu = sum(relay.cpu_times()[:2]) - cpu_before
+    process.kill()
+
+    gigabytes = received / 1024**3
+    print(
+        f"{engine:<10}{received / 1024**2 / elapsed:>12.1f}"
+        f"{cpu / gigabytes:>14.2f}"
+    )
+
+
+if __name__ == "__main__":
+    source_port = free_port()
+    source = multiprocessing.Process(target=run_source, args=(source_port,), daemon=True)
+    source.start()
+    time.sleep(0.5)
+
+    print(f"每轮传输{TOTAL // 1024**2}MB")
+    print(f"{'引擎':<10}{'吞吐(MB/s)':>12}{'CPU(秒/GB)':>14}")
+    try:
+        for engine in ("stream", "protocol"):
+            bench(engine, source_port)
+    finally:
+        source.kill()
@@ -0,0 +1,201 @@
+"""
+Filename: bench/scaling.py
+
+对比单进程和多进程客户端的吞吐量
+
+使用当前目录下的config.toml，需要先在本机启动服务端，例如 python3 multi_server.py server，
+general.domain需要解析到本机，服务端使用自签名证书时需要填写client.ca_file。
+数据源运行在本机，多个Socks5连接同时经过客户端下载，只统计客户端进程的CPU时间。
+
+python3 -m bench.scaling [进程数 ...]
+"""
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+from struct import pack
+from typing import List, Tuple
+
+import psutil
+
+from bench.relay import free_port
+from config_parse import PyxyConfig
+from multi_server import Supervisor
+from proxy_broker import SockRelay
+
+PER_CONNECTION = 32 * 1024 * 1024  # 每个连接下载的数据量
+CONNECTIONS = 16  # 同时下载的连接数
+CHUNK = b"\0" * 65536
+
+
+def run_source(port: int) -> None:
+    """连接建立后发送PER_CONNECTION字节然后关闭"""
+
+    async def handler(reader, writer):
+        sent = 0
+        while sent < PER_CONNECTION:
+            writer.write(CHUNK)
+            await writer.drain()
+            sent += len(CHUNK)
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handler, "127.0.0.1", port, backlog=1024)
+        await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def run_client(workers: int) -> None:
+    config = PyxyConfig()
+    if workers == 1:
+        SockRelay(
+            config,
+            remote_addr=config.general["domain"],
+            remote_port=config.server["port"],
+            name="1",
+        ).run()
+    else:
+        asyncio.run(Supervisor(config, "client", workers).run())
+
+
+async def socks_connect(
+    address: str, port: int, username: str, password: str, target_port: int
+) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """通过Socks5代理连接127.0.0.1上的target_port，返回连接目标成功后的流"""
+    reader, writer = await asyncio.open_connection(address, port)
+
+    writer.write(pack("!BBB", 5, 1, 2))
+    await reader.readexactly(2)
+    username = username.encode("utf-8")
+    password = password.encode("utf-8")
+    writer.write(
+        pack("!BB", 1, len(username)) + username + pack("!B", len(password)) + password
+    )
+    if (await reader.readexactly(2))[1] != 0:
+        raise ConnectionError("身份验证失败")
+
+    writer.write(
+        pack("!BBBB", 5, 1, 0, 1) + socket.inet_aton("127.0.0.1") + pack("!H", target_port)
+    )
+    reply = await reader.readexactly(4)
+    if reply[1] != 0:
+        raise ConnectionError("连接目标失败")
+    await reader.readexactly(4 + 2 if reply[3] == 1 else 16 + 2)
+    return reader, writer
+
+
+async def socks_download(
+    address: str, port: int, username: str, password: str, target_port: int
+) -> int:
+    """通过Socks5代理连接127.0.0.1上的数据源，返回收到的字节数"""
+    reader, writer = await socks_connect(address, port, username, password, target_port)
+
+    received = 0
+    while 1:
+        data = await reader.read(262144)
+        if not data:
+            break
+        received += len(data)
+    writer.close()
+    return received
+
+
+async def download(config: PyxyConfig, target_port: int) -> int:
+    """通过客户端的Socks5端口下载"""
+    client = config.client
+    address = client["socks5_address"]
+    if address in ("0.0.0.0", "::"):
+        address = "127.0.0.1"
+    return await socks_download(
+        address,
+        client["socks5_port"],
+        client["username"],
+        client["password"],
+        target_port,
+    )
+
+
+async def wait_listening(config: PyxyConfig, timeout: float = 10) -> None:
+    client = config.client
+    address = client["socks5_address"]
+    if address in ("0.0.0.0", "::"):
+        address = "127.0.0.1"
+    deadline = time.monotonic() + timeout
+    while 1:
+        try:
+            _, writer = await asyncio.open_connection(address, client["socks5_port"])
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+def cpu_seconds(process: psutil.Process) -> float:
+    """进程和所有子进程的CPU时间"""
+    total = 0.0
+    for p in [process] + process.children(recursive=True):
+        try:
+            total += sum(p.cpu_times()[:2])
+        except psutil.Error:
+            pass
+    return total
+
+
+def bench(config: PyxyConfig, workers: int, target_port: int) -> Tuple[float, float]:
+    """返回吞吐量(MB/s)和每GB数据消耗的CPU秒数"""
+    process = multiprocessing.Process(target=run_client, args=(workers,))
+    process.start()
+    try:
+        asyncio.run(wait_listening(config))
+        time.sleep(1 if workers == 1 else 3)  # 等待所有worker开始服务
+
+        client = psutil.Process(process.pid)
+        cpu_before = cpu_seconds(client)
+        start = time.perf_counter()
+
+        async def run_all() -> List[int]:
+            return await asyncio.gather(
+                *(download(config, target_port) for _ in range(CONNECTIONS))
+            )
+
+        received = sum(asyncio.run(run_all()))
+        elapsed = time.perf_counter() - start
+        cpu = cpu_seconds(client) - cpu_before
+    finally:
+        os.kill(process.pid, signal.SIGTERM)
+        process.join(30)
+        if process.is_alive():
+            process.kill()
+
+    return received / 1024**2 / elapsed, cpu / (received / 1024**3)
+
+
+if __name__ == "__main__":
+    config = PyxyConfig()
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else 1
+    counts = [int(n) for n in sys.argv[1:]] or sorted({1, 2, max(cores, 1)})
+
+    source_port = free_port()
+    source = multiprocessing.Process(target=run_source, args=(source_port,), daemon=True)
+    source.start()
+    time.sleep(0.5)
+
+    print(f"{CONNECTIONS}个连接，每个连接{PER_CONNECTION // 1024**2}MB，可用CPU核心{cores}个")
+    print(f"{'进程数':<8}{'吞吐(MB/s)':>12}{'CPU(秒/GB)':>14}{'加速比':>10}")
+    try:
+        baseline = None
+        for workers in counts:
+            throughput, cpu = bench(config, workers, source_port)
+            baseline = baseline or throughput  # 第一组，默认为单进程
+            print(
+                f"{workers:<8}{throughput:>12.1f}{cpu:>14.2f}"
+                f"{throughput / baseline:>10.2f}"
+            )
+    finally:
+        source.kill()
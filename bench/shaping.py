@@ -0,0 +1,129 @@
+"""
+Filename: bench/shaping.py
+
+检查带宽限制的准确度和公平性
+
+和bench.e2e一样在本机启动服务端、客户端和测试目标，客户端设置rate_limit，
+BULK_CONNECTIONS个连接同时下载DURATION秒，统计总速率相对限制的偏差和各个连接速率的差异，
+同时通过回显目标逐个往返，测量大流量下交互式连接的延迟
+
+python3 -m bench.shaping [--rate MB/s] [--engine stream|protocol]
+"""
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+from typing import Dict, List
+
+import toml
+
+from bench.e2e import (
+    make_config,
+    percentile,
+    run_client,
+    run_server,
+    run_targets,
+    start,
+    wait_listening,
+)
+from bench.relay import free_port
+from bench.scaling import socks_connect
+from config_parse import PyxyConfig
+
+RATE = 8  # 限制的速率，单位MB/s
+BULK_CONNECTIONS = 8
+DURATION = 5.0
+PING_SIZE = 64
+
+
+async def measure(config: PyxyConfig, ports: Dict[str, int]) -> Dict[str, object]:
+    client = config.client
+    proxy = (
+        client["socks5_address"],
+        client["socks5_port"],
+        client["username"],
+        client["password"],
+    )
+    stop = time.perf_counter() + DURATION
+
+    async def download() -> int:
+        reader, writer = await socks_connect(*proxy, ports["bulk"])
+        received = 0
+        while time.perf_counter() < stop:
+            data = await reader.read(65536)
+            if not data:
+                break
+            received += len(data)
+        writer.close()
+        return received
+
+    async def ping() -> List[float]:
+        reader, writer = await socks_connect(*proxy, ports["echo"])
+        samples = []
+        data = b"\0" * PING_SIZE
+        await asyncio.sleep(0.5)  # 等待下载占满带宽
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            writer.write(data)
+            await reader.readexactly(PING_SIZE)
+            samples.append(time.perf_counter() - start)
+            await asyncio.sleep(0.05)
+        writer.close()
+        return samples
+
+    start = time.perf_counter()
+    received, samples = await asyncio.gather(
+        asyncio.gather(*(download() for _ in range(BULK_CONNECTIONS))), ping()
+    )
+    elapsed = time.perf_counter() - start
+    return {"received": received, "elapsed": elapsed, "pings": samples}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="带宽限制的准确度和公平性")
+    parser.add_argument("--rate", type=float, default=RATE, help="限制的速率，单位MB/s")
+    parser.add_argument("--engine", default="stream", help="转发引擎")
+    args = parser.parse_args()
+
+    ports = {"http": free_port(), "bulk": free_port(), "echo": free_port()}
+    targets = start(run_targets, ports["http"], ports["bulk"], ports["echo"])
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_config(directory)
+        raw = toml.load(path)
+        raw["general"]["relay_engine"] = args.engine
+        with open(path, "wt", encoding="utf-8") as f:
+            toml.dump(raw, f)
+        server = start(run_server, path, True)
+
+        # 只有客户端限制带宽
+        raw["general"]["rate_limit"] = int(args.rate * 1024**2)
+        client_path = f"{directory}/client.toml"
+        with open(client_path, "wt", encoding="utf-8") as f:
+            toml.dump(raw, f)
+        config = PyxyConfig(client_path)
+        client = start(run_client, client_path, True)
+        try:
+            asyncio.run(wait_listening(config.server["port"]))
+            asyncio.run(wait_listening(config.client["socks5_port"]))
+            time.sleep(1)
+            result = asyncio.run(measure(config, ports))
+        finally:
+            for process in (server, client, targets):
+                process.kill()
+
+    rates = [n / result["elapsed"] / 1024**2 for n in result["received"]]
+    total = sum(rates)
+    # 开始时令牌桶是满的，允许额外突发rate_burst秒的数据量
+    expected = args.rate * (1 + raw["general"]["rate_burst"] / result["elapsed"])
+    pings = result["pings"]
+    print(f"{BULK_CONNECTIONS}个连接下载{DURATION:.0f}秒，限制{args.rate:.1f}MB/s，{args.engine}引擎")
+    print(f"总速率 {total:.2f}MB/s，含突发的预期 {expected:.2f}MB/s，偏差 {total / expected - 1:+.1%}")
+    print(
+        f"单个连接 最小{min(rates):.2f} 最大{max(rates):.2f}MB/s，"
+        f"变异系数 {statistics.pstdev(rates) / statistics.mean(rates):.1%}"
+    )
+    print(
+        f"交互连接往返 p50 {percentile(pings, 0.5) * 1000:.1f}ms "
+        f"p99 {percentile(pings, 0.99) * 1000:.1f}ms"
+    )
@@ -0,0 +1,171 @@
+"""
+Filename: bench/ttfb.py
+
+测量乐观模式节省的首字节时间
+
+和bench.e2e一样在本机启动服务端、客户端和HTTP目标，客户端到服务端之间经过一个增加固定往返延迟的转发进程，
+模拟真实网络中客户端到服务器的距离。每个请求从连接Socks5端口开始，到收到目标响应的第一个字节结束，
+分别在普通模式和乐观模式下测量，乐观模式应当少一个往返延迟
+
+python3 -m bench.ttfb [--rtt 毫秒] [--mux]
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from typing import List
+
+import toml
+
+from bench.e2e import (
+    HTTP_REQUEST,
+    make_config,
+    percentile,
+    run_client,
+    run_server,
+    run_targets,
+    start,
+    wait_listening,
+)
+from bench.relay import free_port
+from bench.scaling import socks_connect
+from config_parse import PyxyConfig
+
+RTT = 50  # 客户端到服务端的往返延迟，单位毫秒
+REQUESTS = 50
+
+
+def run_delay(port: int, target_port: int, rtt: float) -> None:
+    """把port上的连接转发到target_port，每个方向的数据延迟rtt/2秒后送达"""
+
+    async def pipe(reader, writer):
+        queue = asyncio.Queue()
+
+        async def deliver():
+            while 1:
+                due, data = await queue.get()
+                await asyncio.sleep(due - time.monotonic())
+                if not data:
+                    writer.write_eof()
+                    return
+                writer.write(data)
+                await writer.drain()
+
+        task = asyncio.ensure_future(deliver())
+        try:
+            while 1:
+                data = await reader.read(65536)
+                queue.put_nowait((time.monotonic() + rtt / 2, data))
+                if not data:
+                    break
+            await task
+        except (ConnectionError, OSError):
+            task.cancel()
+
+    async def handler(reader, writer):
+        try:
+            target_reader, target_writer = await asyncio.open_connection(
+                "127.0.0.1", target_port
+            )
+        except OSError:
+            writer.close()
+            return
+        await asyncio.gather(
+            pipe(reader, target_writer), pipe(target_reader, writer)
+        )
+        writer.close()
+        target_writer.close()
+
+    async def main():
+        await asyncio.start_server(handler, "127.0.0.1", port)
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+async def measure(config: PyxyConfig, target_port: int) -> List[float]:
+    """逐个请求，返回每个请求的首字节时间"""
+    client = config.client
+    proxy = (
+        client["socks5_address"],
+        client["socks5_port"],
+        client["username"],
+        client["password"],
+    )
+    samples = []
+    for _ in range(REQUESTS):
+        start = time.perf_counter()
+        reader, writer = await socks_connect(*proxy, target_port)
+        writer.write(HTTP_REQUEST)
+        if not await reader.read(1):
+            raise ConnectionError("没有收到响应")
+        samples.append(time.perf_counter() - start)
+        writer.close()
+    return samples
+
+
+def bench(path: str, optimistic: bool, http_port: int) -> List[float]:
+    raw = toml.load(path)
+    raw["client"]["optimistic"] = optimistic
+    client_path = os.path.join(os.path.dirname(path), f"client_{optimistic}.toml")
+    with open(client_path, "wt", encoding="utf-8") as f:
+        toml.dump(raw, f)
+
+    config = PyxyConfig(client_path)
+    client = start(run_client, client_path, True)
+    try:
+        asyncio.run(wait_listening(config.client["socks5_port"]))
+        time.sleep(1)  # 等待客户端的连接池或者多路复用连接建立
+        return asyncio.run(measure(config, http_port))
+    finally:
+        client.kill()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="乐观模式的首字节时间")
+    parser.add_argument("--rtt", type=float, default=RTT, help="往返延迟，单位毫秒")
+    parser.add_argument("--mux", action="store_true", help="客户端使用多路复用")
+    args = parser.parse_args()
+
+    http_port = free_port()
+    targets = start(run_targets, http_port, free_port(), free_port())
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_config(directory)
+        raw = toml.load(path)
+        server_port = raw["server"]["port"]
+        delay_port = free_port()
+        # 服务端使用原来的端口，客户端连接延迟转发的端口
+        raw["server"]["port"] = delay_port
+        raw["client"]["mux"] = args.mux
+        with open(path, "wt", encoding="utf-8") as f:
+            toml.dump(raw, f)
+
+        server_raw = dict(raw, server=dict(raw["server"], port=server_port))
+        server_path = os.path.join(directory, "server.toml")
+        with open(server_path, "wt", encoding="utf-8") as f:
+            toml.dump(server_raw, f)
+
+        server = start(run_server, server_path, True)
+        delay = start(run_delay, delay_port, server_port, args.rtt / 1000)
+        try:
+            asyncio.run(wait_listening(server_port))
+            asyncio.run(wait_listening(delay_port))
+            results = {
+                "普通": bench(path, False, http_port),
+                "乐观": bench(path, True, http_port),
+            }
+        finally:
+            for process in (server, delay, targets):
+                process.kill()
+
+    mode = "mux" if args.mux else "tls"
+    print(f"{REQUESTS}个请求，往返延迟{args.rtt:.0f}ms，{mode}模式")
+    print(f"{'模式':<8}{'p50(ms)':>10}{'p99(ms)':>10}")
+    for name, samples in results.items():
+        print(
+            f"{name:<8}{percentile(samples, 0.5) * 1000:>10.1f}"
+            f"{percentile(samples, 0.99) * 1000:>10.1f}"
+        )
+    saved = percentile(results["普通"], 0.5) - percentile(results["乐观"], 0.5)
+    print(f"节省 p50 {saved * 1000:.1f}ms")
@@ -0,0 +1,206 @@
+"""
+Filename: bench/udp.py
+
+测试UDP ASSOCIATE的转发性能
+
+1. 逐个往返的延迟，与直接访问回显服务的延迟相比，得到经过隧道增加的延迟
+2. 保持WINDOW个数据报在途时，每秒往返的数据报数和丢失的数据报数
+
+使用当前目录下的config.toml，和bench.scaling一样需要先在本机启动服务端，客户端由测试启动。
+回显服务运行在本机
+
+python3 -m bench.udp
+"""
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from struct import pack
+from typing import List, Tuple
+
+from bench.relay import free_port
+from bench.scaling import run_client, wait_listening
+from config_parse import PyxyConfig
+
+PINGS = 2000  # 测量延迟的往返次数
+COUNT = 50000  # 测量吞吐的数据报数
+WINDOW = 64  # 在途的数据报数
+SIZES = (64, 1200)
+STALL = 1.0  # 超过该秒数没有收到回显时结束测量
+
+
+def run_echo(port: int) -> None:
+    class Echo(asyncio.DatagramProtocol):
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, addr):
+            self.transport.sendto(data, addr)
+
+    async def main():
+        await asyncio.get_running_loop().create_datagram_endpoint(
+            Echo, local_addr=("127.0.0.1", port)
+        )
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+async def associate(config: PyxyConfig) -> Tuple[asyncio.StreamWriter, tuple]:
+    """完成Socks5的UDP ASSOCIATE，返回控制连接和客户端的UDP地址"""
+    client = config.client
+    address = client["socks5_address"]
+    if address in ("0.0.0.0", "::"):
+        address = "127.0.0.1"
+    reader, writer = await asyncio.open_connection(address, client["socks5_port"])
+
+    writer.write(pack("!BBB", 5, 1, 2))
+    await reader.readexactly(2)
+    username = client["username"].encode("utf-8")
+    password = client["password"].encode("utf-8")
+    writer.write(
+        pack("!BB", 1, len(username)) + username + pack("!B", len(password)) + password
+    )
+    if (await reader.readexactly(2))[1] != 0:
+        raise ConnectionError("身份验证失败")
+
+    writer.write(pack("!BBBB", 5, 3, 0, 1) + bytes(4) + pack("!H", 0))
+    reply = await reader.readexactly(4)
+    if reply[1] != 0:
+        raise ConnectionError("UDP关联失败")
+    if reply[3] == 1:
+        raw = await reader.readexactly(4)
+        host = socket.inet_ntop(socket.AF_INET, raw)
+    else:
+        raw = await reader.readexactly(16)
+        host = socket.inet_ntop(socket.AF_INET6, raw)
+    port = int.from_bytes(await reader.readexactly(2), "big")
+    return writer, (host, port)
+
+
+class Probe(asyncio.DatagramProtocol):
+    """发送数据报并统计回显，header为Socks5的UDP请求头，直接访问时为空"""
+
+    def __init__(self, target: tuple, header: bytes) -> None:
+        self.target = target
+        self.header = header
+        self.transport = None
+        self.waiter = None
+        self.received = 0
+        self.last = 0.0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def send(self, data: bytes) -> None:
+        self.transport.sendto(self.header + data, self.target)
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+        self.last = time.perf_counter()
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+
+async def open_probe(target: tuple, header: bytes) -> Probe:
+    family = socket.AF_INET6 if ":" in target[0] else socket.AF_INET
+    _, probe = await asyncio.get_running_loop().create_datagram_endpoint(
+        lambda: Probe(target, header), family=family, local_addr=("127.0.0.1", 0)
+    )
+    return probe
+
+
+async def latency(probe: Probe) -> List[float]:
+    """逐个往返，返回每次的延迟，丢失的不计入"""
+    loop = asyncio.get_running_loop()
+    samples = []
+    for _ in range(PINGS):
+        probe.waiter = loop.create_future()
+        start = time.perf_counter()
+        probe.send(b"\0" * SIZES[0])
+        try:
+            await asyncio.wait_for(probe.waiter, STALL)
+        except asyncio.TimeoutError:
+            continue
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+async def throughput(probe: Probe, size: int) -> Tuple[float, int]:
+    """保持WINDOW个数据报在途，返回每秒往返的数据报数和丢失数"""
+    loop = asyncio.get_running_loop()
+    data = b"\0" * size
+    base = probe.received
+    sent = lost = 0
+    start = probe.last = time.perf_counter()
+    while sent < COUNT:
+        inflight = sent - lost - (probe.received - base)
+        for _ in range(min(WINDOW - inflight, COUNT - sent)):
+            probe.send(data)
+            sent += 1
+        probe.waiter = loop.create_future()
+        try:
+            await asyncio.wait_for(probe.waiter, STALL)
+        except asyncio.TimeoutError:
+            lost += sent - lost - (probe.received - base)  # 在途的数据报视为丢失
+    while (
+        probe.received - base + lost < COUNT
+        and time.perf_counter() - probe.last < STALL
+    ):
+        await asyncio.sleep(0.01)
+
+    done = min(probe.received - base, COUNT)
+    return done / (probe.last - start), COUNT - done
+
+
+def percentile(samples: List[float], p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * p), len(samples) - 1)] * 1000
+
+
+async def main(config: PyxyConfig, echo_port: int) -> None:
+    target = ("127.0.0.1", echo_port)
+    header = b"\0\0\0\x01" + socket.inet_aton(target[0]) + pack("!H", echo_port)
+
+    direct = await open_probe(target, b"")
+    control, relay_address = await associate(config)
+    relay = await open_probe(relay_address, header)
+
+    base = await latency(direct)
+    via = await latency(relay)
+    print(f"{PINGS}次往返，数据报{SIZES[0]}字节")
+    print(f"{'路径':<8}{'p50(ms)':>10}{'p99(ms)':>10}{'丢失':>8}")
+    for name, samples in (("直接", base), ("隧道", via)):
+        print(
+            f"{name:<8}{percentile(samples, 0.5):>10.3f}"
+            f"{percentile(samples, 0.99):>10.3f}{PINGS - len(samples):>8}"
+        )
+    print(f"增加的延迟 p50 {percentile(via, 0.5) - percentile(base, 0.5):.3f}ms")
+
+    print(f"\n{COUNT}个数据报，在途{WINDOW}个")
+    print(f"{'大小':<8}{'数据报/秒':>12}{'MB/s':>10}{'丢失':>8}")
+    for size in SIZES:
+        rate, lost = await throughput(relay, size)
+        print(f"{size:<8}{rate:>12.0f}{rate * size / 1024**2:>10.1f}{lost:>8}")
+
+    control.close()
+
+
+if __name__ == "__main__":
+    config = PyxyConfig()
+    echo_port = free_port()
+    echo = multiprocessing.Process(target=run_echo, args=(echo_port,), daemon=True)
+    echo.start()
+    client = multiprocessing.Process(target=run_client, args=(1,))
+    client.start()
+    try:
+        asyncio.run(wait_listening(config))
+        asyncio.run(main(config, echo_port))
+    finally:
+        os.kill(client.pid, signal.SIGTERM)
+        client.join(30)
+        if client.is_alive():
+            client.kill()
+        echo.kill()
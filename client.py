@@ -3,9 +3,19 @@ Filename: client.py
 """
 import asyncio
 import copy
-from typing import Tuple, Union
-from safe_block import Block, DecryptError
-from xybase import StreamBase
+import socket
+import time
+from collections import deque
+from ssl import SSLError
+from typing import Deque, List, Optional, Tuple
+from safe_block import Block, DecryptError, Key, read_block, BLOCK_VERSION_BINARY
+from mux import MUX_VERSION
+from udp import UDP_VERSION
+from tls import ResumableContext
+from sockopt import SocketOptions
+import connector
+import metrics
+from xylog import DEBUG, INFO, WARNING
 from aisle import SyncLogger
 
 
@@ -20,33 +30,220 @@ class RemoteClientError(Exception):
         return f"RemoteClientError: {self.message}"
 
 
-class Client(StreamBase):
-    """维护和远程的连接"""
+async def open_remote(
+    remote_addr: str,
+    remote_port: int,
+    ssl_context: ResumableContext = None,
+    limit: int = 65536,
+    socket_options: SocketOptions = None,
+) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """和远程服务器建立TLS连接，套接字选项在连接之前设置"""
+    start = time.perf_counter()
+    infos = await asyncio.get_running_loop().getaddrinfo(
+        remote_addr, remote_port, type=socket.SOCK_STREAM
+    )
+    addresses: List[str] = list(dict.fromkeys(info[4][0] for info in infos))
+    rtn = await connector.open_connection(
+        addresses,
+        remote_port,
+        limit=limit,
+        options=socket_options,
+        ssl=ssl_context or True,
+        server_hostname=remote_addr,
+    )
+    metrics.TLS_CONNECT.observe(metrics.elapsed(start))
+    return rtn
+
+
+class ConnectionPool:
+    """预先完成TCP连接和TLS握手的远程连接池
+
+    remote_addr: 远程服务器地址
+    remote_port: 远程服务器端口
+    size: 最多保持的空闲连接数
+    min_idle: 空闲连接少于该数量时，在后台补充至size
+    max_age: 空闲连接的最大存活秒数
+    ssl_context: 可选，共享的客户端安全环境
+    limit: 连接的StreamReader缓冲上限
+    socket_options: 可选，连接远程时使用的套接字选项
+    """
+
+    def __init__(
+        self,
+        remote_addr: str,
+        remote_port: int,
+        logger: SyncLogger,
+        size: int = 4,
+        min_idle: int = 2,
+        max_age: float = 30,
+        ssl_context: ResumableContext = None,
+        limit: int = 65536,
+        socket_options: SocketOptions = None,
+    ) -> None:
+        self.remote_addr = remote_addr
+        self.remote_port = remote_port
+        self.logger = logger
+        self.size = size
+        self.min_idle = min(min_idle, size)
+        self.max_age = max_age
+        self.ssl_context = ssl_context
+        self.limit = limit
+        self.socket_options = socket_options
+
+        # 按建立时间排序，(建立时间, reader, writer)
+        self.idle: Deque[
+            Tuple[float, asyncio.StreamReader, asyncio.StreamWriter]
+        ] = deque()
+        self.hits = 0  # 直接从池中取得连接的次数
+        self.misses = 0  # 池中没有可用连接，临时建立连接的次数
+
+        self._refill_task: Optional[asyncio.Task] = None
+        self._sweep_handle: Optional[asyncio.TimerHandle] = None
+
+    def start(self) -> None:
+        """在事件循环中启动，开始预热连接"""
+        self.__schedule_refill()
+        self.__sweep()
+
+    async def acquire(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """取出一个可用的连接，池为空时临时建立"""
+        now = asyncio.get_running_loop().time()
+        while self.idle:
+            created, reader, writer = self.idle.pop()  # 优先使用最新的连接
+            if self.__usable(now, created, reader, writer):
+                self.hits += 1
+                self.__schedule_refill()
+                return reader, writer
+
+            writer.close()
+
+        self.misses += 1
+        self.__schedule_refill()
+        return await self.connect()
+
+    async def connect(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        return await open_remote(
+            self.remote_addr,
+            self.remote_port,
+            self.ssl_context,
+            self.limit,
+            self.socket_options,
+        )
+
+    def __usable(
+        self,
+        now: float,
+        created: float,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> bool:
+        """连接未过期并且没有被服务器关闭"""
+        return (
+            now - created < self.max_age
+            and not writer.is_closing()
+            and not reader.at_eof()
+        )
+
+    def __prune(self) -> None:
+        """关闭并移除过期或者已经被服务器关闭的空闲连接，否则它们会被计入空闲数量而不再补充"""
+        now = asyncio.get_running_loop().time()
+        usable = deque()
+        for entry in self.idle:
+            if self.__usable(now, *entry):
+                usable.append(entry)
+            else:
+                entry[2].close()
+        self.idle = usable
+
+    def __schedule_refill(self) -> None:
+        self.__prune()
+        if len(self.idle) >= self.min_idle:
+            return
+        if self._refill_task is not None and not self._refill_task.done():
+            return
+        self._refill_task = asyncio.ensure_future(self.__refill())
+
+    async def __refill(self) -> None:
+        loop = asyncio.get_running_loop()
+        while len(self.idle) < self.size:
+            try:
+                reader, writer = await self.connect()
+            except Exception as error:
+                self.logger.warning(f"预热连接失败 > {type(error)}|{error}")
+                return
+            self.idle.append((loop.time(), reader, writer))
+
+        self.logger.debug(f"连接池已补充，命中{self.hits}次，未命中{self.misses}次")
+
+    def __sweep(self) -> None:
+        """定期关闭存活过久或者已经断开的空闲连接，并在最早的连接到期时再次检查"""
+        loop = asyncio.get_running_loop()
+        self.__schedule_refill()  # 先移除失效的连接
+
+        delay = self.max_age / 2
+        if self.idle:
+            delay = min(delay, self.idle[0][0] + self.max_age - loop.time())
+        self._sweep_handle = loop.call_later(max(delay, 0), self.__sweep)
+
+
+class RemoteSession:
+    """一个Socks连接在远程的会话
+
+    密钥、安全环境、连接池和日志由SockRelay共享，这里只保存预协商和转发需要的状态。
+    会话和转发的连接一样长期存在，因此不继承StreamBase，避免每个连接带上计数器、日志对象和实例字典
+
+    key: SockRelay的密钥，共享已经创建的加密对象
+    logger: 所属Socks连接的日志
+    """
+
+    __slots__ = (
+        "key",
+        "remote_addr",
+        "remote_port",
+        "logger",
+        "pool",
+        "ssl_context",
+        "block_version",
+        "limit",
+        "socket_options",
+        "remote_reader",
+        "remote_writer",
+    )
 
     def __init__(
         self,
-        key: str,
-        remoteAddr: str,
-        remotePort: int,
-        tag: Union[str, int] = None,
+        key: Key,
+        remote_addr: str,
+        remote_port: int,
+        logger: SyncLogger,
+        pool: ConnectionPool = None,
+        ssl_context: ResumableContext = None,
+        block_version: int = BLOCK_VERSION_BINARY,
+        limit: int = 65536,
+        socket_options: SocketOptions = None,
     ) -> None:
-        super().__init__(key=key)
-        if tag:
-            self.logger: SyncLogger = self.logger.getChild(f"{tag}")
-        self.remote_addr = remoteAddr
-        self.remote_port = remotePort
-        self.remote_reader: asyncio.StreamReader
-        self.remote_writer: asyncio.StreamWriter
+        self.key = key
+        self.remote_addr = remote_addr
+        self.remote_port = remote_port
+        self.logger = logger
+        self.pool = pool
+        self.ssl_context = ssl_context
+        self.block_version = block_version
+        self.limit = limit
+        self.socket_options = socket_options
+        self.remote_reader: Optional[asyncio.StreamReader] = None
+        self.remote_writer: Optional[asyncio.StreamWriter] = None
 
-    # HACK: 需要优化内存，减小长连接的内存占用
+    async def remote_handshake(self, payload: dict, early: bytes = b"") -> tuple:
+        """打开一个连接之前的预协商
 
-    async def remote_handshake(self, payload: dict) -> tuple:
-        """打开一个连接之前的预协商"""
+        early: 客户端已经发送的数据，紧跟在区块之后一起写入，服务端连接目标后转发
+        """
 
         try:
-            with Block(self.key, payload) as block:
+            with Block(self.key, payload, self.block_version) as block:
                 response = await self.__exchange_block(
-                    copy.copy(block.block_bytes)
+                    copy.copy(block.block_bytes) + early
                 )
 
             response_block = Block.from_bytes(self.key, response)
@@ -55,57 +252,105 @@ class Client(StreamBase):
                 response_block.payload["bind_address"],
                 response_block.payload["bind_port"],
             )
-            self.logger.info("预协商成功")
+            self.logger.event("request", INFO, "预协商成功")
             if (bind_address == "") or (bind_port == 0):
                 raise RemoteClientError("远程的连接建立失败")
 
             rtn = bind_address, bind_port
-            self.logger.debug(f"远程已创建连接，地址：{bind_address}，端口：{bind_port}")
+            self.logger.event(
+                "request", DEBUG, "远程已创建连接，地址：{}，端口：{}", bind_address, bind_port
+            )
             return rtn
 
         except ConnectionResetError:
-            self.logger.warning("远程连接关闭")
+            self.logger.event("failure", WARNING, "远程连接关闭")
             await self.remote_close()
             return None, None
 
         except DecryptError as error:
-            self.logger.warning(f"预协商解密时发生错误 {error}")
+            self.logger.event("failure", WARNING, "预协商解密时发生错误 {}", error)
             await self.remote_close()
             return None, None
 
         except ConnectionRefusedError:
-            self.logger.warning("远程连接被拒绝")
+            self.logger.event("failure", WARNING, "远程连接被拒绝")
             # 因为远程连接没有创建，所以不用关闭
             # await self.remote_close()
             return None, None
 
         except Exception as error:
-            self.logger.warning(f"其他错误 > {type(error)}|{error}")
+            self.logger.event("failure", WARNING, "其他错误 > {}|{}", type(error), error)
             await self.remote_close()
             raise error
 
+    async def mux_handshake(
+        self,
+    ) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """打开一条多路复用连接的预协商，成功后返回底层连接"""
+        await self.__tunnel_handshake("mux", MUX_VERSION)
+        self.logger.info("多路复用预协商成功")
+        return self.remote_reader, self.remote_writer
+
+    async def udp_handshake(
+        self,
+    ) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """打开一条转发UDP数据报的连接，成功后返回底层连接"""
+        await self.__tunnel_handshake("udp", UDP_VERSION)
+        self.logger.event("request", INFO, "UDP预协商成功")
+        return self.remote_reader, self.remote_writer
+
+    async def __tunnel_handshake(self, name: str, version: int) -> None:
+        """预协商后整条连接用于name指定的协议，服务端需要回复相同的版本"""
+        with Block(self.key, {name: version}, self.block_version) as block:
+            response = await self.__exchange_block(copy.copy(block.block_bytes))
+
+        response_block = Block.from_bytes(self.key, response)
+        if response_block.payload.get(name) != version:
+            await self.remote_close()
+            raise RemoteClientError(f"远程不支持{name}")
+
     async def remote_close(self) -> None:
         """关闭远程的连接
 
         捕获所有异常"""
-        await self.try_close(self.remote_writer)
+        writer = self.remote_writer
+        if writer is None:
+            return
+        try:
+            if not writer.is_closing():
+                writer.close()
+            await writer.wait_closed()
+        except (ConnectionError, SSLError):
+            pass  # 连接已经断开
+        except Exception as err:
+            self.logger.warning("在关闭连接时发生意外错误 > {} {}", type(err), err)
 
     async def __exchange_block(self, raw: bytes) -> bytes:
         """远程的连接预协商，self.reader和writer初始化"""
         self.remote_reader, self.remote_writer = await self.__connect()
 
+        start = time.perf_counter()
         self.remote_writer.write(raw)
         await self.remote_writer.drain()
-        rtn = await self.remote_reader.read(4096)
+        rtn = await read_block(self.remote_reader)
+        metrics.BLOCK_HANDSHAKE.observe(metrics.elapsed(start))
+
+        if self.ssl_context is not None:
+            # 此时已经收到了服务器的数据，会话票据也已经到达
+            self.ssl_context.record(self.remote_writer.get_extra_info("ssl_object"))
 
         return rtn
 
     async def __connect(
         self,
     ) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
-        return await asyncio.open_connection(
+        if self.pool is not None:
+            return await self.pool.acquire()
+
+        return await open_remote(
             self.remote_addr,
             self.remote_port,
-            # limit=4096,
-            ssl=True,
+            self.ssl_context,
+            self.limit,
+            self.socket_options,
         )
@@ -12,10 +12,13 @@ VERSION = 1  # TODO: 添加跨版本控制代码
 
 
 class PyxyConfig:
-    """配置文件类，三个属性，每个属性存储一个字典"""
+    """配置文件类，三个属性，每个属性存储一个字典
 
-    def __init__(self) -> None:
-        with ConfigParser() as config:
+    path: 配置文件的路径，默认为当前目录下的config.toml
+    """
+
+    def __init__(self, path: str = DEFAULT_FILE) -> None:
+        with ConfigParser(path) as config:
             self.all = config.config
         return
 
@@ -49,13 +52,14 @@ class PyxyConfig:
 
 
 class ConfigParser(LogMixin):
-    def __init__(self) -> None:
+    def __init__(self, path: str = DEFAULT_FILE) -> None:
         super().__init__()
+        self.path = path
 
-        if not os.path.exists("./config.toml"):
+        if not os.path.exists(path):
             self.gen_default()
 
-        config = self.load_file("./config.toml")
+        config = self.load_file(path)
 
         self.check_config(config)
         self.config = config
@@ -91,11 +95,11 @@ class ConfigParser(LogMixin):
         config["server"]["crt_file"] = "填入你的SSL密钥的crt文件的路径"
         config["server"]["key_file"] = "填入你的SSL密钥的key文件的路径"
 
-        with open(DEFAULT_FILE, "wt", encoding="utf-8") as f:
+        with open(self.path, "wt", encoding="utf-8") as f:
             toml.dump(config, f)
 
-        self.logger.warning(f"配置文件生成完成，路径{DEFAULT_FILE}，请查看并修改文件")
-        raise TypeError(f"配置文件生成完成，路径{DEFAULT_FILE}，请查看并修改文件")
+        self.logger.warning(f"配置文件生成完成，路径{self.path}，请查看并修改文件")
+        raise TypeError(f"配置文件生成完成，路径{self.path}，请查看并修改文件")
 
     def check_config(self, config: dict) -> bool:
         """检查config是否满足样例标准
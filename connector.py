@@ -0,0 +1,118 @@
+"""
+Filename: connector.py
+
+向多个候选地址发起连接，参考RFC 8305 (Happy Eyeballs v2)
+"""
+import asyncio
+import socket
+from typing import List, Optional, Set, Tuple
+
+from sockopt import SocketOptions
+
+
+def interleave(addresses: List[str]) -> List[str]:
+    """按地址族交替排列，保持各地址族内部的顺序，首个地址的地址族优先"""
+    if not addresses:
+        return []
+
+    first_v6 = ":" in addresses[0]
+    preferred = [a for a in addresses if (":" in a) == first_v6]
+    other = [a for a in addresses if (":" in a) != first_v6]
+
+    rtn = []
+    for i in range(max(len(preferred), len(other))):
+        if i < len(preferred):
+            rtn.append(preferred[i])
+        if i < len(other):
+            rtn.append(other[i])
+    return rtn
+
+
+def _close_if_connected(task: asyncio.Task) -> None:
+    """被放弃的连接尝试如果已经连上，需要关闭"""
+    if task.cancelled() or task.exception() is not None:
+        return
+    _, writer = task.result()
+    writer.close()
+
+
+async def _connect(
+    address: str, port: int, options: Optional[SocketOptions], **kwds
+) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """连接一个IP地址，有套接字选项时先创建并设置套接字再连接"""
+    if options is None:
+        return await asyncio.open_connection(address, port, **kwds)
+
+    sock = options.socket(socket.AF_INET6 if ":" in address else socket.AF_INET)
+    try:
+        await asyncio.get_running_loop().sock_connect(sock, (address, port))
+    except BaseException:
+        sock.close()
+        raise
+    return await asyncio.open_connection(sock=sock, **kwds)
+
+
+async def open_connection(
+    addresses: List[str],
+    port: int,
+    delay: float = 0.25,
+    limit: int = 65536,
+    options: SocketOptions = None,
+    **kwds,
+) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """依次向多个地址发起连接，返回最先成功的连接
+
+    每次尝试开始后等待delay秒，如果还没有结果就并行开始下一次尝试，
+    某次尝试失败时立即开始下一次尝试。delay为0时只连接第一个地址。
+    limit为StreamReader的缓冲上限，options为连接前设置的套接字选项，
+    其他参数（例如ssl和server_hostname）传给asyncio.open_connection
+
+    Raises:
+        OSError: 所有地址都连接失败
+    """
+    if not addresses:
+        raise socket.gaierror("没有可用的地址")
+    if delay <= 0:
+        return await _connect(addresses[0], port, options, limit=limit, **kwds)
+
+    candidates = iter(interleave(addresses))
+    next_address: Optional[str] = next(candidates)
+    pending: Set[asyncio.Task] = set()
+    errors: List[BaseException] = []
+
+    try:
+        while next_address is not None or pending:
+            timeout = None
+            if next_address is not None:
+                pending.add(
+                    asyncio.ensure_future(
+                        _connect(next_address, port, options, limit=limit, **kwds)
+                    )
+                )
+                next_address = next(candidates, None)
+                if next_address is not None:
+                    timeout = delay
+
+            done, pending = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+
+            winner = None
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                elif winner is None:
+                    winner = task.result()
+                else:
+                    # 同时成功的多余连接
+                    _close_if_connected(task)
+
+            if winner is not None:
+                return winner
+
+    finally:
+        for task in pending:
+            task.cancel()
+            task.add_done_callback(_close_if_connected)
+
+    raise errors[0]
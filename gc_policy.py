@@ -0,0 +1,138 @@
+"""
+Filename: gc_policy.py
+
+垃圾回收策略
+
+启动完成后冻结已有的对象，年轻代的回收仍然由解释器自动完成，
+完整回收（第2代）不再自动触发，而是在内存增长、间隔过久或者低负载时由本模块调度
+"""
+import asyncio
+import gc
+import time
+from typing import Any, Dict, Optional
+
+import psutil
+
+import metrics
+from aisle import SyncLogger
+
+# 第2代的阈值，足够大使解释器不会自动进行完整回收
+FULL_THRESHOLD_OFF = 1 << 30
+
+GC_PAUSE_YOUNG = metrics.REGISTRY.histogram(
+    "pyxy_gc_young_pause_seconds", "第0代和第1代回收的停顿时间", metrics.PAUSE_BUCKETS
+)
+GC_PAUSE_FULL = metrics.REGISTRY.histogram(
+    "pyxy_gc_full_pause_seconds", "完整回收的停顿时间", metrics.PAUSE_BUCKETS
+)
+GC_COLLECTED = metrics.REGISTRY.counter(
+    "pyxy_gc_collected_objects_total", "垃圾回收释放的对象数量"
+)
+GC_FULL = metrics.REGISTRY.counter(
+    "pyxy_gc_full_collections_total", "按触发原因统计的完整回收次数", ("reason",)
+)
+
+
+class GCPolicy:
+    """根据负载和内存调度完整回收
+
+    config: 配置文件中的general部分
+    """
+
+    def __init__(self, config: Dict[str, Any], logger: SyncLogger) -> None:
+        self.logger = logger
+        self.threshold0 = config["gc_threshold0"]
+        self.threshold1 = config["gc_threshold1"]
+        self.check_interval = config["gc_check_interval"]
+        self.full_interval = config["gc_full_interval"]
+        self.rss_growth = config["gc_rss_growth"] * 1024 * 1024
+        self.low_load = config["gc_low_load"]
+        self.low_load_interval = config["gc_low_load_interval"]
+
+        self.process = psutil.Process()
+        self.baseline_rss = 0  # 上次完整回收之后的常驻内存
+        self.last_full = 0.0
+        self._started: Optional[float] = None  # 正在进行的回收的开始时间
+        self._handle: Optional[asyncio.TimerHandle] = None
+
+    def start(self) -> None:
+        """在服务启动完成后调用，冻结启动时创建的对象并开始调度"""
+        gc.enable()
+        gc.collect()
+        if hasattr(gc, "freeze"):
+            # 启动时创建的对象几乎不会被释放，移出回收器可以减少每次完整回收的工作量
+            gc.freeze()
+        gc.set_threshold(self.threshold0, self.threshold1, FULL_THRESHOLD_OFF)
+        if hasattr(gc, "callbacks") and self.__on_gc not in gc.callbacks:
+            gc.callbacks.append(self.__on_gc)
+
+        self.baseline_rss = self.process.memory_info().rss
+        self.last_full = asyncio.get_running_loop().time()
+        if self.check_interval > 0:
+            self._handle = asyncio.get_running_loop().call_later(
+                self.check_interval, self.__check
+            )
+
+    def __on_gc(self, phase: str, info: Dict[str, int]) -> None:
+        """记录每次回收的停顿时间，包括解释器自动进行的回收"""
+        if phase == "start":
+            self._started = time.perf_counter()
+            return
+        if self._started is None:
+            return
+        pause = time.perf_counter() - self._started
+        self._started = None
+        if info["generation"] == 2:
+            GC_PAUSE_FULL.observe(pause)
+        else:
+            GC_PAUSE_YOUNG.observe(pause)
+        GC_COLLECTED.inc(info["collected"])
+
+    def __check(self) -> None:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        since = now - self.last_full
+        rss = self.process.memory_info().rss
+
+        reason = None
+        if self.full_interval > 0 and since >= self.full_interval:
+            reason = "interval"
+        elif self.rss_growth > 0 and rss - self.baseline_rss >= self.rss_growth:
+            reason = "rss"
+        elif (
+            metrics.CONNECTIONS_ACTIVE.value <= self.low_load
+            and since >= self.low_load_interval
+            and gc.get_count()[2] > 0  # 上次完整回收之后有对象进入了第2代
+        ):
+            reason = "low_load"
+
+        if reason is not None:
+            self.collect(reason)
+
+        self._handle = loop.call_later(self.check_interval, self.__check)
+
+    def collect(self, reason: str) -> None:
+        """进行一次完整回收"""
+        start = time.perf_counter()
+        collected = gc.collect()
+        pause = time.perf_counter() - start
+
+        self.baseline_rss = self.process.memory_info().rss
+        self.last_full = asyncio.get_running_loop().time()
+        GC_FULL.labels(reason).inc()
+        self.logger.debug(
+            f"完整回收({reason})释放{collected}个对象，停顿{pause * 1000:.1f}ms，"
+            f"当前内存{self.baseline_rss / 1024 / 1024:.1f}MB"
+        )
+
+
+_installed: Optional[GCPolicy] = None
+
+
+def install(policy: GCPolicy) -> GCPolicy:
+    """在当前进程中启动垃圾回收策略，一个进程只会启动一个，返回正在运行的策略"""
+    global _installed
+    if _installed is None:
+        _installed = policy
+        policy.start()
+    return _installed
@@ -0,0 +1,382 @@
+"""
+Filename: metrics.py
+
+运行指标，以Prometheus文本格式通过本地HTTP端口输出
+
+指标的更新只是整数和浮点数的加法，可以放在转发的热路径上
+"""
+import asyncio
+import gc
+import json
+import os
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+import psutil
+
+from aisle import SyncLogger
+
+# 延迟直方图的分桶上界，单位秒
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# 垃圾回收停顿的分桶上界，单位秒
+PAUSE_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+
+Samples = Iterable[Tuple[Dict[str, str], float]]
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    """整数值不带小数点输出，避免大的计数器丢失精度"""
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class Value:
+    """一个时间序列的值"""
+
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Metric:
+    """带有可选标签的计数器或仪表"""
+
+    def __init__(
+        self, name: str, documentation: str, kind: str, labelnames: Tuple[str, ...] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = labelnames
+        self.children: Dict[Tuple[str, ...], Value] = {}
+        if not labelnames:
+            self.children[()] = Value()
+
+    @property
+    def value(self) -> float:
+        """没有标签的指标的当前值"""
+        return self.children[()].value
+
+    def labels(self, *values: str) -> Value:
+        """返回标签对应的时间序列，热路径上应该提前取得并保存"""
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = Value()
+        return child
+
+    def inc(self, amount: float = 1) -> None:
+        self.children[()].value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.children[()].value -= amount
+
+    def set(self, value: float) -> None:
+        self.children[()].value = value
+
+    def samples(self) -> Samples:
+        for values, child in self.children.items():
+            yield dict(zip(self.labelnames, values)), child.value
+
+    def render(self, lines: List[str]) -> None:
+        lines.append(f"# HELP {self.name} {self.documentation}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+        for labels, value in self.samples():
+            lines.append(f"{self.name}{_format_labels(labels)} {_format_value(value)}")
+
+
+class CallbackMetric(Metric):
+    """在输出时调用callback取值的指标，用于已有的统计属性
+
+    callback返回一个数值，或者(标签, 数值)的序列
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        kind: str,
+        callback: Callable[[], Union[float, Samples]],
+    ) -> None:
+        super().__init__(name, documentation, kind)
+        self.callback = callback
+
+    def samples(self) -> Samples:
+        value = self.callback()
+        if isinstance(value, (int, float)):
+            return [({}, value)]
+        return value
+
+
+class Histogram:
+    """固定分桶的直方图，observe只做一次二分查找和两次加法"""
+
+    __slots__ = ("name", "documentation", "bounds", "counts", "sum")
+
+    def __init__(
+        self, name: str, documentation: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.bounds = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个为+Inf
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def render(self, lines: List[str]) -> None:
+        lines.append(f"# HELP {self.name} {self.documentation}")
+        lines.append(f"# TYPE {self.name} histogram")
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            lines.append(f'{self.name}_bucket{{le="{bound:g}"}} {total}')
+        total += self.counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {total}')
+        lines.append(f"{self.name}_sum {_format_value(self.sum)}")
+        lines.append(f"{self.name}_count {total}")
+
+
+class Registry:
+    """进程内所有指标的集合"""
+
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Union[Metric, Histogram]] = {}
+
+    def counter(
+        self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()
+    ) -> Metric:
+        return self.__add(Metric(name, documentation, "counter", labelnames))
+
+    def gauge(
+        self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()
+    ) -> Metric:
+        return self.__add(Metric(name, documentation, "gauge", labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self.__add(Histogram(name, documentation, buckets))
+
+    def callback(
+        self,
+        name: str,
+        documentation: str,
+        callback: Callable[[], Union[float, Samples]],
+        kind: str = "gauge",
+    ) -> CallbackMetric:
+        """注册在输出时取值的指标，同名的指标会被替换"""
+        return self.__add(CallbackMetric(name, documentation, kind, callback))
+
+    def __add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics.values():
+            metric.render(lines)
+        lines.append("")
+        return "\n".join(lines)
+
+
+REGISTRY = Registry()
+
+# 连接
+CONNECTIONS_ACCEPTED = REGISTRY.counter(
+    "pyxy_connections_accepted_total", "接受的连接总数"
+)
+CONNECTIONS_FAILED = REGISTRY.counter(
+    "pyxy_connections_failed_total", "按失败原因统计的连接数", ("reason",)
+)
+CONNECTIONS_ACTIVE = REGISTRY.gauge("pyxy_connections_active", "正在处理的连接数")
+
+# 转发的字节数，upload为本地到远程，download为远程到本地
+RELAY_BYTES = REGISTRY.counter(
+    "pyxy_relay_bytes_total", "按方向统计的转发字节数", ("direction",)
+)
+RELAY_UPLOAD = RELAY_BYTES.labels("upload")
+RELAY_DOWNLOAD = RELAY_BYTES.labels("download")
+
+# UDP关联，upload为发往目标，download为目标发回
+UDP_DATAGRAMS = REGISTRY.counter(
+    "pyxy_udp_datagrams_total", "按方向统计的UDP数据报数", ("direction",)
+)
+UDP_UPLOAD = UDP_DATAGRAMS.labels("upload")
+UDP_DOWNLOAD = UDP_DATAGRAMS.labels("download")
+UDP_BATCHES = REGISTRY.counter("pyxy_udp_batches_total", "数据报合并后写入隧道的次数")
+UDP_DROPPED = REGISTRY.counter(
+    "pyxy_udp_dropped_total", "按原因统计的丢弃的UDP数据报数", ("reason",)
+)
+UDP_ASSOCIATIONS = REGISTRY.gauge("pyxy_udp_associations", "正在转发的UDP关联数")
+
+# 延迟
+SOCKS_NEGOTIATION = REGISTRY.histogram(
+    "pyxy_socks_negotiation_seconds", "Socks5协商的耗时，从连接建立到读取完请求"
+)
+TLS_CONNECT = REGISTRY.histogram(
+    "pyxy_tls_connect_seconds", "客户端到服务器的TCP连接和TLS握手的耗时"
+)
+BLOCK_HANDSHAKE = REGISTRY.histogram(
+    "pyxy_block_handshake_seconds", "客户端发出预协商区块到收到响应的耗时，包括服务端连接目标"
+)
+TARGET_CONNECT = REGISTRY.histogram(
+    "pyxy_target_connect_seconds", "服务端解析目标域名并建立连接的耗时"
+)
+
+# 每次输出时取得当前进程，fork出的子进程也能得到正确的值
+REGISTRY.callback(
+    "pyxy_process_resident_memory_bytes",
+    "进程的常驻内存",
+    lambda: psutil.Process().memory_info().rss,
+)
+REGISTRY.callback(
+    "pyxy_process_cpu_seconds_total",
+    "进程消耗的CPU时间",
+    lambda: sum(psutil.Process().cpu_times()[:2]),
+    kind="counter",
+)
+REGISTRY.callback(
+    "pyxy_gc_objects",
+    "垃圾回收器跟踪的各代对象数量",
+    lambda: [({"generation": str(i)}, n) for i, n in enumerate(gc.get_count())],
+)
+
+
+STATUS_FD_ENV = "PYXY_STATUS_FD"  # supervisor传给worker的状态管道
+WORKER_ENV = "PYXY_WORKER"  # supervisor传给worker的序号
+
+
+def is_worker() -> bool:
+    """是否由supervisor启动"""
+    return WORKER_ENV in os.environ
+
+
+def worker_index() -> int:
+    """由supervisor启动的worker的序号，单进程运行时为0"""
+    return int(os.environ.get(WORKER_ENV, 0))
+
+
+def report_status(interval: float = 5) -> None:
+    """由supervisor启动的worker定期通过管道报告连接数，第一次报告表示已经开始服务"""
+    fd = os.environ.get(STATUS_FD_ENV)
+    if not fd:
+        return
+    fd = int(fd)
+    os.set_blocking(fd, False)
+    loop = asyncio.get_running_loop()
+
+    def report() -> None:
+        line = json.dumps(
+            {
+                "active": CONNECTIONS_ACTIVE.value,
+                "accepted": CONNECTIONS_ACCEPTED.value,
+            }
+        )
+        try:
+            os.write(fd, line.encode("utf-8") + b"\n")
+        except BlockingIOError:
+            pass  # supervisor暂时没有读取，丢弃本次报告
+        except OSError:
+            return  # supervisor已经退出
+        loop.call_later(interval, report)
+
+    report()
+
+
+def elapsed(start: float) -> float:
+    """从start到现在的秒数，start由time.perf_counter取得"""
+    return time.perf_counter() - start
+
+
+async def serve(
+    address: str, port: int, logger: SyncLogger
+) -> Optional[asyncio.AbstractServer]:
+    """在本地端口输出指标，port为0时不启动
+
+    由supervisor启动的worker使用port加上worker序号的端口
+    """
+    if not port:
+        return None
+    port += worker_index()
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[1] == b"/metrics":
+                status, body = "200 OK", REGISTRY.render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"not found\n"
+
+            writer.write(
+                f"HTTP/1.0 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode("ascii")
+                + body
+            )
+            await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    # 替换worker时新旧进程会短暂地同时运行
+    server = await asyncio.start_server(handle, address, port, reuse_port=True)
+    logger.warning(f"指标输出于 http://{address}:{port}/metrics")
+    return server
@@ -1,22 +1,347 @@
+"""
+Filename: multi_server.py
+
+多进程运行服务端或客户端
+
+python3 multi_server.py [server|client]
+
+每个CPU核心运行一个worker进程，所有worker通过SO_REUSEPORT监听同一个端口，由内核分配连接。
+worker异常退出后按指数退避重启；常驻内存超过上限的worker会先启动替代进程，
+替代进程开始服务后才让旧进程停止接受连接并等待已有连接结束，重启过程中始终保持服务能力。
+收到SIGHUP时逐个替换所有worker，可以用于更新代码
+"""
+from __future__ import annotations
 import asyncio
+import json
+import os
+import signal
 import sys
+from typing import Any, Dict, List, Optional, Set
+
+import psutil
+
+import metrics
+import xylog
+from config_parse import PyxyConfig
+from tls import TICKET_SECRET_ENV, TICKET_SECRET_SIZE
+
+ROLES = {"server": "server.py", "client": "proxy_broker.py"}
+
+READY_TIMEOUT = 30  # 等待新的worker开始服务的最长秒数
+BACKOFF_MIN = 1  # 重启等待的初始秒数，连续崩溃时翻倍
+KILL_GRACE = 5  # 超过drain_timeout之后仍未退出的worker再等待的秒数，之后强制结束
+
+
+class Worker:
+    """一个worker进程和它报告的状态"""
+
+    __slots__ = (
+        "index",
+        "cpu",
+        "process",
+        "started",
+        "status",
+        "ready",
+        "restart",
+        "replaced",
+        "reason",
+    )
+
+    def __init__(
+        self, index: int, cpu: Optional[int], process: asyncio.subprocess.Process
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        self.index = index
+        self.cpu = cpu
+        self.process = process
+        self.started = loop.time()
+        self.status: Dict[str, Any] = {}  # worker最近一次报告的状态
+        self.ready = loop.create_future()  # 收到第一次报告时完成
+        self.restart = asyncio.Event()  # 设置后由所在的槽启动替代进程
+        self.replaced = loop.create_future()  # 替换结束后完成，结果为是否已经被替换
+        self.reason = ""  # 替换的原因
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    def replace(self, reason: str) -> None:
+        if not self.restart.is_set():
+            self.reason = reason
+            self.restart.set()
+
+    def finish(self, replaced: bool) -> None:
+        if not self.replaced.done():
+            self.replaced.set_result(replaced)
+
+
+class Supervisor:
+    """启动并监视多个worker进程
+
+    config: 配置文件
+    role: server或client
+    workers: worker数量，为None时使用general.workers，为0时使用可用的CPU核心数
+    """
+
+    def __init__(
+        self, config: PyxyConfig, role: str = "server", workers: Optional[int] = None
+    ) -> None:
+        general = config.general
+        xylog.configure(general)
+        self.logger = xylog.get_logger(self.__class__.__name__).get_child(role)
+
+        self.role = role
+        self.script = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), ROLES[role]
+        )
+        self.cpus = self.__available_cpus()
+        if workers is None:
+            workers = general["workers"]
+        self.size = workers or len(self.cpus)
+        self.cpu_affinity = general["worker_cpu_affinity"] and hasattr(
+            os, "sched_setaffinity"
+        )
+        self.max_rss = general["worker_max_rss"] * 1024 * 1024
+        self.backoff_max = max(general["worker_backoff_max"], BACKOFF_MIN)
+        self.report_interval = general["worker_report_interval"]
+        self.drain_timeout = general["drain_timeout"]
+
+        # 服务端worker共享的会话票据密钥种子，只存在于本机的进程中，替换worker时保持不变
+        self.ticket_secret = os.urandom(TICKET_SECRET_SIZE).hex()
 
+        self.slots: List[Optional[Worker]] = [None] * self.size
+        self.restarts = [0] * self.size  # 每个槽的重启次数
+        self.stopping: Optional[asyncio.Event] = None
+        self.tasks: Set[asyncio.Task] = set()  # 事件循环只保存任务的弱引用
 
-class MultiServer:
-    def __init__(self, max_size: int = 4):
-        self.max_size = max_size
+    @staticmethod
+    def __available_cpus() -> List[int]:
+        if hasattr(os, "sched_getaffinity"):
+            return sorted(os.sched_getaffinity(0))
+        return list(range(os.cpu_count() or 1))
 
-    def run_until_complete(self):
-        loop = asyncio.get_event_loop()
-        for i in range(self.max_size):
-            loop.create_task(self.start_process())
-        loop.run_forever()
+    async def run(self) -> None:
+        """启动所有的worker，直到收到SIGINT或SIGTERM"""
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stopping.set)
+        loop.add_signal_handler(signal.SIGHUP, self.rolling_restart)
 
-    async def start_process(self):
-        p = await asyncio.create_subprocess_exec("python3", "server.py", stdout=sys.stdout, stderr=sys.stderr)
-        await p.wait()
+        self.logger.warning(
+            f"启动{self.size}个worker，"
+            f"CPU绑定{'开启' if self.cpu_affinity else '关闭'}，{self.script}"
+        )
+        slots = [
+            asyncio.create_task(self.__run_slot(index)) for index in range(self.size)
+        ]
+        monitor = asyncio.create_task(self.__monitor())
+
+        await self.stopping.wait()
+        self.logger.warning("正在停止所有worker")
+        monitor.cancel()
+        await asyncio.gather(*slots, return_exceptions=True)
+        await asyncio.gather(
+            *(self.__stop(worker) for worker in self.slots if worker is not None)
+        )
+
+    def rolling_restart(self) -> None:
+        """逐个替换所有的worker，每次只替换一个"""
+        self.__background(self.__rolling_restart())
+
+    def __background(self, coro) -> None:
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def __rolling_restart(self) -> None:
+        self.logger.warning("开始逐个替换worker")
+        for worker in list(self.slots):
+            if worker is None or self.stopping.is_set():
+                continue
+            worker.replace("rolling")
+            if not await worker.replaced:
+                self.logger.error("替换失败，停止逐个替换")
+                return
+        self.logger.warning("所有worker替换完成")
+
+    async def __spawn(self, index: int) -> Worker:
+        """启动一个worker，通过管道接收它的状态报告"""
+        loop = asyncio.get_running_loop()
+        read_fd, write_fd = os.pipe()
+        env = dict(os.environ)
+        env[metrics.STATUS_FD_ENV] = str(write_fd)
+        env[metrics.WORKER_ENV] = str(index)
+        if self.role == "server":
+            env[TICKET_SECRET_ENV] = self.ticket_secret
+        try:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable,
+                self.script,
+                env=env,
+                pass_fds=(write_fd,),
+                start_new_session=True,  # 终端的Ctrl-C只发给supervisor，由它通知worker
+            )
+        finally:
+            os.close(write_fd)
+
+        cpu = None
+        if self.cpu_affinity:
+            cpu = self.cpus[index % len(self.cpus)]
+            try:
+                os.sched_setaffinity(process.pid, {cpu})
+            except OSError as error:
+                self.logger.warning(f"worker {process.pid} 绑定CPU{cpu}失败 > {error}")
+                cpu = None
+
+        worker = Worker(index, cpu, process)
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(read_fd, "rb", 0)
+        )
+        self.__background(self.__read_status(worker, reader))
+        return worker
+
+    async def __read_status(self, worker: Worker, reader: asyncio.StreamReader) -> None:
+        while 1:
+            line = await reader.readline()
+            if not line:
+                break  # worker已经退出
+            try:
+                worker.status = json.loads(line)
+            except ValueError:
+                continue
+            if not worker.ready.done():
+                worker.ready.set_result(None)
+
+    async def __run_slot(self, index: int) -> None:
+        """保持一个槽中始终有一个正在服务的worker"""
+        loop = asyncio.get_running_loop()
+        failures = 0  # 连续崩溃的次数
+        worker = self.slots[index] = await self.__spawn(index)
+
+        while not self.stopping.is_set():
+            exited = asyncio.ensure_future(worker.process.wait())
+            restart = asyncio.ensure_future(worker.restart.wait())
+            stopping = asyncio.ensure_future(self.stopping.wait())
+            await asyncio.wait(
+                (exited, restart, stopping), return_when=asyncio.FIRST_COMPLETED
+            )
+            restart.cancel()
+            stopping.cancel()
+            if self.stopping.is_set():
+                exited.cancel()
+                return
+
+            if exited.done():
+                # 异常退出，运行超过backoff_max秒视为已经稳定，重新计算退避时间
+                worker.finish(True)
+                if loop.time() - worker.started >= self.backoff_max:
+                    failures = 0
+                delay = min(BACKOFF_MIN * 2**failures, self.backoff_max)
+                failures += 1
+                self.restarts[index] += 1
+                self.logger.error(
+                    f"worker {worker.pid} 退出，返回值{exited.result()}，{delay}秒后重启"
+                )
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), delay)
+                    return
+                except asyncio.TimeoutError:
+                    pass
+                worker = self.slots[index] = await self.__spawn(index)
+                continue
+
+            # 先启动替代进程，开始服务后再停止旧的进程
+            exited.cancel()
+            replacement = await self.__spawn(index)
+            if not await self.__wait_ready(replacement):
+                self.logger.error(
+                    f"替代worker {replacement.pid} 未能开始服务，"
+                    f"保留原来的worker {worker.pid}"
+                )
+                await self.__stop(replacement)
+                worker.finish(False)
+                worker.replaced = loop.create_future()
+                worker.restart.clear()
+                continue
+
+            self.logger.warning(
+                f"worker {worker.pid} ({worker.reason}) 已被 {replacement.pid} 替换"
+            )
+            self.restarts[index] += 1
+            old, worker = worker, replacement
+            self.slots[index] = worker
+            old.finish(True)
+            self.__background(self.__stop(old))
+
+    async def __wait_ready(self, worker: Worker) -> bool:
+        """等待worker开始服务，worker退出、超时或者正在停止时返回False"""
+        exited = asyncio.ensure_future(worker.process.wait())
+        stopping = asyncio.ensure_future(self.stopping.wait())
+        await asyncio.wait(
+            (worker.ready, exited, stopping),
+            timeout=READY_TIMEOUT,
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        exited.cancel()
+        stopping.cancel()
+        return worker.ready.done() and worker.process.returncode is None
+
+    async def __stop(self, worker: Worker) -> None:
+        """通知worker停止接受连接并等待已有连接结束，超时后强制结束"""
+        if worker.process.returncode is None:
+            try:
+                worker.process.terminate()
+                await asyncio.wait_for(
+                    worker.process.wait(), self.drain_timeout + KILL_GRACE
+                )
+            except ProcessLookupError:
+                pass
+            except asyncio.TimeoutError:
+                self.logger.warning(f"worker {worker.pid} 未能按时退出，强制结束")
+                worker.process.kill()
+                await worker.process.wait()
+        worker.finish(False)
+
+    async def __monitor(self) -> None:
+        """定期检查每个worker的内存并输出状态"""
+        last_report = asyncio.get_running_loop().time()
+        while 1:
+            await asyncio.sleep(min(self.report_interval or 5, 5))
+            now = asyncio.get_running_loop().time()
+            report = self.report_interval > 0 and now - last_report >= self.report_interval
+            if report:
+                last_report = now
+
+            for worker in self.slots:
+                if worker is None or worker.process.returncode is not None:
+                    continue
+                try:
+                    rss = psutil.Process(worker.pid).memory_info().rss
+                except psutil.Error:
+                    continue
+
+                if self.max_rss > 0 and rss > self.max_rss:
+                    self.logger.warning(
+                        f"worker {worker.pid} 内存{rss / 1024 / 1024:.1f}MB超过上限"
+                    )
+                    worker.replace("rss")
+
+                if report:
+                    self.logger.info(
+                        f"worker[{worker.index}] pid={worker.pid} cpu={worker.cpu} "
+                        f"active={worker.status.get('active', 0):.0f} "
+                        f"accepted={worker.status.get('accepted', 0):.0f} "
+                        f"rss={rss / 1024 / 1024:.1f}MB "
+                        f"restarts={self.restarts[worker.index]}"
+                    )
 
 
 if __name__ == "__main__":
-    server = MultiServer()
-    server.run_until_complete()
+    role = sys.argv[1] if len(sys.argv) > 1 else "server"
+    if role not in ROLES:
+        sys.exit(f"usage: python3 multi_server.py [{'|'.join(ROLES)}]")
+
+    config = PyxyConfig()
+    asyncio.run(Supervisor(config, role).run())
@@ -0,0 +1,384 @@
+"""
+Filename: mux.py
+
+多路复用隧道，在少量长期保持的TLS连接上承载多个逻辑流
+
+帧格式: 类型(1字节) | 流ID(4字节) | 负载长度(2字节) | 负载
+"""
+from __future__ import annotations
+import asyncio
+import json
+from struct import Struct, error as StructError
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from aisle import SyncLogger
+
+MUX_VERSION = 1
+
+FRAME_HEADER = Struct("!BIH")
+WINDOW_UPDATE = Struct("!I")
+
+FRAME_OPEN = 1  # 客户端请求打开新流，负载为JSON格式的目标地址
+FRAME_REPLY = 2  # 服务端响应打开结果，负载为JSON格式的绑定地址
+FRAME_DATA = 3  # 数据
+FRAME_CLOSE = 4  # 关闭流（双向）
+FRAME_WINDOW = 5  # 流控窗口增量
+
+MAX_FRAME_SIZE = 16384  # 单个数据帧的最大负载
+INITIAL_WINDOW = 262144  # 每个流的初始发送窗口
+
+
+def _load_json(payload: bytes) -> dict:
+    """解析打开请求和响应的负载
+
+    Raises:
+        ValueError: 不是JSON格式的字典
+    """
+    rtn = json.loads(payload.decode("utf-8"))
+    if not isinstance(rtn, dict):
+        raise ValueError("负载不是字典")
+    return rtn
+
+
+class MuxError(Exception):
+    """多路复用协议错误"""
+
+    def __init__(self, msg: str = None):
+        super().__init__(msg)
+        self.message = msg
+
+    def __str__(self) -> str:
+        return f"MuxError: {self.message}"
+
+
+class MuxStream:
+    """多路复用隧道中的一个逻辑流
+
+    同时提供StreamReader和StreamWriter的常用接口，可直接交给StreamBase.exchange_stream
+    """
+
+    __slots__ = (
+        "session",
+        "stream_id",
+        "_buffer",
+        "_eof",
+        "_closed",
+        "_read_waiter",
+        "_reply",
+        "_pending",
+        "_send_window",
+        "_window_waiter",
+        "_consumed",
+    )
+
+    def __init__(self, session: MuxSession, stream_id: int) -> None:
+        self.session = session
+        self.stream_id = stream_id
+        self._buffer = bytearray()
+        self._eof = False
+        self._closed = False
+        self._read_waiter: Optional[asyncio.Future] = None
+        self._reply: Optional[asyncio.Future] = None
+        self._pending = bytearray()
+        self._send_window = INITIAL_WINDOW
+        self._window_waiter: Optional[asyncio.Future] = None
+        self._consumed = 0
+
+    # 读取接口
+
+    async def read(self, n: int = -1) -> bytes:
+        """读取至多n字节，流结束时返回空字节串"""
+        while not self._buffer and not self._eof:
+            self._read_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._read_waiter
+            finally:
+                self._read_waiter = None
+
+        if n < 0 or n >= len(self._buffer):
+            data = bytes(self._buffer)
+            self._buffer.clear()
+        else:
+            data = bytes(self._buffer[:n])
+            del self._buffer[:n]
+
+        # 数据被消费后归还窗口
+        self._consumed += len(data)
+        if self._consumed >= INITIAL_WINDOW // 2 and not self._closed:
+            self.session.send_frame(
+                FRAME_WINDOW, self.stream_id, WINDOW_UPDATE.pack(self._consumed)
+            )
+            self._consumed = 0
+
+        return data
+
+    def at_eof(self) -> bool:
+        return self._eof and not self._buffer
+
+    # 写入接口
+
+    def write(self, data: bytes) -> None:
+        if self._closed:
+            return
+        self._pending += data
+
+    async def drain(self) -> None:
+        """按照对端的窗口发送缓存的数据"""
+        while self._pending:
+            if self._closed:
+                raise ConnectionResetError("多路复用流已关闭")
+
+            if self._send_window <= 0:
+                self._window_waiter = asyncio.get_running_loop().create_future()
+                try:
+                    await self._window_waiter
+                finally:
+                    self._window_waiter = None
+                continue
+
+            size = min(len(self._pending), self._send_window, MAX_FRAME_SIZE)
+            self.session.send_frame(
+                FRAME_DATA, self.stream_id, bytes(self._pending[:size])
+            )
+            del self._pending[:size]
+            self._send_window -= size
+
+        await self.session.drain()
+
+    def is_closing(self) -> bool:
+        return self._closed
+
+    def close(self) -> None:
+        """关闭流，通知对端"""
+        if self._closed:
+            return
+        self.session.send_frame(FRAME_CLOSE, self.stream_id)
+        self._on_close()
+
+    async def wait_closed(self) -> None:
+        return
+
+    def get_extra_info(self, name: str, default: Any = None) -> Any:
+        return self.session.writer.get_extra_info(name, default)
+
+    # 打开流的响应
+
+    def reply(self, bind_address: str, bind_port: int) -> None:
+        """服务端回复目标连接的绑定地址"""
+        self.session.send_frame(
+            FRAME_REPLY,
+            self.stream_id,
+            json.dumps(
+                {"bind_address": bind_address, "bind_port": bind_port}
+            ).encode("utf-8"),
+        )
+
+    async def wait_reply(self) -> Tuple[str, int]:
+        """客户端等待服务端的打开结果"""
+        response = await self._reply
+        return response["bind_address"], response["bind_port"]
+
+    # 由MuxSession调用
+
+    def _on_data(self, data: bytes) -> None:
+        self._buffer += data
+        if len(self._buffer) > INITIAL_WINDOW:
+            # 对端没有遵守流控窗口
+            self.session.logger.warning(f"流{self.stream_id}超出窗口，关闭")
+            self.close()
+            return
+        self._wakeup(self._read_waiter)
+
+    def _on_window(self, increment: int) -> None:
+        self._send_window += increment
+        self._wakeup(self._window_waiter)
+
+    def _on_reply(self, response: dict) -> None:
+        if self._reply is not None and not self._reply.done():
+            self._reply.set_result(response)
+
+    def _on_close(self) -> None:
+        """流被任一方关闭"""
+        self._closed = True
+        self._eof = True
+        self._pending.clear()
+        self._wakeup(self._read_waiter)
+        self._wakeup(self._window_waiter)
+        if self._reply is not None and not self._reply.done():
+            self._reply.set_exception(ConnectionResetError("多路复用流在打开前关闭"))
+        self.session.streams.pop(self.stream_id, None)
+
+    @staticmethod
+    def _wakeup(waiter: Optional[asyncio.Future]) -> None:
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+
+class MuxSession:
+    """一条承载多个逻辑流的底层连接
+
+    reader, writer: 已经完成预协商的底层连接
+    on_open: 服务端使用，收到打开请求时以(stream, payload)为参数调用的协程
+    """
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        logger: SyncLogger,
+        on_open: Callable[[MuxStream, dict], Awaitable[Any]] = None,
+    ) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.logger = logger
+        self.streams: Dict[int, MuxStream] = {}
+        self.closed = False
+        self._on_open = on_open
+        self._next_id = 1
+        self._drain_lock = asyncio.Lock()
+        self._tasks: Set[asyncio.Task] = set()  # 保持对流处理任务的引用
+
+    def send_frame(self, frame_type: int, stream_id: int, payload: bytes = b"") -> None:
+        if self.closed:
+            return
+        self.writer.write(FRAME_HEADER.pack(frame_type, stream_id, len(payload)))
+        if payload:
+            self.writer.write(payload)
+
+    async def drain(self) -> None:
+        """多个流共享同一个底层连接，需要串行等待"""
+        async with self._drain_lock:
+            await self.writer.drain()
+
+    async def open_stream(self, payload: dict) -> MuxStream:
+        """客户端打开新的逻辑流，不等待服务端的响应"""
+        if self.closed:
+            raise ConnectionResetError("多路复用连接已关闭")
+
+        stream_id = self._next_id
+        self._next_id += 2
+        stream = MuxStream(self, stream_id)
+        stream._reply = asyncio.get_running_loop().create_future()
+        self.streams[stream_id] = stream
+        self.send_frame(FRAME_OPEN, stream_id, json.dumps(payload).encode("utf-8"))
+        await self.drain()
+        return stream
+
+    async def run(self) -> None:
+        """循环读取帧并分发到各个流，直到底层连接断开"""
+        try:
+            while 1:
+                header = await self.reader.readexactly(FRAME_HEADER.size)
+                frame_type, stream_id, length = FRAME_HEADER.unpack(header)
+                payload = await self.reader.readexactly(length) if length else b""
+                self.__dispatch(frame_type, stream_id, payload)
+
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            self.logger.debug("多路复用连接断开")
+
+        except MuxError as error:
+            self.logger.warning(f"多路复用协议错误 > {error}")
+
+        finally:
+            self.closed = True
+            for stream in list(self.streams.values()):
+                stream._on_close()
+
+    def __dispatch(self, frame_type: int, stream_id: int, payload: bytes) -> None:
+        """分发一帧，负载格式错误时抛出MuxError，由run关闭连接和所有的流"""
+        try:
+            self.__handle(frame_type, stream_id, payload)
+        except (ValueError, StructError) as error:
+            raise MuxError(f"帧{frame_type}的负载错误 {error}")
+
+    def __handle(self, frame_type: int, stream_id: int, payload: bytes) -> None:
+        if frame_type == FRAME_OPEN:
+            if self._on_open is None or stream_id in self.streams:
+                raise MuxError(f"无效的打开请求{stream_id}")
+            stream = MuxStream(self, stream_id)
+            self.streams[stream_id] = stream
+            task = asyncio.ensure_future(self._on_open(stream, _load_json(payload)))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            return
+
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            # 流已经关闭，丢弃迟到的帧
+            return
+
+        if frame_type == FRAME_DATA:
+            stream._on_data(payload)
+        elif frame_type == FRAME_WINDOW:
+            stream._on_window(WINDOW_UPDATE.unpack(payload)[0])
+        elif frame_type == FRAME_REPLY:
+            stream._on_reply(_load_json(payload))
+        elif frame_type == FRAME_CLOSE:
+            stream._on_close()
+        else:
+            raise MuxError(f"未知的帧类型{frame_type}")
+
+
+class MuxPool:
+    """客户端持有的多路复用连接池
+
+    connect: 建立一条完成多路复用预协商的底层连接的协程函数
+    size: 最多同时保持的底层连接数量
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], Awaitable[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]],
+        logger: SyncLogger,
+        size: int = 2,
+    ) -> None:
+        self.connect = connect
+        self.logger = logger
+        self.size = max(size, 1)
+        self.sessions: List[MuxSession] = []
+        self._connecting: Optional[asyncio.Future] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def open_stream(self, payload: dict) -> MuxStream:
+        """在负载最小的底层连接上打开逻辑流"""
+        session = await self.__pick_session()
+        return await session.open_stream(payload)
+
+    async def __pick_session(self) -> MuxSession:
+        alive = [s for s in self.sessions if not s.closed]
+        self.sessions = alive
+
+        if len(alive) < self.size:
+            if self._connecting is None:
+                self._connecting = asyncio.ensure_future(self.__new_session())
+                self._connecting.add_done_callback(self.__connect_done)
+            if not alive:
+                # 没有可用的连接，只能等待
+                return await asyncio.shield(self._connecting)
+
+        return min(alive, key=lambda s: len(s.streams))
+
+    async def __new_session(self) -> MuxSession:
+        try:
+            reader, writer = await self.connect()
+            session = MuxSession(reader, writer, self.logger)
+            self.sessions.append(session)
+            task = asyncio.ensure_future(self.__run_session(session))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            self.logger.info(f"新建多路复用连接，当前连接数{len(self.sessions)}")
+            return session
+        finally:
+            self._connecting = None
+
+    def __connect_done(self, future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception():
+            self.logger.warning(f"多路复用连接建立失败 > {future.exception()}")
+
+    async def __run_session(self, session: MuxSession) -> None:
+        await session.run()
+        try:
+            session.writer.close()
+            await session.writer.wait_closed()
+        except Exception:
+            pass
@@ -1,24 +1,40 @@
 import socket
-from struct import pack, unpack
+import time
+from struct import pack
 import asyncio
-from aisle import LogMixin
-from client import Client, RemoteClientError
+from typing import Tuple
+from aisle import LogMixin, SyncLogger
+from client import ConnectionPool, RemoteClientError, RemoteSession
+from mux import MuxPool
+from udp import ClientAssociation, UDP_VERSION
+import metrics
+import xylog
+from xylog import DEBUG, INFO, WARNING
+from gc_policy import GCPolicy, install as install_gc_policy
+from tls import ResumableContext
 from xybase import StreamBase
 from config_parse import PyxyConfig
+from multi_server import Supervisor
+from socks5 import SOCKS_VERSION, SocksError, SocksParser
+from sockopt import SocketOptions
+from timer import Deadline
 
 # from memory_profiler import profile
-SOCKS_VERSION = 5
 
 
-class SocksError(Exception):
-    """Sock协议错误"""
-
-    def __init__(self, msg: str = None):
-        super().__init__(msg)
-        self.message = msg
-
-    def __str__(self) -> str:
-        return f"SocksError: {self.message}"
+def socks_reply(bind_address: str, bind_port: int, status: int = 0) -> bytes:
+    """生成Socks5的响应，地址类型由绑定地址决定"""
+    try:
+        address_bytes = socket.inet_pton(socket.AF_INET, bind_address)
+        address_type = 1
+    except OSError:
+        address_bytes = socket.inet_pton(socket.AF_INET6, bind_address)
+        address_type = 4
+    return (
+        pack("!BBBB", SOCKS_VERSION, status, 0, address_type)
+        + address_bytes
+        + pack("!H", bind_port)
+    )
 
 
 class SockRelay(StreamBase, LogMixin):
@@ -35,17 +51,102 @@ class SockRelay(StreamBase, LogMixin):
         self.key_string = config_all.general["key"]
 
         super().__init__(self.key_string, name=name)
+        xylog.configure(config_all.general)
 
         self.config = config_all.client
+        self.configure_relay(config_all.general)
 
         self.username = self.config["username"]
         self.password = self.config["password"]
+        self.username_bytes = self.username.encode("utf-8")
+        self.password_bytes = self.password.encode("utf-8")
         self.sock_proxy_addr = self.config["socks5_address"]
         self.sock_proxy_port = self.config["socks5_port"]
         self.remote_addr = remote_addr
         self.remote_port = remote_port
+        self.block_version = config_all.general["block_version"]
+        self.optimistic = self.config["optimistic"]
+        self.optimistic_wait = self.config["optimistic_wait"]
+
+        # 所有远程连接共享的安全环境，用于恢复TLS会话
+        self.ssl_context = ResumableContext(
+            cache_size=self.config["tls_session_cache"],
+            ca_file=self.config["ca_file"],
+        )
+
+        # Socks连接和远程连接的套接字选项，远程连接可以使用TCP Fast Open
+        self.socket_options = SocketOptions(self.config, fastopen_connect=True)
+        for warning in self.socket_options.warnings:
+            self.logger.warning(warning)
+
+        # 预先握手的远程连接池，多路复用模式下不会单独建立远程连接，不需要连接池
+        self.pool = None
+        if self.config["pool_size"] > 0 and not self.config["mux"]:
+            if 0 < self.block_wait_timeout <= self.config["pool_max_age"]:
+                self.logger.warning(
+                    "pool_max_age不小于block_wait_timeout，"
+                    "服务端会在连接池中的连接被使用之前关闭它们"
+                )
+            self.pool = ConnectionPool(
+                self.remote_addr,
+                self.remote_port,
+                self.logger.get_child("pool"),
+                size=self.config["pool_size"],
+                min_idle=self.config["pool_min_idle"],
+                max_age=self.config["pool_max_age"],
+                ssl_context=self.ssl_context,
+                limit=self.stream_limit,
+                socket_options=self.socket_options,
+            )
+
+        # 多路复用模式下，所有的Socks连接共享少量的远程连接
+        self.mux_pool = None
+        if self.config["mux"]:
+            self.mux_pool = MuxPool(
+                self.__mux_connect,
+                self.logger.get_child("mux"),
+                size=self.config["mux_connections"],
+            )
+
+        # 垃圾回收策略，在服务启动后生效
+        self.gc_policy = GCPolicy(config_all.general, self.logger.get_child("gc"))
         # self.run()
 
+    def __register_metrics(self):
+        """输出连接池、多路复用和TLS会话恢复的统计"""
+        context, pool, mux_pool = self.ssl_context, self.pool, self.mux_pool
+        metrics.REGISTRY.callback(
+            "pyxy_tls_handshakes_total",
+            "按类型统计的TLS握手次数",
+            lambda: [
+                ({"type": "resumed"}, context.resumed),
+                ({"type": "full"}, context.full),
+            ],
+            kind="counter",
+        )
+        if pool is not None:
+            metrics.REGISTRY.callback(
+                "pyxy_pool_acquires_total",
+                "按是否命中统计的连接池取用次数",
+                lambda: [
+                    ({"result": "hit"}, pool.hits),
+                    ({"result": "miss"}, pool.misses),
+                ],
+                kind="counter",
+            )
+            metrics.REGISTRY.callback(
+                "pyxy_pool_idle_connections", "连接池中的空闲连接数", lambda: len(pool.idle)
+            )
+        if mux_pool is not None:
+            metrics.REGISTRY.callback(
+                "pyxy_mux_streams",
+                "各多路复用连接上的逻辑流数量",
+                lambda: [
+                    ({"session": str(i)}, len(s.streams))
+                    for i, s in enumerate(mux_pool.sessions)
+                ],
+            )
+
     def run(self):
         """同步启动"""
         try:
@@ -62,13 +163,147 @@ class SockRelay(StreamBase, LogMixin):
             self.sock_proxy_addr,
             self.sock_proxy_port,
             backlog=self.config["backlog"],
+            limit=self.stream_limit,
+            reuse_port=True,
         )
 
+        for sock in server.sockets:
+            self.socket_options.listen(sock)
         addr = server.sockets[0].getsockname()
         self.logger.warning(f"服务器启动, 端口:{addr[1]}")
+        self.logger.info(f"监听套接字选项 > {self.socket_options.describe(server.sockets[0])}")
+        self.logger.info(f"远程连接套接字选项 > {self.socket_options.describe()}")
+        self.__register_metrics()
+        await metrics.serve(
+            self.config["metrics_address"], self.config["metrics_port"], self.logger
+        )
+
+        if self.pool is not None:
+            self.pool.start()
+        install_gc_policy(self.gc_policy)
+        metrics.report_status()
+
+        await self.serve_until_stopped(server)
+
+    def __remote_session(self, logger: SyncLogger) -> RemoteSession:
+        """为一个Socks连接创建远程会话，共享密钥、安全环境和连接池"""
+        return RemoteSession(
+            self.key,
+            self.remote_addr,
+            self.remote_port,
+            logger,
+            pool=self.pool,
+            ssl_context=self.ssl_context,
+            block_version=self.block_version,
+            limit=self.stream_limit,
+            socket_options=self.socket_options,
+        )
+
+    async def __mux_connect(self):
+        """建立一条多路复用的远程连接"""
+        remote_session = self.__remote_session(self.logger.get_child("mux"))
+        return await remote_session.mux_handshake()
+
+    async def __udp_associate(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        logger: SyncLogger,
+        handshake: Deadline,
+    ) -> None:
+        """处理UDP ASSOCIATE请求
+
+        每个关联使用一条独立的远程连接或者多路复用的逻辑流，Socks连接关闭时关联结束。
+        handshake: 握手超时，远程的预协商完成并回复Socks客户端之后才取消
+        """
+        if self.mux_pool is not None:
+            remote_stream = await self.mux_pool.open_stream({"udp": UDP_VERSION})
+            try:
+                await remote_stream.wait_reply()
+            except ConnectionResetError:
+                raise RemoteClientError("远程的UDP关联建立失败")
+            except BaseException:
+                remote_stream.close()  # 握手超时
+                raise
+            remote_reader = remote_writer = remote_stream
+        else:
+            remote_session = self.__remote_session(logger)
+            try:
+                remote_reader, remote_writer = await remote_session.udp_handshake()
+            except BaseException:
+                # 握手超时或者预协商失败，远程连接可能已经建立
+                if remote_session.remote_writer is not None:
+                    self.abort(remote_session.remote_writer)
+                raise
+
+        association = ClientAssociation(
+            writer.get_extra_info("peername")[0], logger, self.udp_idle_timeout
+        )
+
+        async def control() -> None:
+            # 控制连接不再有请求，读到EOF表示客户端结束了关联
+            while await reader.read(4096):
+                pass
+
+        relay = None
+        try:
+            # 绑定在客户端连接的本地地址上，保证客户端可以访问
+            bind_address, bind_port = await association.open(
+                writer.get_extra_info("sockname")[0]
+            )
+            association.attach(remote_reader, remote_writer)
+            writer.write(socks_reply(bind_address, bind_port))
+            await writer.drain()
+            handshake.cancel()
+            logger.event("request", INFO, "UDP关联 > {}:{}", bind_address, bind_port)
 
-        async with server:
-            await server.serve_forever()
+            relay = asyncio.ensure_future(association.run())
+            watcher = asyncio.ensure_future(control())
+            await asyncio.wait((relay, watcher), return_when=asyncio.FIRST_COMPLETED)
+            watcher.cancel()
+        finally:
+            association.close()
+            if relay is not None:
+                await asyncio.gather(relay, return_exceptions=True)
+            await self.try_close(remote_writer)
+
+    async def negotiate(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> Tuple[int, str, str, int, bytes]:
+        """完成Socks5的认证并读取请求，返回 命令, 目标IP, 目标域名, 目标端口, 提前发送的数据
+
+        每次读取缓冲区中已有的全部数据交给状态机，只有数据不完整时才等待，
+        客户端把认证和请求连在一起发送时只需要一次读取和一次写入
+
+        Raises:
+            SocksError: 协议错误或者身份验证失败
+            asyncio.IncompleteReadError: 客户端提前关闭连接
+        """
+        parser = SocksParser(self.username_bytes, self.password_bytes)
+        while not parser.done:
+            data = await reader.read(self.stream_limit)
+            if not data:
+                raise asyncio.IncompleteReadError(parser.early, None)
+            try:
+                reply = parser.feed(data)
+            except SocksError as error:
+                if error.reply:
+                    writer.write(error.reply)
+                    await writer.drain()
+                raise
+            if reply:
+                writer.write(reply)
+                await writer.drain()
+        return (*parser.result(), parser.early)
+
+    async def __first_data(self, reader: asyncio.StreamReader) -> bytes:
+        """乐观模式下等待客户端的第一段数据，超过optimistic_wait秒时不再等待"""
+        try:
+            return await asyncio.wait_for(
+                reader.read(self.stream_limit), self.optimistic_wait
+            )
+        except asyncio.TimeoutError:
+            return b""  # 目标先发送数据的协议
 
     @StreamBase.handlerDeco
     async def local_sock_handle(
@@ -78,157 +313,146 @@ class SockRelay(StreamBase, LogMixin):
 
         request_id = self.total_conn_count - 1
         logger = self.logger.get_child(str(request_id))
-        logger.debug(f'接收来自{writer.get_extra_info("peername")}的连接')
+        self.socket_options.apply(writer.get_extra_info("socket"))
+        logger.event(
+            "connection", DEBUG, "接收来自{}的连接", writer.get_extra_info("peername")
+        )
 
         # Socks5参考文献
         # [RFC1928]
         # https://www.quarkay.com/code/383/socks5-protocol-rfc-chinese-traslation
+        remote_writer = None
+        handshake = self.watch_handshake(writer)
+        start = time.perf_counter()
         try:
 
-            # Socks5协议头
-            header = await reader.readexactly(2)
-            version, nmethods = unpack("!BB", header)
-            assert version == SOCKS_VERSION, SocksError("不支持的Socks版本")
-            assert nmethods > 0, SocksError("Socks请求包协议头错误，认证方式的数量不能小于0")
-
-            # 检查客户端支持的methods
-            methods = []
-            for _ in range(nmethods):
-                methods.append(
-                    ord(
-                        await reader.readexactly(1),
-                    )
-                )
-
-            # 目前只兼容用户名密码方式
-            if 2 not in set(methods):
-                raise SocksError("不支持的身份验证方式")
-
-            # 发送支持的methods
-            writer.write(pack("!BB", SOCKS_VERSION, 2))  # 2表示用户名密码方式
-            await writer.drain()
-
-            # 验证身份信息
-            # [文档](https://www.jianshu.com/p/8001c40e5f83)
-            version = ord(await reader.readexactly(1))
-            assert version == 1, SocksError("不支持的身份验证版本")
-
-            username_len = ord(await reader.readexactly(1))
-            username = (await reader.readexactly(username_len)).decode("utf-8")
-
-            password_len = ord(await reader.readexactly(1))
-            password = (await reader.readexactly(password_len)).decode("utf-8")
+            cmd, true_ip, true_domain, true_port, early = await self.negotiate(
+                reader, writer
+            )
+            logger.event(
+                "request", INFO, "客户端请求 > {}|{}:{}", true_ip, true_domain, true_port
+            )
+            metrics.SOCKS_NEGOTIATION.observe(metrics.elapsed(start))
 
-            if (username == self.username) and (password == self.password):
-                # 身份验证成功
-                writer.write(pack("!BB", version, 0))  # 0 表示正确
-                await writer.drain()
+            if cmd == 3:  # UDP ASSOCIATE，请求中的地址是客户端发送数据报的地址，不需要使用
+                await self.__udp_associate(reader, writer, logger, handshake)
+                return
 
-            else:
-                # 身份验证失败
-                writer.write(pack("!BB", version, 0xFF))  # !0 表示不正确
+            # 乐观模式下先回复成功，客户端随后发送的第一段数据和预协商一起发出
+            optimistic = self.optimistic and cmd == 1
+            if optimistic:
+                writer.write(socks_reply("0.0.0.0", 0))
                 await writer.drain()
-                raise SocksError("身份验证失败")
-
-            # 读取客户端请求
-            # request
-            version, cmd, _, address_type = unpack("!BBBB", await reader.readexactly(4))
-            assert version == SOCKS_VERSION, SocksError("不支持的Socks版本")
-
-            if address_type == 1:  # IPv4
-                true_domain = ""
-                true_ip_bytes = await reader.readexactly(4)
-                if true_ip_bytes == b"":
-                    raise SocksError("没有获取到目标IP地址")
-                true_ip = socket.inet_ntoa(true_ip_bytes)
-
-            elif address_type == 3:  # 域名
-                true_ip = ""
-                domain_length = (await reader.readexactly(1))[0]  # 返回int类型
-                true_domain_bytes = await reader.readexactly(domain_length)
-                true_domain = true_domain_bytes.decode("utf-8")
+                early += await self.__first_data(reader)
+
+            # 在远程创建真实链接，客户端提前发送的数据紧跟在请求之后
+            # 通过认证的Socks用户名一并传给服务端，用于按用户限制带宽
+            payload = {
+                "ip": true_ip,
+                "domain": true_domain,
+                "port": true_port,
+                "user": self.username,
+            }
+            if self.mux_pool is not None:
+                start = time.perf_counter()
+                remote_stream = await self.mux_pool.open_stream(payload)
+                remote_reader = remote_writer = remote_stream
+                if early:
+                    remote_stream.write(early)
+                    await remote_stream.drain()
+                try:
+                    response = await remote_stream.wait_reply()
+                except ConnectionResetError:
+                    raise RemoteClientError("远程的连接建立失败")
+                metrics.BLOCK_HANDSHAKE.observe(metrics.elapsed(start))
 
             else:
-                raise SocksError(f"不支持的地址类型{address_type}")
-
-            true_port = unpack("!H", await reader.readexactly(2))[0]
-            logger.info(f"客户端请求 > {true_ip}|{true_domain}:{true_port}")
-
-            # 在远程创建真实链接
-            remote_client = Client(
-                self.key_string,
-                self.remote_addr,
-                self.remote_port,
-                tag=request_id,
-            )
-            response = await remote_client.remote_handshake(
-                payload={
-                    "ip": true_ip,
-                    "domain": true_domain,
-                    "port": true_port,
-                }
-            )
+                remote_session = self.__remote_session(logger)
+                response = await remote_session.remote_handshake(payload, early)
+                remote_reader = remote_session.remote_reader
+                remote_writer = remote_session.remote_writer
 
             bind_address, bind_port = response
 
             if bind_address is None or bind_port is None:
+                # 乐观模式下已经回复了成功，只能关闭连接
                 raise RemoteClientError("远程的客户端错误")
 
-            bind_address_bytes = socket.inet_aton(bind_address)
-            bind_address_int = unpack("!I", bind_address_bytes)[0]
-
-            # 对Socks客户端响应连接的结果
-            reply = pack("!BBBBIH", SOCKS_VERSION, 0, 0, 1, bind_address_int, bind_port)
-            writer.write(reply)
-            await writer.drain()
+            if not optimistic:
+                # 对Socks客户端响应连接的结果
+                writer.write(socks_reply(bind_address, bind_port))
+                await writer.drain()
 
             # 建立数据交换
-            if not remote_client.remote_reader:
+            if not remote_reader:
                 raise RemoteClientError("连接未建立")
-            if not remote_client.remote_writer:
+            if not remote_writer:
                 raise RemoteClientError("连接未建立")
 
-            if reply[1] == 0 and cmd == 1:
-                await remote_client.exchange_stream(
+            handshake.cancel()
+            if cmd == 1:
+                await self.exchange_stream(
                     reader,
                     writer,
-                    remote_client.remote_reader,
-                    remote_client.remote_writer,
+                    remote_reader,
+                    remote_writer,
+                    self.limiters_for(self.username, true_domain or true_ip),
                 )
 
         except RemoteClientError as error:
-            logger.warning(f"远程创建连接失败 > {error}")
+            logger.event("failure", WARNING, "远程创建连接失败 > {}", error)
+            metrics.CONNECTIONS_FAILED.labels("remote").inc()
 
         except SocksError as error:
-            logger.warning(f"Socks错误 > {error}")
+            logger.event("failure", WARNING, "Socks错误 > {}", error)
+            metrics.CONNECTIONS_FAILED.labels("socks").inc()
 
         except OSError as error:
-            logger.warning(f"OS错误 > {error}")
+            logger.event("failure", WARNING, "OS错误 > {}", error)
+            metrics.CONNECTIONS_FAILED.labels("os").inc()
 
         except Exception as error:
-            logger.warning(f"未知错误 > {type(error)}|{error}")
+            logger.event("failure", WARNING, "未知错误 > {}|{}", type(error), error)
+            metrics.CONNECTIONS_FAILED.labels("unknown").inc()
 
         finally:
+            handshake.cancel()
             try:
                 writer.close()
                 await writer.wait_closed()
-                logger.debug("本地连接已关闭")
+                logger.event("connection", DEBUG, "本地连接已关闭")
             except Exception as error:
-                logger.debug(f"关闭本地连接失败，连接可能已断开 > {type(error)}|{error}")
+                logger.event(
+                    "connection",
+                    DEBUG,
+                    "关闭本地连接失败，连接可能已断开 > {}|{}",
+                    type(error),
+                    error,
+                )
 
             try:
-                await remote_client.remote_close()
+                if remote_writer is not None:
+                    await self.try_close(remote_writer)
             except Exception as error:
-                logger.debug(f"关闭远程连接失败，连接可能已断开 > {type(error)}|{error}")
-
-            logger.info("请求处理结束")
+                logger.event(
+                    "connection",
+                    DEBUG,
+                    "关闭远程连接失败，连接可能已断开 > {}|{}",
+                    type(error),
+                    error,
+                )
 
-            # DEBUG
-            # objgraph.show_growth()
+            logger.event("connection", INFO, "请求处理结束")
 
 
 if __name__ == "__main__":
     config = PyxyConfig()
+    workers = config.client["workers"]
+    if workers != 1 and not metrics.is_worker():
+        # 多个SockRelay进程共享Socks5端口，每个进程有自己的事件循环和远程连接
+        asyncio.run(Supervisor(config, "client", workers).run())
+        raise SystemExit
+
     proxy_server = SockRelay(
         config,
         remote_addr=config.general["domain"],
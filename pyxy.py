@@ -1,167 +1,650 @@
-from aisle import LogMixin
-import select
+"""
+Filename: pyxy.py
+
+不经过服务端的直连Socks5代理
+
+python3 pyxy.py [--address 127.0.0.1] [--port 9011] [--max-connections 4096]
+
+单线程的selectors反应器处理所有连接，连接数达到上限后暂停accept，新的连接留在内核的积压队列中。
+转发时一个方向的数据没有写完就不再读取这个方向，由TCP的流量控制让对端减速
+"""
+from __future__ import annotations
+import argparse
+import errno
+import os
+import queue
+import selectors
 import socket
 import struct
-from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional, Set, Tuple
+
+import xylog
+from xylog import DEBUG, INFO, WARNING
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
-# logging.basicConfig(level=logging.INFO)
 SOCKS_VERSION = 5
 
+# Linux上通过管道在两个套接字之间搬运数据，数据不经过用户空间
+SPLICE_AVAILABLE = hasattr(os, "splice")
+BUFFER_SIZE = 65536  # recv单次读取的最大字节数
+PIPE_SIZE = 1048576  # 管道容量，也是splice单次搬运的最大字节数，设置失败时为默认的64KB
 
-class ThreadingTCPServer(ThreadingMixIn, TCPServer):
-    pass
+MAX_CONNECTIONS = 4096  # 同时处理的连接数上限
+BACKLOG = 1024
+HANDSHAKE_TIMEOUT = 10  # 完成Socks5协商和连接目标的最长秒数
+RESOLVER_WORKERS = 4  # 解析域名的线程数
 
+READ, WRITE = selectors.EVENT_READ, selectors.EVENT_WRITE
 
-class SocksProxy(LogMixin, StreamRequestHandler):
-    # [资料](https://docs.python.org/zh-cn/3.7/library/socketserver.html)
-    username = "username"
-    password = "password"
+# 握手阶段
+GREETING, AUTH, REQUEST, CONNECTING, RELAY, CLOSED = range(6)
 
-    def handle(self):
-        # logging.info(self.request)
-        self.logger.info(
-            "Accepting connection from %s:%s" % self.client_address
-        )
 
-        # greeting header
-        # read and unpack 2 bytes from a client
-        header = self.connection.recv(2)  # 取数据包的头2字节，作为Socks5协议的版本号和命令类型
-        version, nmethods = struct.unpack("!BB", header)
+class CopyPump:
+    """一个方向的转发，通过recv和send在用户空间拷贝
 
-        # [RFC1928]
-        # https://www.quarkay.com/code/383/socks5-protocol-rfc-chinese-traslation
+    src和dst都是非阻塞的套接字，dst写不下的数据留在pending中，pending不为空时不再从src读取
+    """
 
-        # socks 5
-        assert version == SOCKS_VERSION
-        assert nmethods > 0
+    __slots__ = ("src", "dst", "buffer", "eof", "done")
 
-        # get available methods
-        methods = self.get_available_methods(nmethods)
+    def __init__(self, src: socket.socket, dst: socket.socket) -> None:
+        self.src = src
+        self.dst = dst
+        self.buffer = memoryview(b"")
+        self.eof = False  # src已经读到EOF
+        self.done = False  # 数据已经全部写出，并且半关闭了dst
 
-        # accept only USERNAME/PASSWORD auth
-        if 2 not in set(methods):
-            # close connection
-            self.server.close_request(self.request)
+    @property
+    def pending(self) -> int:
+        return len(self.buffer)
+
+    def preload(self, data: bytes) -> None:
+        """握手阶段多读到的数据，在转发开始时首先写出"""
+        self.buffer = memoryview(data)
+
+    def read(self) -> None:
+        """src可读时调用"""
+        try:
+            data = self.src.recv(BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        if not data:
+            self.eof = True
             return
+        self.buffer = memoryview(data)
+        self.write()
+
+    def write(self) -> None:
+        """dst可写时调用，写出尽量多的pending数据"""
+        try:
+            n = self.dst.send(self.buffer)
+        except BlockingIOError:
+            return
+        self.buffer = self.buffer[n:]
+
+    def close(self) -> None:
+        self.buffer = memoryview(b"")
+
 
-        # send welcome message
-        self.connection.sendall(struct.pack("!BB", SOCKS_VERSION, 2))
+class PipePool:
+    """splice使用的管道
 
-        if not self.verify_credentials():
+    管道只在一个方向有没写完的数据时被占用，数据写完后归还，空闲的连接不占用管道
+    """
+
+    def __init__(self, max_idle: int = 64) -> None:
+        self.max_idle = max_idle
+        self.idle: List[Tuple[int, int, int]] = []
+
+    def acquire(self) -> Tuple[int, int, int]:
+        """返回(读端, 写端, 容量)"""
+        if self.idle:
+            return self.idle.pop()
+        pipe_r, pipe_w = os.pipe()
+        try:
+            size = fcntl.fcntl(pipe_w, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+        except (AttributeError, OSError):
+            size = 65536  # 超过了/proc/sys/fs/pipe-max-size
+        return pipe_r, pipe_w, size
+
+    def release(self, pipe: Tuple[int, int, int]) -> None:
+        """归还一个空的管道"""
+        if len(self.idle) < self.max_idle:
+            self.idle.append(pipe)
+        else:
+            self.discard(pipe)
+
+    @staticmethod
+    def discard(pipe: Tuple[int, int, int]) -> None:
+        os.close(pipe[0])
+        os.close(pipe[1])
+
+    def close(self) -> None:
+        while self.idle:
+            self.discard(self.idle.pop())
+
+
+class SplicePump(CopyPump):
+    """一个方向的转发，通过splice经由管道在内核中搬运，pending为管道中的字节数"""
+
+    __slots__ = ("pipes", "pipe", "count")
+
+    def __init__(
+        self, src: socket.socket, dst: socket.socket, pipes: PipePool
+    ) -> None:
+        super().__init__(src, dst)
+        self.pipes = pipes
+        self.pipe: Optional[Tuple[int, int, int]] = None
+        self.count = 0
+
+    @property
+    def pending(self) -> int:
+        return self.count
+
+    def preload(self, data: bytes) -> None:
+        self.pipe = self.pipes.acquire()
+        self.count = os.write(self.pipe[1], data)  # 空管道可以容纳握手阶段的少量数据
+
+    def read(self) -> None:
+        if self.pipe is None:
+            self.pipe = self.pipes.acquire()
+        try:
+            n = os.splice(
+                self.src.fileno(),
+                self.pipe[1],
+                self.pipe[2],
+                flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK,
+            )
+        except BlockingIOError:
+            n = -1
+        if n <= 0:
+            self.eof = n == 0
+            self.pipes.release(self.pipe)
+            self.pipe = None
             return
+        self.count = n
+        self.write()
 
-        # request
-        version, cmd, _, address_type = struct.unpack(
-            "!BBBB", self.connection.recv(4)
-        )
-        assert version == SOCKS_VERSION
+    def write(self) -> None:
+        try:
+            n = os.splice(
+                self.pipe[0],
+                self.dst.fileno(),
+                self.count,
+                flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK,
+            )
+        except BlockingIOError:
+            return
+        self.count -= n
+        if not self.count:
+            self.pipes.release(self.pipe)
+            self.pipe = None
+
+    def close(self) -> None:
+        if self.pipe is not None:
+            # 管道中还有数据，不能再给其他连接使用
+            self.pipes.discard(self.pipe)
+            self.pipe = None
+
+
+class Connection:
+    """一个Socks5连接
+
+    握手阶段累积client发来的数据并逐段解析，连接目标之后双向转发
+    """
+
+    __slots__ = (
+        "proxy",
+        "client",
+        "remote",
+        "buffer",
+        "state",
+        "started",
+        "masks",
+        "upload",
+        "download",
+        "logger",
+    )
+
+    def __init__(self, proxy: DirectProxy, client: socket.socket, name: str) -> None:
+        self.proxy = proxy
+        self.client = client
+        self.remote: Optional[socket.socket] = None
+        self.buffer = b""  # 握手阶段收到但还没有解析的数据
+        self.state = GREETING
+        self.started = time.monotonic()
+        self.masks = {}  # 每个套接字在selector中注册的事件
+        self.upload: Optional[CopyPump] = None  # client到remote
+        self.download: Optional[CopyPump] = None  # remote到client
+        self.logger = proxy.logger.get_child(name)
+
+        client.setblocking(False)
+        self.watch(client, READ)
+
+    def watch(self, sock: socket.socket, mask: int) -> None:
+        """修改套接字关注的事件，mask为0时从selector中移除"""
+        old = self.masks.get(sock, 0)
+        if mask == old:
+            return
+        selector = self.proxy.selector
+        if not old:
+            callback = self.on_client if sock is self.client else self.on_remote
+            selector.register(sock, mask, callback)
+        elif not mask:
+            selector.unregister(sock)
+        else:
+            selector.modify(sock, mask, selector.get_key(sock).data)
+        self.masks[sock] = mask
+
+    def on_client(self, events: int) -> None:
+        try:
+            if self.state == RELAY:
+                if events & READ:
+                    self.upload.read()
+                if events & WRITE:
+                    self.download.write()
+                self.update()
+            elif self.state < CONNECTING:
+                self.handshake()
+        except OSError as error:
+            self.logger.event("connection", DEBUG, "连接中断 > {}", error)
+            self.close()
+
+    def on_remote(self, events: int) -> None:
+        try:
+            if self.state == RELAY:
+                if events & READ:
+                    self.download.read()
+                if events & WRITE:
+                    self.upload.write()
+                self.update()
+            elif self.state == CONNECTING:
+                self.connected()
+        except OSError as error:
+            self.logger.event("connection", DEBUG, "连接中断 > {}", error)
+            self.close()
+
+    # 握手
+
+    def handshake(self) -> None:
+        try:
+            data = self.client.recv(BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        if not data:
+            self.close()
+            return
+        self.buffer += data
+
+        while self.state in (GREETING, AUTH, REQUEST):
+            consumed = (self.greeting, self.auth, self.request)[self.state]()
+            if not consumed:
+                return  # 数据不完整，等待下一次读取
+            self.buffer = self.buffer[consumed:]
+
+    def greeting(self) -> int:
+        # [RFC1928]
+        # https://www.quarkay.com/code/383/socks5-protocol-rfc-chinese-traslation
+        if len(self.buffer) < 2:
+            return 0
+        version, nmethods = self.buffer[0], self.buffer[1]
+        if version != SOCKS_VERSION or nmethods == 0:
+            self.close()
+            return 0
+        if len(self.buffer) < 2 + nmethods:
+            return 0
+
+        # accept only USERNAME/PASSWORD auth
+        if 2 not in self.buffer[2 : 2 + nmethods]:
+            self.client.send(struct.pack("!BB", SOCKS_VERSION, 0xFF))
+            self.close()
+            return 0
+
+        self.client.send(struct.pack("!BB", SOCKS_VERSION, 2))
+        self.state = AUTH
+        return 2 + nmethods
+
+    def auth(self) -> int:
+        # [文档](https://www.jianshu.com/p/8001c40e5f83)
+        buffer = self.buffer
+        if len(buffer) < 2:
+            return 0
+        if buffer[0] != 1:
+            self.close()
+            return 0
+        username_end = 2 + buffer[1]
+        if len(buffer) < username_end + 1:
+            return 0
+        password_end = username_end + 1 + buffer[username_end]
+        if len(buffer) < password_end:
+            return 0
+
+        username = buffer[2:username_end].decode("utf-8", "replace")
+        password = buffer[username_end + 1 : password_end].decode("utf-8", "replace")
+        if username != self.proxy.username or password != self.proxy.password:
+            # failure, status != 0
+            self.client.send(struct.pack("!BB", 1, 0xFF))
+            self.logger.event("failure", WARNING, "身份验证失败")
+            self.close()
+            return 0
+
+        # success, status = 0
+        self.client.send(struct.pack("!BB", 1, 0))
+        self.state = REQUEST
+        return password_end
+
+    def request(self) -> int:
+        buffer = self.buffer
+        if len(buffer) < 5:
+            return 0
+        version, cmd, _, address_type = buffer[:4]
+        if version != SOCKS_VERSION:
+            self.close()
+            return 0
 
         if address_type == 1:  # IPv4
-            ipAddress = socket.inet_ntoa(self.connection.recv(4))
+            end = 4 + 4
         elif address_type == 3:  # Domain name
-            domain_length = self.connection.recv(1)[
-                0
-            ]  # 对bytes进行切片[0]，返回一个int，相当于强转
-            domainAddress = self.connection.recv(domain_length)
-            ipAddress = socket.gethostbyname(
-                domainAddress
-            )  # 将域名解析为IPv4地址  #TODO:需要考虑到DNS也走代理的情况
-
-        # TODO: address_type == 4  # IPv6
+            end = 4 + 1 + buffer[4]
+        elif address_type == 4:  # IPv6
+            end = 4 + 16
+        else:
+            self.fail(8)  # 不支持的地址类型
+            return 0
+        if len(buffer) < end + 2:
+            return 0
+
+        if address_type == 1:
+            host = socket.inet_ntoa(buffer[4:end])
+        elif address_type == 3:
+            host = buffer[5:end].decode("utf-8", "replace")
+        else:
+            host = socket.inet_ntop(socket.AF_INET6, buffer[4:end])
+        port = struct.unpack("!H", buffer[end : end + 2])[0]
+
+        if cmd != 1:  # 只支持CONNECT
+            self.fail(7)
+            return 0
+
+        self.logger.event("request", INFO, "客户端请求 > {}:{}", host, port)
+        self.state = CONNECTING
+        self.watch(self.client, 0)  # 连接目标期间不读取client
+        if address_type == 3:
+            self.proxy.resolve(self, host, port)
+        else:
+            self.connect(host, port)
+        return end + 2
+
+    def resolved(self, future: Future) -> None:
+        """域名解析完成，在事件循环的线程中调用"""
+        if self.state != CONNECTING:
+            return  # 解析期间连接已经关闭
+        try:
+            family, _, _, _, address = future.result()[0]
+        except (OSError, IndexError) as error:
+            self.logger.event("failure", WARNING, "域名解析失败 > {}", error)
+            self.fail(4)
+            return
+        self.connect(address[0], address[1], family)
+
+    def connect(self, host: str, port: int, family: int = None) -> None:
+        if family is None:
+            family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        self.remote = socket.socket(family, socket.SOCK_STREAM)
+        self.remote.setblocking(False)
+        error = self.remote.connect_ex((host, port))
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.logger.event("failure", WARNING, "连接目标失败 > {}", os.strerror(error))
+            self.fail(5)
+            return
+        self.watch(self.remote, WRITE)
 
-        port = struct.unpack("!H", self.connection.recv(2))[
-            0
-        ]  # 对单元素tuple切片，返回一个int
+    def connected(self) -> None:
+        error = self.remote.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self.logger.event("failure", WARNING, "连接目标失败 > {}", os.strerror(error))
+            self.fail(5)
+            return
 
         # reply
-        # 创建真实连接
+        bind_address, bind_port = self.remote.getsockname()[:2]
+        if self.remote.family == socket.AF_INET6:
+            address = b"\x04" + socket.inet_pton(socket.AF_INET6, bind_address)
+        else:
+            address = b"\x01" + socket.inet_aton(bind_address)
+        self.client.send(
+            struct.pack("!BBB", SOCKS_VERSION, 0, 0) + address + struct.pack("!H", bind_port)
+        )
+
+        # establish data exchange
+        if self.proxy.splice:
+            self.upload = SplicePump(self.client, self.remote, self.proxy.pipes)
+            self.download = SplicePump(self.remote, self.client, self.proxy.pipes)
+        else:
+            self.upload = CopyPump(self.client, self.remote)
+            self.download = CopyPump(self.remote, self.client)
+        if self.buffer:
+            self.upload.preload(self.buffer)
+            self.buffer = b""
+        self.state = RELAY
+        if self.upload.pending:
+            self.upload.write()
+        self.update()
+
+    def fail(self, status: int) -> None:
+        """回复连接失败并关闭"""
         try:
-            if cmd == 1:  # CONNECT
-                remote = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                remote.connect((ipAddress, port))
-                bind_address = remote.getsockname()
-            else:
-                self.server.close_request(self.request)
-
-            addr = struct.unpack("!I", socket.inet_aton(bind_address[0]))[0]
-            port = bind_address[1]
-            reply = struct.pack(
-                "!BBBBIH", SOCKS_VERSION, 0, 0, 1, addr, port
-            )  # 对sock客户端响应连接的结果
+            self.client.send(
+                struct.pack("!BBBBIH", SOCKS_VERSION, status, 0, 1, 0, 0)
+            )
+        except OSError:
             pass
-        except Exception as err:
-            self.logger.error(err)
-            # return connection refused error
-            reply = self.generate_failed_reply(address_type, 5)
+        self.close()
+
+    # 转发
+
+    def update(self) -> None:
+        """根据两个方向的状态更新关注的事件
+
+        一个方向还有没写完的数据时不再读取它的源，等待目标可写；
+        源读到EOF并且数据全部写出后半关闭目标，两个方向都结束后关闭连接
+        """
+        upload, download = self.upload, self.download
+        for pump in (upload, download):
+            if pump.eof and not pump.pending and not pump.done:
+                pump.done = True
+                try:
+                    pump.dst.shutdown(socket.SHUT_WR)
+                except OSError:
+                    pass  # 对端已经关闭
+        if upload.done and download.done:
+            self.close()
+            return
 
-        self.connection.sendall(reply)
+        self.watch(
+            self.client,
+            (0 if upload.eof or upload.pending else READ)
+            | (WRITE if download.pending else 0),
+        )
+        self.watch(
+            self.remote,
+            (0 if download.eof or download.pending else READ)
+            | (WRITE if upload.pending else 0),
+        )
 
-        # establish data exchange、
-        # 回传
-        if reply[1] == 0 and cmd == 1:
+    def close(self) -> None:
+        if self.state == CLOSED:
+            return
+        self.state = CLOSED
+        for sock in (self.client, self.remote):
+            if sock is None:
+                continue
+            if self.masks.get(sock):
+                self.proxy.selector.unregister(sock)
+            sock.close()
+        for pump in (self.upload, self.download):
+            if pump is not None:
+                pump.close()
+        self.proxy.closed(self)
+
+
+class DirectProxy:
+    """单线程的Socks5直连代理
+
+    max_connections: 同时处理的连接数上限，达到上限后暂停accept
+    splice: 是否使用splice转发，为False时使用recv和send
+    """
+
+    def __init__(
+        self,
+        address: str = "127.0.0.1",
+        port: int = 9011,
+        username: str = "username",
+        password: str = "password",
+        max_connections: int = MAX_CONNECTIONS,
+        splice: bool = SPLICE_AVAILABLE,
+    ) -> None:
+        self.logger = xylog.get_logger(self.__class__.__name__)
+        self.username = username
+        self.password = password
+        self.max_connections = max_connections
+        self.splice = splice
+        self.pipes = PipePool()
+
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.create_server((address, port), backlog=BACKLOG)
+        self.listener.setblocking(False)
+        self.accepting = False
+        self.connections: Set[Connection] = set()
+        self.total_conn_count = 0
+
+        # 域名解析在线程池中进行，结果通过队列交回事件循环，socketpair用于唤醒select
+        self.resolver = ThreadPoolExecutor(RESOLVER_WORKERS, "resolver")
+        self.resolved: "queue.SimpleQueue" = queue.SimpleQueue()
+        self.waker_r, self.waker_w = socket.socketpair()
+        self.waker_r.setblocking(False)
+        self.waker_w.setblocking(False)
+        self.selector.register(self.waker_r, READ, self.__on_wake)
+
+    @property
+    def address(self):
+        return self.listener.getsockname()
+
+    def serve_forever(self) -> None:
+        self.logger.warning(
+            "服务器启动于 {}:{}，连接数上限{}，转发方式{}",
+            *self.address[:2],
+            self.max_connections,
+            "splice" if self.splice else "copy",
+        )
+        self.__accept_on()
+        last_sweep = time.monotonic()
+        try:
+            while 1:
+                for key, events in self.selector.select(1):
+                    key.data(events)
+                now = time.monotonic()
+                if now - last_sweep >= 1:
+                    last_sweep = now
+                    self.__sweep(now)
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        for conn in list(self.connections):
+            conn.close()
+        self.resolver.shutdown(wait=False)
+        self.pipes.close()
+        self.selector.close()
+        self.listener.close()
+        self.waker_r.close()
+        self.waker_w.close()
+
+    def __accept_on(self) -> None:
+        if not self.accepting:
+            self.selector.register(self.listener, READ, self.__on_accept)
+            self.accepting = True
+
+    def __accept_off(self) -> None:
+        if self.accepting:
+            self.selector.unregister(self.listener)
+            self.accepting = False
+
+    def __on_accept(self, events: int) -> None:
+        while len(self.connections) < self.max_connections:
             try:
-                self.exchange_loop(self.connection, remote)
-            except ConnectionResetError:
-                """
-                ConnectionResetError: [WinError 10054] 远程主机强迫关闭了一个现有的连接。
-                应该是数据传回客户端中出现异常
-                """
-                self.logger.info("客户端关闭了连接")
-
-        self.server.close_request(self.request)
-
-    def get_available_methods(self, n):
-        methods = []
-        for i in range(n):
-            methods.append(ord(self.connection.recv(1)))
-        return methods
-
-    def verify_credentials(self):
-        # [文档](https://www.jianshu.com/p/8001c40e5f83)
-        version = ord(self.connection.recv(1))
-        assert version == 1
-
-        username_len = ord(self.connection.recv(1))
-        username = self.connection.recv(username_len).decode("utf-8")
-
-        password_len = ord(self.connection.recv(1))
-        password = self.connection.recv(password_len).decode("utf-8")
-
-        if username == self.username and password == self.password:
-            # success, status = 0
-            response = struct.pack("!BB", version, 0)
-            self.connection.sendall(response)
-            return True
-
-        # failure, status != 0
-        response = struct.pack("!BB", version, 0xFF)
-        self.connection.sendall(response)
-        self.server.close_request(self.request)
-        return False
-
-    def generate_failed_reply(self, address_type, error_number):
-        return struct.pack(
-            "!BBBBIH", SOCKS_VERSION, error_number, 0, address_type, 0, 0
+                client, address = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as error:
+                # 文件描述符耗尽等错误，停止accept直到有连接关闭
+                self.logger.error("accept失败 > {}", error)
+                self.__accept_off()
+                return
+            self.total_conn_count += 1
+            conn = Connection(self, client, str(self.total_conn_count))
+            self.connections.add(conn)
+            conn.logger.event("connection", INFO, "Accepting connection from {}:{}", *address[:2])
+
+        self.logger.event("failure", WARNING, "连接数达到上限{}，暂停接受新连接", self.max_connections)
+        self.__accept_off()
+
+    def closed(self, conn: Connection) -> None:
+        self.connections.discard(conn)
+        if not self.accepting and len(self.connections) < self.max_connections:
+            self.__accept_on()
+
+    def resolve(self, conn: Connection, host: str, port: int) -> None:
+        future = self.resolver.submit(
+            socket.getaddrinfo, host, port, 0, socket.SOCK_STREAM
         )
+        future.add_done_callback(lambda f: self.__post(conn, f))
 
-    def exchange_loop(self, client, remote):
-
-        while True:
-
-            # wait until client or remote is available for read
-            r, w, e = select.select([client, remote], [], [])
+    def __post(self, conn: Connection, future: Future) -> None:
+        """在解析线程中调用"""
+        self.resolved.put((conn, future))
+        try:
+            self.waker_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass  # 已经有未处理的唤醒
 
-            if client in r:
-                data = client.recv(4096)
-                if remote.send(data) <= 0:
-                    break
+    def __on_wake(self, events: int) -> None:
+        try:
+            while self.waker_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while 1:
+            try:
+                conn, future = self.resolved.get_nowait()
+            except queue.Empty:
+                return
+            conn.resolved(future)
 
-            if remote in r:
-                data = remote.recv(4096)
-                if client.send(data) <= 0:
-                    break
+    def __sweep(self, now: float) -> None:
+        """关闭握手超时的连接"""
+        for conn in list(self.connections):
+            if conn.state < RELAY and now - conn.started > HANDSHAKE_TIMEOUT:
+                conn.logger.event("failure", WARNING, "握手超时")
+                conn.close()
 
 
 if __name__ == "__main__":
-    with ThreadingTCPServer(("127.0.0.1", 9011), SocksProxy) as server:
-        server.serve_forever()
+    parser = argparse.ArgumentParser(description="直连Socks5代理")
+    parser.add_argument("--address", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9011)
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS)
+    args = parser.parse_args()
+
+    proxy = DirectProxy(args.address, args.port, max_connections=args.max_connections)
+    try:
+        proxy.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,221 @@
+"""
+Filename: relay.py
+
+基于asyncio.BufferedProtocol的转发引擎
+
+接管两条连接的transport，数据直接读入预先分配的缓冲区后写入对端的transport，
+转发过程中没有协程切换，背压通过pause_reading/resume_reading实现
+"""
+import asyncio
+from typing import Optional, Tuple
+
+from metrics import Value
+from shaper import Limiter
+from timer import Deadline
+
+BUFFER_SIZE = 65536
+
+
+class _RelaySide(asyncio.BufferedProtocol):
+    """一条连接的协议对象，读到的数据写入对端"""
+
+    __slots__ = (
+        "relay",
+        "transport",
+        "original",
+        "peer",
+        "buffer_size",
+        "deadline",
+        "counter",
+        "limiter",
+        "blocked",
+        "shaped",
+        "_view",
+    )
+
+    def __init__(
+        self,
+        relay: "Relay",
+        transport: asyncio.Transport,
+        original: asyncio.BaseProtocol,
+        buffer_size: int,
+        deadline: Optional[Deadline],
+        counter: Optional[Value],
+        limiter: Optional[Limiter] = None,
+    ) -> None:
+        self.relay = relay
+        self.transport = transport
+        self.original = original  # 原来的StreamReaderProtocol，连接断开时通知它
+        self.peer: Optional[_RelaySide] = None
+        self.buffer_size = buffer_size
+        self.deadline = deadline
+        self.counter = counter  # 从本连接读到的字节数
+        self.limiter = limiter  # 从本连接读取的带宽限制
+        # 暂停读取的两个原因，对端的写缓冲已满，或者带宽限制的令牌透支，都解除后才恢复读取
+        self.blocked = False
+        self.shaped = False
+        self._view = memoryview(bytearray(buffer_size))
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self.limiter is not None:
+            return self._view[: self.limiter.share()]
+        return self._view
+
+    def buffer_updated(self, nbytes: int) -> None:
+        peer_transport = self.peer.transport
+        peer_transport.write(self._view[:nbytes])
+        if self.deadline is not None:
+            self.deadline.touch()
+        if self.counter is not None:
+            self.counter.value += nbytes
+        if peer_transport.get_write_buffer_size():
+            # 对端没能立即发送完毕，transport可能还引用着这块缓冲区，换一块新的
+            self._view = memoryview(bytearray(self.buffer_size))
+        if self.limiter is not None and not self.limiter.charge(nbytes):
+            self.shaped = True
+            self.transport.pause_reading()
+            self.limiter.wait(self.unshape)
+
+    def unshape(self) -> None:
+        """被令牌桶唤醒后继续读取"""
+        self.shaped = False
+        if not self.blocked and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def eof_received(self) -> bool:
+        self.relay.half_close()
+        self.relay.close()
+        return False
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.original.connection_lost(exc)
+        self.relay.side_lost()
+
+    def pause_writing(self) -> None:
+        # 本连接的写缓冲已满，暂停读取对端
+        self.peer.blocked = True
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self) -> None:
+        self.peer.blocked = False
+        if not self.peer.shaped:
+            self.peer.transport.resume_reading()
+
+
+class Relay:
+    """在两条由asyncio.StreamReader/StreamWriter包装的连接之间直接转发数据
+
+    deadline: 可选，空闲超时项，收到数据时更新，任意一方结束后切换为half_closed_timeout
+    counters: 可选，(本地到远程, 远程到本地)两个方向的字节数指标
+    limiters: 可选，(本地到远程, 远程到本地)两个方向的带宽限制
+    """
+
+    def __init__(
+        self,
+        local_reader: asyncio.StreamReader,
+        local_writer: asyncio.StreamWriter,
+        remote_reader: asyncio.StreamReader,
+        remote_writer: asyncio.StreamWriter,
+        buffer_size: int = BUFFER_SIZE,
+        deadline: Optional[Deadline] = None,
+        half_closed_timeout: float = 0,
+        counters: Tuple[Optional[Value], Optional[Value]] = (None, None),
+        limiters: Tuple[Optional[Limiter], Optional[Limiter]] = (None, None),
+    ) -> None:
+        self.readers = (local_reader, remote_reader)
+        self.local = _RelaySide(
+            self,
+            local_writer.transport,
+            local_writer._protocol,
+            buffer_size,
+            deadline,
+            counters[0],
+            limiters[0],
+        )
+        self.remote = _RelaySide(
+            self,
+            remote_writer.transport,
+            remote_writer._protocol,
+            buffer_size,
+            deadline,
+            counters[1],
+            limiters[1],
+        )
+        self.deadline = deadline
+        self.half_closed_timeout = half_closed_timeout
+        self.local.peer, self.remote.peer = self.remote, self.local
+        self._lost = 0
+        self._done: Optional[asyncio.Future] = None
+
+    async def run(self) -> None:
+        """开始转发，直到两条连接都断开"""
+        self._done = asyncio.get_running_loop().create_future()
+
+        eof = False
+        for side, reader in zip((self.local, self.remote), self.readers):
+            # StreamReader中可能已经缓存了数据，需要先转发给对端
+            leftover = bytes(reader._buffer)
+            reader._buffer.clear()
+            if leftover:
+                side.peer.transport.write(leftover)
+                if side.counter is not None:
+                    side.counter.value += len(leftover)
+            eof = eof or reader._eof
+
+            if side.transport.is_closing():
+                self._lost += 1
+            else:
+                side.transport.set_protocol(side)
+                # StreamReader的缓冲满时会暂停读取，交接之后需要恢复
+                side.transport.resume_reading()
+
+        if eof or self._lost:
+            self.half_close()
+            self.close()
+        if self._lost >= 2:
+            return
+
+        await self._done
+
+    def close(self) -> None:
+        """关闭两条连接，未发送的数据会被发送完毕后再关闭"""
+        self.local.transport.close()
+        self.remote.transport.close()
+
+    def half_close(self) -> None:
+        """一方已经结束，剩余的数据需要在半关闭超时内发送完毕"""
+        if self.deadline is not None:
+            self.deadline.reset(self.half_closed_timeout)
+
+    def side_lost(self) -> None:
+        if not self._lost:
+            self.half_close()
+        self.close()
+        self._lost += 1
+        if self._lost >= 2 and self._done is not None and not self._done.done():
+            self._done.set_result(None)
+
+
+async def pipe(
+    local_reader: asyncio.StreamReader,
+    local_writer: asyncio.StreamWriter,
+    remote_reader: asyncio.StreamReader,
+    remote_writer: asyncio.StreamWriter,
+    buffer_size: int = BUFFER_SIZE,
+    deadline: Optional[Deadline] = None,
+    half_closed_timeout: float = 0,
+    counters: Tuple[Optional[Value], Optional[Value]] = (None, None),
+    limiters: Tuple[Optional[Limiter], Optional[Limiter]] = (None, None),
+) -> None:
+    """双向转发两条连接的数据"""
+    await Relay(
+        local_reader,
+        local_writer,
+        remote_reader,
+        remote_writer,
+        buffer_size,
+        deadline,
+        half_closed_timeout,
+        counters,
+        limiters,
+    ).run()
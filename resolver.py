@@ -0,0 +1,209 @@
+"""
+Filename: resolver.py
+
+异步DNS解析，带有缓存和请求合并
+"""
+import asyncio
+import functools
+import json
+import os
+import socket
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from aisle import SyncLogger
+
+SAVE_BATCH = 512  # 保存缓存时每批序列化的条数
+
+
+def is_ip_address(host: str) -> bool:
+    """判断是否为IPv4或IPv6地址"""
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except OSError:
+            pass
+    return False
+
+
+class Resolver:
+    """不阻塞事件循环的DNS解析器
+
+    解析通过loop.getaddrinfo在线程池中完成；结果按LRU缓存，
+    同一个域名的并发请求只会触发一次查询。
+    getaddrinfo不返回记录的TTL，所以缓存时间统一使用ttl参数。
+
+    size: 最多缓存的域名数量
+    ttl: 缓存的有效秒数
+    cache_file: 可选，缓存持久化的文件路径，重启后可以直接使用
+    """
+
+    def __init__(
+        self,
+        logger: SyncLogger,
+        size: int = 4096,
+        ttl: float = 300,
+        cache_file: str = "",
+    ) -> None:
+        self.logger = logger
+        self.size = size
+        self.ttl = ttl
+        self.cache_file = cache_file
+
+        # 域名 -> (过期时间, 地址列表)，过期时间使用事件循环的时钟
+        self.cache: "OrderedDict[str, Tuple[float, List[str]]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._saving: Optional[asyncio.Future] = None  # 正在进行的缓存写入
+
+        self.hits = 0  # 命中缓存的次数
+        self.misses = 0  # 发起查询的次数
+        self.coalesced = 0  # 合并到正在进行的查询的次数
+        self.lookup_time = 0.0  # 查询的总耗时
+        self.lookup_max = 0.0  # 单次查询的最大耗时
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses + self.coalesced
+        return (self.hits + self.coalesced) / total if total else 0.0
+
+    async def resolve(self, host: str) -> List[str]:
+        """返回域名对应的地址列表
+
+        Raises:
+            socket.gaierror: 解析失败
+        """
+        if is_ip_address(host):
+            return [host]
+
+        loop = asyncio.get_running_loop()
+
+        entry = self.cache.get(host)
+        if entry is not None:
+            if entry[0] > loop.time():
+                self.hits += 1
+                self.cache.move_to_end(host)
+                return entry[1]
+            del self.cache[host]
+
+        # 查询在独立的任务中进行，每个请求通过shield等待，某个请求被取消不会影响其他合并的请求
+        task = self._inflight.get(host)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = self._inflight[host] = loop.create_task(self.__lookup(host))
+            task.add_done_callback(functools.partial(self.__lookup_done, host))
+        return await asyncio.shield(task)
+
+    def __lookup_done(self, host: str, task: asyncio.Task) -> None:
+        """查询任务结束时移除正在进行的记录，成功则写入缓存"""
+        if self._inflight.get(host) is task:
+            del self._inflight[host]
+        if task.cancelled():
+            return
+        if task.exception() is None:  # 同时避免没有请求等待时未读取异常的警告
+            self.__store(host, task.result(), task.get_loop().time() + self.ttl)
+
+    async def __lookup(self, host: str) -> List[str]:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            infos = await loop.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        finally:
+            cost = loop.time() - start
+            self.lookup_time += cost
+            self.lookup_max = max(self.lookup_max, cost)
+
+        addresses: List[str] = []
+        for _, _, _, _, sockaddr in infos:
+            if sockaddr[0] not in addresses:
+                addresses.append(sockaddr[0])
+        if not addresses:
+            raise socket.gaierror(f"没有{host}的地址")
+        return addresses
+
+    def __store(self, host: str, addresses: List[str], expire: float) -> None:
+        self.cache[host] = (expire, addresses)
+        self.cache.move_to_end(host)
+        while len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+    def load(self) -> None:
+        """从文件恢复未过期的缓存"""
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, "rt", encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as error:
+            self.logger.warning(f"读取DNS缓存失败 > {error}")
+            return
+
+        now, loop_now = time.time(), asyncio.get_running_loop().time()
+        for host, (expire, addresses) in saved.items():
+            if expire > now:
+                self.__store(host, addresses, loop_now + expire - now)
+        self.logger.info(f"恢复了{len(self.cache)}条DNS缓存")
+
+    def save(self) -> Optional[asyncio.Future]:
+        """将未过期的缓存写入文件，过期时间转换为墙上时间
+
+        在事件循环中复制缓存，转换、序列化和写入文件在线程池中进行，不阻塞事件循环。
+        返回写入的Future，上一次写入还没有完成时直接返回它
+        """
+        if not self.cache_file:
+            return None
+        if self._saving is not None and not self._saving.done():
+            return self._saving
+        loop = asyncio.get_running_loop()
+        # 缓存项是不可变的元组，只需要在事件循环中浅复制
+        self._saving = loop.run_in_executor(
+            None, self.__write, dict(self.cache), time.time(), loop.time()
+        )
+        self._saving.add_done_callback(self.__saved)
+        return self._saving
+
+    def __write(
+        self,
+        entries: Dict[str, Tuple[float, List[str]]],
+        now: float,
+        loop_now: float,
+    ) -> Optional[OSError]:
+        """在线程池中写入文件，返回遇到的错误
+
+        json的C实现在序列化期间一直持有GIL，分批序列化让事件循环可以在批次之间运行
+        """
+        saved = [
+            (host, (now + expire - loop_now, addresses))
+            for host, (expire, addresses) in entries.items()
+            if expire > loop_now
+        ]
+        temp_file = f"{self.cache_file}.{os.getpid()}"
+        try:
+            with open(temp_file, "wt", encoding="utf-8") as f:
+                f.write("{")
+                for start in range(0, len(saved), SAVE_BATCH):
+                    if start:
+                        f.write(",")
+                    f.write(json.dumps(dict(saved[start : start + SAVE_BATCH]))[1:-1])
+                f.write("}")
+            os.replace(temp_file, self.cache_file)  # 多个进程同时写入也不会损坏文件
+        except OSError as error:
+            return error
+        return None
+
+    def __saved(self, future: asyncio.Future) -> None:
+        """写入结束后在事件循环中记录错误"""
+        if not future.cancelled() and future.result() is not None:
+            self.logger.warning(f"保存DNS缓存失败 > {future.result()}")
+
+    def report(self, logger: SyncLogger) -> None:
+        """输出缓存命中率和查询耗时"""
+        average = self.lookup_time / self.misses if self.misses else 0.0
+        logger.info(
+            f"DNS缓存命中率 {self.hit_rate:.1%} (缓存{len(self.cache)}条)，"
+            f"查询{self.misses}次，平均耗时{average * 1000:.1f}ms，"
+            f"最大耗时{self.lookup_max * 1000:.1f}ms"
+        )
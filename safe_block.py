@@ -1,10 +1,37 @@
 from aisle import LOG
-import uuid
+import asyncio
+import functools
+import hashlib
+import hmac
 import json
+import os
+import socket
 import time
-from Crypto.Cipher import AES
+import uuid
+from struct import Struct, error as StructError
+from typing import Tuple
+from Crypto.Cipher import AES, ChaCha20
 from Crypto.Util.Padding import pad, unpad
 
+# 区块格式: 版本(1字节) | 长度(2字节) | 内容
+BLOCK_HEADER = Struct("!BH")
+BLOCK_VERSION_JSON = 1  # 内容为AES-ECB加密的JSON
+BLOCK_VERSION_BINARY = 2  # 内容为 随机数 | ChaCha20密文 | 认证标签，标签为区块头、随机数和密文的BLAKE2b
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+# 二进制格式的明文: 类型(1字节) | 时间戳(4字节) | 负载
+BINARY_HEAD = Struct("!BI")
+PORT = Struct("!H")
+KIND_JSON = 0  # 负载为JSON，兼容任意字典
+KIND_CONNECT = 1  # 负载为目标地址和端口
+KIND_REPLY = 2  # 负载为绑定地址和端口
+KIND_CONNECT_USER = 3  # 负载为目标地址、端口、用户名长度(1字节)和用户名
+
+ATYP_IPV4 = 1
+ATYP_DOMAIN = 3
+ATYP_IPV6 = 4
+
 # debug
 # from pympler import asizeof
 # import sys
@@ -22,7 +49,7 @@ class Key:
         self: 一个16位比特串
     """
 
-    __slots__ = "_key_bytes"
+    __slots__ = "_key_bytes", "_crypto", "_cipher_key", "_mac"
 
     def __init__(self, key_string: str = "") -> None:
         if not key_string:
@@ -42,6 +69,9 @@ class Key:
             raise ValueError("key must be 32 bytes")
         else:
             self._key_bytes = value
+            self._crypto = None
+            self._cipher_key = None
+            self._mac = None
 
     @property
     def key_string(self) -> str:
@@ -51,6 +81,29 @@ class Key:
     def key_string(self, value: str):
         self.key_bytes = value.encode("utf-8")
 
+    @property
+    def crypto(self) -> "Crypto":
+        """JSON格式区块使用的加密对象，相同的密钥共享同一个实例"""
+        if self._crypto is None:
+            self._crypto = _crypto_for(self._key_bytes)
+        return self._crypto
+
+    @property
+    def cipher_key(self) -> bytes:
+        """二进制格式区块使用的ChaCha20密钥"""
+        if self._cipher_key is None:
+            self._cipher_key = _derive_block_key(self._key_bytes, b"cipher")
+        return self._cipher_key
+
+    @property
+    def mac(self) -> "hashlib.blake2b":
+        """二进制格式区块使用的带密钥的BLAKE2b，每个区块复制后使用"""
+        if self._mac is None:
+            self._mac = hashlib.blake2b(
+                key=_derive_block_key(self._key_bytes, b"mac"), digest_size=TAG_SIZE
+            )
+        return self._mac
+
 
 class Crypto:
     __slots__ = ["cipher", "block_size"]
@@ -72,14 +125,152 @@ class Crypto:
             raise DecryptError("解密错误")
 
 
+def _derive_block_key(key_bytes: bytes, purpose: bytes) -> bytes:
+    """由共享密钥派生二进制区块使用的密钥，加密和认证的密钥分开，也与JSON格式的ECB密钥分开"""
+    return hmac.new(key_bytes, b"pyxy block " + purpose, hashlib.sha256).digest()
+
+
+def _seal(key: Key, header: bytes, nonce: bytes, plaintext: bytes) -> bytes:
+    """先加密后认证，返回 密文 | 认证标签
+
+    每个区块只需要构造ChaCha20对象，认证使用Key中缓存的BLAKE2b状态的副本
+    """
+    ciphertext = ChaCha20.new(key=key.cipher_key, nonce=nonce).encrypt(plaintext)
+    mac = key.mac.copy()
+    mac.update(header + nonce + ciphertext)
+    return ciphertext + mac.digest()
+
+
+def _open(key: Key, header: bytes, nonce: bytes, data: bytes) -> bytes:
+    """验证并解密 密文 | 认证标签
+
+    Raises:
+        DecryptError: 认证失败
+    """
+    if len(data) < TAG_SIZE:
+        raise DecryptError("区块长度错误")
+    ciphertext = data[:-TAG_SIZE]
+    mac = key.mac.copy()
+    mac.update(header + nonce + ciphertext)
+    if not hmac.compare_digest(mac.digest(), data[-TAG_SIZE:]):
+        raise DecryptError("认证失败")
+    return ChaCha20.new(key=key.cipher_key, nonce=nonce).decrypt(ciphertext)
+
+
+@functools.lru_cache(maxsize=16)
+def _crypto_for(key_bytes: bytes) -> Crypto:
+    return Crypto(key_bytes)
+
+
+def pack_address(address: str, is_domain: bool) -> bytes:
+    """按照Socks5的格式打包地址
+
+    Raises:
+        ValueError: 地址无法用二进制格式表示
+    """
+    if not is_domain:
+        try:
+            return bytes((ATYP_IPV4,)) + socket.inet_pton(socket.AF_INET, address)
+        except OSError:
+            pass
+        try:
+            return bytes((ATYP_IPV6,)) + socket.inet_pton(socket.AF_INET6, address)
+        except OSError:
+            raise ValueError(f"无效的IP地址{address}")
+
+    raw = address.encode("utf-8")
+    if len(raw) > 255:
+        raise ValueError("域名过长")
+    return bytes((ATYP_DOMAIN, len(raw))) + raw
+
+
+def unpack_address(b: bytes, offset: int) -> Tuple[int, str, int]:
+    """返回 地址类型, 地址, 下一个字段的位置"""
+    address_type = b[offset]
+    offset += 1
+    if address_type == ATYP_IPV4:
+        return address_type, socket.inet_ntop(socket.AF_INET, b[offset : offset + 4]), offset + 4
+    if address_type == ATYP_IPV6:
+        return address_type, socket.inet_ntop(socket.AF_INET6, b[offset : offset + 16]), offset + 16
+    if address_type == ATYP_DOMAIN:
+        length = b[offset]
+        offset += 1
+        return address_type, b[offset : offset + length].decode("utf-8"), offset + length
+    raise DecryptError(f"未知的地址类型{address_type}")
+
+
+def _encode_payload(payload: dict) -> Tuple[int, bytes]:
+    """将常用的负载编码为紧凑的二进制格式，其他的负载使用JSON"""
+    keys = payload.keys()
+    try:
+        if (
+            keys == {"ip", "domain", "port"} or keys == {"ip", "domain", "port", "user"}
+        ) and not (payload["ip"] and payload["domain"]):
+            # 目标地址，IP和域名只会有一个
+            address = payload["ip"] or payload["domain"]
+            body = pack_address(address, not payload["ip"]) + PORT.pack(payload["port"])
+            if "user" not in payload:
+                return KIND_CONNECT, body
+            user = payload["user"].encode("utf-8")
+            if len(user) > 255:
+                raise ValueError("用户名过长")
+            return KIND_CONNECT_USER, body + bytes((len(user),)) + user
+
+        if keys == {"bind_address", "bind_port"}:
+            address = payload["bind_address"]
+            return KIND_REPLY, (
+                pack_address(address, not address) + PORT.pack(payload["bind_port"])
+            )
+    except (ValueError, TypeError):
+        pass
+
+    return KIND_JSON, json.dumps(payload).encode("utf-8")
+
+
+def _decode_payload(kind: int, b: bytes, offset: int) -> dict:
+    if kind == KIND_CONNECT or kind == KIND_CONNECT_USER:
+        address_type, address, offset = unpack_address(b, offset)
+        is_domain = address_type == ATYP_DOMAIN
+        rtn = {
+            "ip": "" if is_domain else address,
+            "domain": address if is_domain else "",
+            "port": PORT.unpack_from(b, offset)[0],
+        }
+        if kind == KIND_CONNECT_USER:
+            offset += PORT.size
+            end = offset + 1 + b[offset]
+            rtn["user"] = b[offset + 1 : end].decode("utf-8")
+        return rtn
+
+    if kind == KIND_REPLY:
+        _, address, offset = unpack_address(b, offset)
+        return {"bind_address": address, "bind_port": PORT.unpack_from(b, offset)[0]}
+
+    if kind == KIND_JSON:
+        return json.loads(b[offset:].decode("utf-8"))
+
+    raise DecryptError(f"未知的负载类型{kind}")
+
+
+async def read_block(reader: asyncio.StreamReader, header: bytes = b"") -> bytes:
+    """从流中读取一个完整的区块，不会多读取后续的数据
+
+    header: 可选，调用者已经读取的区块头
+    """
+    if not header:
+        header = await reader.readexactly(BLOCK_HEADER.size)
+    _, length = BLOCK_HEADER.unpack(header)
+    return header + await reader.readexactly(length)
+
+
 class Block:
     """安全区块"""
 
-    __slots__ = "uuid", "key", "payload", "timestamp", "_crypto"
+    __slots__ = "uuid", "key", "payload", "timestamp", "version"
 
     @classmethod
     def from_bytes(cls, key: Key, b: bytes) -> "Block":
-        """解密字节串并转换为Block对象
+        """解密字节串并转换为Block对象，根据版本号选择解析格式
 
         Args:
             key (Key): 加密密钥
@@ -87,36 +278,70 @@ class Block:
         Raises:
             DecryptError: 解密错误，解密失败
         """
-        crypto = Crypto(key.key_bytes)
-        rebuild_dict = json.loads(crypto.decrypt(b).decode("utf-8"))
-        vTime = rebuild_dict["timestamp"] - int(time.time())  # 验证时间是否大于10秒
+        if len(b) < BLOCK_HEADER.size:
+            raise DecryptError("区块长度错误")
+        version, length = BLOCK_HEADER.unpack_from(b)
+        if length != len(b) - BLOCK_HEADER.size:
+            raise DecryptError("区块长度错误")
+
+        rtn = cls(key, {}, version=version)  # 创建空的Block对象
+
+        if version == BLOCK_VERSION_BINARY:
+            nonce_end = BLOCK_HEADER.size + NONCE_SIZE
+            nonce = b[BLOCK_HEADER.size : nonce_end]
+            plain = _open(key, b[: BLOCK_HEADER.size], nonce, b[nonce_end:])
+            try:
+                kind, rtn.timestamp = BINARY_HEAD.unpack_from(plain)
+                rtn.payload = _decode_payload(kind, plain, BINARY_HEAD.size)
+            except (IndexError, ValueError, StructError) as error:
+                raise DecryptError(f"区块内容错误 {error}")
+            rtn.uuid = nonce.hex()
+
+        elif version == BLOCK_VERSION_JSON:
+            rebuild_dict = json.loads(
+                key.crypto.decrypt(b[BLOCK_HEADER.size :]).decode("utf-8")
+            )
+            rtn.uuid = rebuild_dict["uuid"]  # 强制重载
+            rtn.payload = rebuild_dict["payload"]  # 强制重载
+            rtn.timestamp = rebuild_dict["timestamp"]
+
+        else:
+            raise DecryptError(f"不支持的区块版本{version}")
+
+        vTime = rtn.timestamp - int(time.time())  # 验证时间是否大于10秒
         if vTime >= 10:
             raise DecryptError("时间戳误差大于10秒")
 
-        rtn = cls(key, {})  # 创建空的Block对象
-        rtn.uuid = rebuild_dict["uuid"]  # 强制重载
-        rtn.payload = rebuild_dict["payload"]  # 强制重载
-        rtn.timestamp = rebuild_dict["timestamp"]
-
         return rtn
 
-    def __init__(self, key: Key, payload: dict = {}) -> None:
+    def __init__(
+        self, key: Key, payload: dict = {}, version: int = BLOCK_VERSION_BINARY
+    ) -> None:
         """安全区块构造函数"""
         super().__init__()
 
-        # 四个参数（简称ukpt）都会加密
-        self.uuid = uuid.uuid4().hex
-        self.key = key.key_string
+        self.uuid = None  # 在加密时生成
+        self.key = key
         self.payload = payload
         self.timestamp = int(time.time())
-        self._crypto = Crypto(key.key_bytes)
+        self.version = version
         pass
 
     @property
     def block_bytes(self) -> bytes:
-        """自我加密后，返回ukpt的字节串"""
-        rtn = self._crypto.encrypt(json.dumps(self.__ukpt).encode("utf-8"))
-        return rtn
+        """自我加密后，返回带版本号和长度的字节串"""
+        if self.version == BLOCK_VERSION_BINARY:
+            kind, body = _encode_payload(self.payload)
+            plain = BINARY_HEAD.pack(kind, self.timestamp) + body
+            nonce = os.urandom(NONCE_SIZE)
+            self.uuid = nonce.hex()
+            header = BLOCK_HEADER.pack(self.version, NONCE_SIZE + len(plain) + TAG_SIZE)
+            return header + nonce + _seal(self.key, header, nonce, plain)
+
+        if self.uuid is None:
+            self.uuid = uuid.uuid4().hex
+        rtn = self.key.crypto.encrypt(json.dumps(self.__ukpt).encode("utf-8"))
+        return BLOCK_HEADER.pack(self.version, len(rtn)) + rtn
 
     def __enter__(self) -> "Block":
         """返回自身"""
@@ -131,7 +356,7 @@ class Block:
         # ukpt取首字母
         return {
             "uuid": self.uuid,
-            "key": self.key,
+            "key": self.key.key_string,
             "payload": self.payload,
             "timestamp": self.timestamp,
         }
@@ -146,9 +371,10 @@ class DecryptError(Exception):
 def test():
     key = Key()
     LOG.info(key.key_bytes)
-    blk = Block(key, {"a": 1})
-    print(blk.block_bytes)
-    Block.from_bytes(key, blk.block_bytes)
+    for version in (BLOCK_VERSION_JSON, BLOCK_VERSION_BINARY):
+        blk = Block(key, {"ip": "", "domain": "www.example.com", "port": 443}, version)
+        print(blk.block_bytes)
+        assert Block.from_bytes(key, blk.block_bytes).payload == blk.payload
     pass
 
 
@@ -1,32 +1,79 @@
 # coding: utf-8
 import asyncio
 import socket
-import ssl
 import os
-from safe_block import Block, DecryptError
+import time
+from typing import Tuple
+from safe_block import (
+    Block,
+    DecryptError,
+    read_block,
+    BLOCK_HEADER,
+    BLOCK_VERSION_BINARY,
+)
 from xybase import StreamBase
+from mux import MuxSession, MuxStream, MUX_VERSION
+from tls import ServerContext, ticket_secret
+from resolver import Resolver
+from sockopt import SocketOptions
+from udp import ServerAssociation, UDP_VERSION
+import connector
+import metrics
+import xylog
+from xylog import DEBUG, ERROR, INFO, WARNING
+from gc_policy import GCPolicy, install as install_gc_policy
 from aisle import SyncLogger
 from config_parse import PyxyConfig
 
 
+def connect_failure(error: Exception) -> str:
+    """连接目标失败的原因，用作指标的标签"""
+    if isinstance(error, socket.gaierror):
+        return "dns"
+    if isinstance(error, ConnectionRefusedError):
+        return "refused"
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError)):
+        return "timeout"
+    if isinstance(error, OSError):
+        return "os"
+    return "connect"
+
+
 class Server(StreamBase):
     """服务器对象"""
 
     def __init__(self, config: PyxyConfig, name: str = None):
         self.key_string = config.general["key"]
         super().__init__(self.key_string)
+        xylog.configure(config.general)
         self.config = config.server
+        self.configure_relay(config.general)
         self.logger.name = str(os.getpid())
         if name:
             self.logger = self.logger.get_child(suffix=name)
         # 获取安全环境
-        self.safe_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        self.safe_context.load_cert_chain(
-            certfile=self.config["crt_file"], keyfile=self.config["key_file"]
-        )
+        self.safe_context = ServerContext(self.config, ticket_secret())
+        for warning in self.safe_context.warnings:
+            self.logger.warning(warning)
 
         # You can load your own cert and key files here.
 
+        # 监听、接受和连接目标的套接字选项
+        self.socket_options = SocketOptions(self.config)
+        for warning in self.socket_options.warnings:
+            self.logger.warning(warning)
+
+        # 异步DNS解析
+        self.resolver = Resolver(
+            self.logger.get_child("dns"),
+            size=self.config["dns_cache_size"],
+            ttl=self.config["dns_cache_ttl"],
+            cache_file=self.config["dns_cache_file"],
+        )
+
+        # 垃圾回收策略，在服务启动后生效
+        self.gc_policy = GCPolicy(config.general, self.logger.get_child("gc"))
+
     async def start(self):
         """异步入口函数
 
@@ -41,16 +88,35 @@ class Server(StreamBase):
             self.handler,
             self.config["ipv4_address"],
             self.config["port"],
-            # limit=4096,  # 创建的流的缓冲大小
+            limit=self.stream_limit,  # 创建的流的缓冲大小
             ssl=self.safe_context,
             backlog=self.config["backlog"],
             reuse_port=True,
         )
+        for sock in server.sockets:
+            self.socket_options.listen(sock)
         self.logger.warning(
             f"Server starting at {self.config['ipv4_address']}:{self.config['port']}"
         )
-        async with server:
-            await server.serve_forever()
+        self.logger.info(
+            f"Listen socket options > {self.socket_options.describe(server.sockets[0])}"
+        )
+        self.logger.info(f"Target socket options > {self.socket_options.describe()}")
+        self.__register_metrics()
+        await metrics.serve(
+            self.config["metrics_address"], self.config["metrics_port"], self.logger
+        )
+        self.safe_context.rotate()
+        self.resolver.load()
+        install_gc_policy(self.gc_policy)
+        self.__report()
+        metrics.report_status()
+        await self.serve_until_stopped(server)
+
+        # 退出前保存DNS缓存
+        saving = self.resolver.save()
+        if saving is not None:
+            await saving
 
     @StreamBase.handlerDeco
     async def handler(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
@@ -58,100 +124,360 @@ class Server(StreamBase):
 
         request_id = self.total_conn_count
         logger = self.logger.get_child(f"{request_id}")
+        self.safe_context.record(writer.get_extra_info("ssl_object"))
+        self.socket_options.apply(writer.get_extra_info("socket"))
         # 请求处理主体
 
+        # 预协商失败时不主动关闭连接，由握手超时回收
+        # 客户端连接池中的连接在使用之前保持空闲，收到区块头之后才开始计算握手超时
+        handshake = self.watch_handshake(writer, timeout=self.block_wait_timeout)
+        try:
+            header = await reader.readexactly(BLOCK_HEADER.size)
+        except asyncio.IncompleteReadError as error:
+            if error.partial:
+                logger.event("failure", WARNING, "Protocol fail > {} {}", type(error), error)
+                metrics.CONNECTIONS_FAILED.labels("protocol").inc()
+                handshake.reset(self.handshake_timeout)
+            else:
+                # 客户端关闭了连接池中过期的连接，不是错误
+                logger.event("connection", DEBUG, "连接在预协商之前关闭")
+                handshake.cancel()
+                writer.close()
+            return
+        handshake.reset(self.handshake_timeout)
+
         # 1. 预协商
         try:
-            true_ip, true_domain, true_port = await self.__exchange_block(
-                reader, writer
+            request = await self.__exchange_block(reader, writer, header=header)
+            payload = request.payload
+            if payload.get("mux"):
+                handshake.cancel()
+                await self.__mux_session(reader, writer, request, logger)
+                return
+            if payload.get("udp"):
+                handshake.cancel()
+                await self.__udp_session(reader, writer, request, logger)
+                return
+
+            true_ip = payload["ip"]
+            true_domain = payload["domain"]
+            true_port = payload["port"]
+            logger.event(
+                "request", INFO, "Get request > {}|{}:{}", true_ip, true_domain, true_port
             )
-            logger.info(f"Get request > {true_ip}|{true_domain}:{true_port}")
         except Exception as err:
-            logger.warning(f"Protocol fail > {type(err)} {err}")
+            logger.event("failure", WARNING, "Protocol fail > {} {}", type(err), err)
+            metrics.CONNECTIONS_FAILED.labels("protocol").inc()
             return
 
-        # 2. 格式化目标地址
-        if (not true_ip) and (not true_domain):
-            logger.error("NO IP OR DOMAIN")
+        # 2. 尝试建立真实连接
+        try:
+            true_reader, true_writer = await self.__open_target(
+                true_ip, true_domain, true_port, logger
+            )
+
+            bind_address, bind_port = true_writer.get_extra_info("sockname")[:2]
+
+        except Exception as error:
+            logger.event(
+                "failure", WARNING, "Unexpected error > {}:{}", type(error), error
+            )
+            metrics.CONNECTIONS_FAILED.labels(connect_failure(error)).inc()
+            # 空的绑定地址告知客户端连接失败，之后直接关闭连接
+            handshake.cancel()
+            await self.__exchange_block(
+                reader, writer, {"bind_address": "", "bind_port": 0}, request.version
+            )
+            writer.close()
             return
 
-        if true_domain:
-            true_ip = socket.gethostbyname(true_domain)
-        logger.info(f"Start true connect > {true_ip}|{true_domain}:{true_port}")
+        await self.__exchange_block(
+            reader,
+            writer,
+            {"bind_address": bind_address, "bind_port": bind_port},
+            request.version,
+        )
+
+        # 3. 开始转发
+        handshake.cancel()
+        await self.__relay(
+            reader,
+            writer,
+            true_reader,
+            true_writer,
+            self.__user(payload, writer),
+            true_domain or true_ip,
+            logger,
+        )
+
+    @StreamBase.handlerDeco
+    async def mux_stream_handler(self, stream: MuxStream, payload: dict):
+        """处理多路复用连接中的一个逻辑流，捕获所有的异常"""
+
+        request_id = self.total_conn_count
+        logger = self.logger.get_child(f"{request_id}")
+        handshake = self.watch_handshake(stream)
+
+        if payload.get("udp"):
+            handshake.cancel()
+            association = await self.__udp_open(logger)
+            if association is None:
+                stream.close()
+                return
+            stream.reply(*association.sockname)
+            association.attach(stream, stream)
+            await association.run()
+            logger.event("connection", DEBUG, "UDP association end")
+            return
 
-        # 3. 尝试建立真实连接
-        bind_address, bind_port = "", 0
         try:
-            true_reader, true_writer = await asyncio.open_connection(true_ip, true_port)
+            true_ip = payload["ip"]
+            true_domain = payload["domain"]
+            true_port = payload["port"]
+            logger.event(
+                "request",
+                INFO,
+                "Get mux request > {}|{}:{}",
+                true_ip,
+                true_domain,
+                true_port,
+            )
 
-            bind_address, bind_port = true_writer.get_extra_info("sockname")
+            true_reader, true_writer = await self.__open_target(
+                true_ip, true_domain, true_port, logger
+            )
+            bind_address, bind_port = true_writer.get_extra_info("sockname")[:2]
 
         except Exception as error:
-            logger.warning(f"Unexpected error > {type(error)}:{error}")
-            raise error
+            logger.event(
+                "failure", WARNING, "Unexpected error > {}:{}", type(error), error
+            )
+            metrics.CONNECTIONS_FAILED.labels(connect_failure(error)).inc()
+            stream.close()
+            return
 
         finally:
+            handshake.cancel()
+
+        stream.reply(bind_address, bind_port)
+        await self.__relay(
+            stream,
+            stream,
+            true_reader,
+            true_writer,
+            self.__user(payload, stream),
+            true_domain or true_ip,
+            logger,
+        )
+
+    def __register_metrics(self):
+        """输出TLS会话恢复和DNS缓存的统计"""
+        context, resolver = self.safe_context, self.resolver
+        metrics.REGISTRY.callback(
+            "pyxy_tls_handshakes_total",
+            "按类型统计的TLS握手次数",
+            lambda: [
+                ({"type": "resumed"}, context.resumed),
+                ({"type": "full"}, context.full),
+            ],
+            kind="counter",
+        )
+        metrics.REGISTRY.callback(
+            "pyxy_dns_lookups_total",
+            "按结果统计的DNS解析请求数",
+            lambda: [
+                ({"result": "hit"}, resolver.hits),
+                ({"result": "miss"}, resolver.misses),
+                ({"result": "coalesced"}, resolver.coalesced),
+            ],
+            kind="counter",
+        )
+        metrics.REGISTRY.callback(
+            "pyxy_dns_cache_entries", "DNS缓存的域名数量", lambda: len(resolver.cache)
+        )
+
+    def __report(self):
+        """定期输出本worker的TLS会话恢复率和DNS缓存状态，并在线程池中保存DNS缓存"""
+        self.safe_context.report(self.logger)
+        self.resolver.report(self.logger)
+        self.resolver.save()
+        asyncio.get_running_loop().call_later(60, self.__report)
+
+    async def __mux_session(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        request: Block,
+        logger: SyncLogger,
+    ):
+        """在一条连接上处理多路复用的逻辑流，直到连接断开"""
+        await self.__exchange_block(
+            reader, writer, {"mux": MUX_VERSION}, request.version
+        )
+        logger.info("Mux session start")
+
+        session = MuxSession(reader, writer, logger, on_open=self.mux_stream_handler)
+        await session.run()
+
+        await self.try_close(writer)
+        logger.info("Mux session end")
+
+    async def __udp_session(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        request: Block,
+        logger: SyncLogger,
+    ):
+        """整条连接用于一个UDP关联，直到连接断开或者空闲超时"""
+        association = await self.__udp_open(logger)
+        if association is None:
+            await self.try_close(writer)
+            return
+        try:
             await self.__exchange_block(
-                reader,
-                writer,
-                {"bind_address": bind_address, "bind_port": bind_port},
+                reader, writer, {"udp": UDP_VERSION}, request.version
             )
+        except Exception:
+            association.close()
+            raise
+        association.attach(reader, writer)
+        await association.run()
+        await self.try_close(writer)
+        logger.event("connection", DEBUG, "UDP association end")
+
+    async def __udp_open(self, logger: SyncLogger) -> ServerAssociation:
+        """打开UDP关联的套接字，失败时返回None"""
+        logger.event("request", INFO, "Get UDP associate request")
+        association = ServerAssociation(self.resolver, logger, self.udp_idle_timeout)
+        try:
+            await association.open()
+        except OSError as error:
+            logger.event("failure", WARNING, "UDP socket fail > {}", error)
+            metrics.CONNECTIONS_FAILED.labels("os").inc()
+            association.close()
+            return None
+        return association
+
+    async def __open_target(
+        self, true_ip: str, true_domain: str, true_port: int, logger: SyncLogger
+    ) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """格式化目标地址并建立真实连接"""
+        if (not true_ip) and (not true_domain):
+            raise ValueError("NO IP OR DOMAIN")
 
-        # 4. 开始转发
+        start = time.perf_counter()
+        if true_domain:
+            addresses = await self.resolver.resolve(true_domain)
+        else:
+            addresses = [true_ip]
+        logger.event(
+            "request",
+            INFO,
+            "Start true connect > {}|{}:{}",
+            addresses,
+            true_domain,
+            true_port,
+        )
+
+        rtn = await connector.open_connection(
+            addresses,
+            true_port,
+            self.config["happy_eyeballs_delay"],
+            limit=self.stream_limit,
+            options=self.socket_options,
+        )
+        metrics.TARGET_CONNECT.observe(metrics.elapsed(start))
+        return rtn
+
+    @staticmethod
+    def __user(payload: dict, writer: asyncio.StreamWriter) -> str:
+        """带宽限制使用的用户，即客户端传来的Socks用户名，旧版本的客户端不传用户名时按客户端的IP地址区分"""
+        user = payload.get("user")
+        if user:
+            return str(user)
+        peer = writer.get_extra_info("peername")
+        return peer[0] if peer else ""
+
+    async def __relay(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        true_reader: asyncio.StreamReader,
+        true_writer: asyncio.StreamWriter,
+        user: str,
+        destination: str,
+        logger: SyncLogger,
+    ):
+        """转发数据直到任意一方关闭，user和destination为带宽限制使用的用户和目标"""
         try:
-            await self.exchange_stream(reader, writer, true_reader, true_writer)
+            await self.exchange_stream(
+                reader,
+                writer,
+                true_reader,
+                true_writer,
+                self.limiters_for(user, destination),
+            )
 
         # 第一步之后的异常处理
         except socket.gaierror as error:
-            logger.error(f"DNS failure > {error}")
+            logger.event("failure", ERROR, "DNS failure > {}", error)
+            metrics.CONNECTIONS_FAILED.labels("dns").inc()
 
         except ConnectionResetError as error:
-            logger.warning(f"Connection Reset > {error}")
+            logger.event("failure", WARNING, "Connection Reset > {}", error)
+            metrics.CONNECTIONS_FAILED.labels("reset").inc()
             return
         except ConnectionRefusedError as error:
-            logger.warning(f"Connection Refused > {error}")
+            logger.event("failure", WARNING, "Connection Refused > {}", error)
+            metrics.CONNECTIONS_FAILED.labels("refused").inc()
 
         except TimeoutError as error:
-            logger.warning(f"Connection timeout > {error}")
+            logger.event("failure", WARNING, "Connection timeout > {}", error)
+            metrics.CONNECTIONS_FAILED.labels("timeout").inc()
 
         except OSError as error:
-            logger.warning(f"System fail connection > {error}")
+            logger.event("failure", WARNING, "System fail connection > {}", error)
+            metrics.CONNECTIONS_FAILED.labels("os").inc()
 
         except Exception as error:
-            logger.error(f"Unknown error > {type(error)} {error}")
+            logger.event("failure", ERROR, "Unknown error > {} {}", type(error), error)
+            metrics.CONNECTIONS_FAILED.labels("unknown").inc()
 
         finally:
             await asyncio.gather(self.try_close(true_writer), self.try_close(writer))
 
             # 收尾工作
-            logger.debug("Request Handle End")
+            logger.event("connection", DEBUG, "Request Handle End")
 
     async def __exchange_block(
         self,
         reader: asyncio.StreamReader,
         writer: asyncio.StreamWriter,
         payload: dict = None,
-    ):
-        """远程的连接预协商"""
+        version: int = BLOCK_VERSION_BINARY,
+        header: bytes = b"",
+    ) -> Block:
+        """远程的连接预协商
+
+        接收时返回客户端发来的区块，发送时使用和客户端相同的区块版本
+        header: 接收时已经读取的区块头
+        """
         if payload:
             # 发送
-            request = Block(self.key, payload)
-            writer.write(request.block_bytes)
+            response = Block(self.key, payload, version)
+            writer.write(response.block_bytes)
             await writer.drain()
             return
 
         else:
             # 接收
             try:
-                response = await reader.read(4096)  # TODO: 引入超时
+                response = await read_block(reader, header)  # 超时由handler的握手超时处理
                 block = Block.from_bytes(self.key, response)
-                true_ip = block.payload["ip"]
-                true_domain = block.payload["domain"]
-                true_port = block.payload["port"]
-                # self.logger.debug(f'收到客户端请求 {trueDomain} | {trueIp}: \
-                # {truePort}')
+                # self.logger.debug(f'收到客户端请求 {block.payload}')
 
-                return true_ip, true_domain, true_port
+                return block
 
             except DecryptError as error:
                 # self.logger.error(f'解密失败, {e}')
@@ -171,5 +497,4 @@ if __name__ == "__main__":
 
     serverIPv4 = Server(config)
     serverIPv6 = Server(config)
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(serverIPv4.start())
+    asyncio.run(serverIPv4.start())
@@ -0,0 +1,197 @@
+"""
+Filename: shaper.py
+
+令牌桶带宽限制
+
+每个限制对应一个令牌桶，令牌在使用时按经过的时间补充，不需要定时器。
+连接每转发一段数据就从经过的所有桶中扣除令牌，令牌可以透支，透支后暂停读取直到令牌恢复，
+由TCP的流量控制让对端减速。一个桶只有在有连接等待时才设置一个定时器，到期时唤醒所有等待的连接，
+被唤醒的连接各自再转发一段后重新扣除令牌。每段数据不超过ROUND秒的数据量除以使用该桶的连接数，
+因此受同一个限制的活动连接按轮次交替转发，平分带宽，交互式连接最多等待大约一轮
+"""
+import asyncio
+import functools
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+MIN_SHARE = 4096  # 每段数据的最小字节数，避免连接很多时读取过于零碎
+ROUND = 0.02  # 所有活动连接各转发一段的时长，单位秒
+MIN_INTERVAL = 0.005  # 唤醒的最小间隔，同一时间段内的透支合并为一次唤醒
+
+
+class TokenBucket:
+    """令牌桶
+
+    rate: 每秒补充的令牌数，即字节数
+    burst: 桶的容量，空闲之后最多可以突发的字节数
+    table, key: 所在的字典和键，没有连接使用时从字典中移除
+    """
+
+    __slots__ = (
+        "rate",
+        "burst",
+        "tokens",
+        "stamp",
+        "active",
+        "waiters",
+        "handle",
+        "table",
+        "key",
+    )
+
+    def __init__(
+        self, rate: float, burst: float, table: Dict = None, key: str = None
+    ) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.active = 0  # 使用该桶的连接方向数
+        self.waiters: List[Callable[[], None]] = []
+        self.handle: Optional[asyncio.TimerHandle] = None
+        self.table = table
+        self.key = key
+
+    def refill(self, now: float) -> float:
+        """按经过的时间补充令牌，返回当前的令牌数"""
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        self.tokens = tokens if tokens < self.burst else self.burst
+        self.stamp = now
+        return self.tokens
+
+    def share(self) -> int:
+        """每个连接一次可以转发的字节数"""
+        return max(MIN_SHARE, int(self.rate * ROUND) // (self.active or 1))
+
+    def wait(self, callback: Callable[[], None]) -> None:
+        """令牌恢复为非负时调用callback"""
+        self.waiters.append(callback)
+        if self.handle is None:
+            self.__schedule(time.monotonic())
+
+    def __schedule(self, now: float) -> None:
+        delay = max(-self.refill(now) / self.rate, MIN_INTERVAL)
+        self.handle = asyncio.get_running_loop().call_later(delay, self.__wakeup)
+
+    def __wakeup(self) -> None:
+        self.handle = None
+        now = time.monotonic()
+        if self.refill(now) < 0:
+            # 等待期间其他连接又透支了令牌
+            self.__schedule(now)
+            return
+        waiters, self.waiters = self.waiters, []
+        for callback in waiters:
+            callback()
+
+    def release(self) -> None:
+        self.active -= 1
+        if self.active <= 0 and self.table is not None:
+            self.table.pop(self.key, None)
+
+
+def _wake(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class Limiter:
+    """一个连接的一个方向经过的令牌桶"""
+
+    __slots__ = ("buckets",)
+
+    def __init__(self, buckets: Tuple[TokenBucket, ...]) -> None:
+        self.buckets = buckets
+        for bucket in buckets:
+            bucket.active += 1
+
+    def share(self) -> int:
+        return min(bucket.share() for bucket in self.buckets)
+
+    def charge(self, n: int) -> bool:
+        """扣除转发的字节数，返回是否可以继续读取"""
+        now = time.monotonic()
+        ready = True
+        for bucket in self.buckets:
+            bucket.refill(now)
+            bucket.tokens -= n
+            if bucket.tokens < 0:
+                ready = False
+        return ready
+
+    def wait(self, callback: Callable[[], None]) -> None:
+        """在透支最多的桶上等待，其他桶可能仍在透支，唤醒后先转发一段，透支在之后的等待中偿还
+
+        唤醒后不再检查令牌，否则同一轮被唤醒的连接中只有第一个能够继续，其他的连接会一直排在它后面
+        """
+        bucket = min(self.buckets, key=lambda b: b.tokens / b.rate)
+        bucket.wait(callback)
+
+    async def throttle(self) -> None:
+        """协程中等待，见wait"""
+        future = asyncio.get_running_loop().create_future()
+        self.wait(functools.partial(_wake, future))
+        await future
+
+    def close(self) -> None:
+        for bucket in self.buckets:
+            bucket.release()
+
+
+class Shaper:
+    """按全局、用户和目标限制带宽，上传和下载分别计算
+
+    rate, user_rate, destination_rate: 每秒字节数，设置为0则不限制
+    burst: 令牌桶的容量，单位为秒，即允许突发该秒数的数据量
+    """
+
+    def __init__(
+        self,
+        rate: float = 0,
+        user_rate: float = 0,
+        destination_rate: float = 0,
+        burst: float = 0.5,
+    ) -> None:
+        self.rate = rate
+        self.user_rate = user_rate
+        self.destination_rate = destination_rate
+        self.burst = burst
+        # 上传和下载方向各一组
+        self.globals = tuple(TokenBucket(rate, rate * burst) for _ in range(2))
+        self.users: Tuple[Dict[str, TokenBucket], ...] = ({}, {})
+        self.destinations: Tuple[Dict[str, TokenBucket], ...] = ({}, {})
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.rate or self.user_rate or self.destination_rate)
+
+    def __bucket(self, table: Dict[str, TokenBucket], key: str, rate: float):
+        bucket = table.get(key)
+        if bucket is None:
+            bucket = table[key] = TokenBucket(rate, rate * self.burst, table, key)
+        return bucket
+
+    def limiters(
+        self, user: str, destination: str
+    ) -> Tuple[Optional[Limiter], Optional[Limiter]]:
+        """返回一个连接(上传, 下载)两个方向的限制，不限制时为None"""
+        if not self.enabled:
+            return None, None
+
+        rtn = []
+        for direction in range(2):
+            buckets = []
+            if self.rate:
+                buckets.append(self.globals[direction])
+            if self.user_rate and user:
+                buckets.append(
+                    self.__bucket(self.users[direction], user, self.user_rate)
+                )
+            if self.destination_rate and destination:
+                buckets.append(
+                    self.__bucket(
+                        self.destinations[direction], destination, self.destination_rate
+                    )
+                )
+            rtn.append(Limiter(tuple(buckets)) if buckets else None)
+        return rtn[0], rtn[1]
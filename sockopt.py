@@ -0,0 +1,164 @@
+"""
+Filename: sockopt.py
+
+TCP套接字选项
+
+服务端和客户端各自读取config.toml中对应部分的选项，统一应用于监听的套接字、接受的连接和主动发起的连接。
+启动时在一个探测套接字上逐项设置，系统不支持的选项记录在warnings中并且不再使用，
+之后每个连接只执行一组已经确认可用的setsockopt
+"""
+import socket
+import sys
+from typing import Dict, List, Optional, Tuple
+
+# Linux的TCP_FASTOPEN_CONNECT，Python的socket模块没有导出
+TCP_FASTOPEN_CONNECT = getattr(
+    socket, "TCP_FASTOPEN_CONNECT", 30 if sys.platform == "linux" else None
+)
+FASTOPEN_QUEUE = 256  # 监听套接字上等待完成握手的Fast Open请求数量
+CONGESTION_NAME_SIZE = 16  # Linux的TCP_CA_NAME_MAX
+
+# (名称, 协议层, 选项)，名称用于日志，系统不支持时选项为None
+Option = Tuple[str, int, Optional[int]]
+
+
+def _option(name: str, level: int, attribute: str) -> Option:
+    return name, level, getattr(socket, attribute, None)
+
+
+NODELAY = _option("nodelay", socket.IPPROTO_TCP, "TCP_NODELAY")
+KEEPALIVE = _option("keepalive", socket.SOL_SOCKET, "SO_KEEPALIVE")
+KEEPIDLE = _option("keepalive_idle", socket.IPPROTO_TCP, "TCP_KEEPIDLE")
+KEEPINTVL = _option("keepalive_interval", socket.IPPROTO_TCP, "TCP_KEEPINTVL")
+KEEPCNT = _option("keepalive_count", socket.IPPROTO_TCP, "TCP_KEEPCNT")
+SNDBUF = _option("send_buffer", socket.SOL_SOCKET, "SO_SNDBUF")
+RCVBUF = _option("receive_buffer", socket.SOL_SOCKET, "SO_RCVBUF")
+NOTSENT_LOWAT = _option("notsent_lowat", socket.IPPROTO_TCP, "TCP_NOTSENT_LOWAT")
+CONGESTION = _option("congestion", socket.IPPROTO_TCP, "TCP_CONGESTION")
+FASTOPEN = _option("fastopen", socket.IPPROTO_TCP, "TCP_FASTOPEN")
+FASTOPEN_CONNECT = ("fastopen_connect", socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT)
+
+
+class SocketOptions:
+    """一个角色的套接字选项
+
+    config: config.toml中服务端或者客户端的部分
+    fastopen_connect: 主动发起的连接是否使用Fast Open，
+        只用于客户端到服务端的连接，服务端连接目标时需要立即知道连接是否成功
+    """
+
+    __slots__ = "options", "listen_options", "connect_options", "warnings"
+
+    def __init__(self, config: dict, fastopen_connect: bool = False) -> None:
+        self.warnings: List[str] = []  # 不支持的选项，由调用者输出日志
+
+        options = [(NODELAY, int(config["tcp_nodelay"]))]
+        if config["keepalive_idle"] > 0:
+            options += [
+                (KEEPALIVE, 1),
+                (KEEPIDLE, config["keepalive_idle"]),
+                (KEEPINTVL, config["keepalive_interval"]),
+                (KEEPCNT, config["keepalive_count"]),
+            ]
+        if config["send_buffer"] > 0:
+            options.append((SNDBUF, config["send_buffer"]))
+        if config["receive_buffer"] > 0:
+            options.append((RCVBUF, config["receive_buffer"]))
+        if config["notsent_lowat"] > 0:
+            options.append((NOTSENT_LOWAT, config["notsent_lowat"]))
+        if config["congestion"]:
+            options.append((CONGESTION, config["congestion"].encode("ascii")))
+
+        listen_options, connect_options = [], []
+        if config["tcp_fastopen"]:
+            listen_options.append((FASTOPEN, FASTOPEN_QUEUE))
+            if fastopen_connect:
+                connect_options.append((FASTOPEN_CONNECT, 1))
+
+        self.options = self.__probe(options)
+        self.listen_options = self.__probe(listen_options)
+        self.connect_options = self.__probe(connect_options)
+
+    def __probe(self, options: list) -> Tuple[Tuple[int, int, object], ...]:
+        """在探测套接字上逐项设置，返回可用的(协议层, 选项, 值)"""
+        rtn = []
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+            for (name, level, optname), value in options:
+                if optname is None:
+                    self.warnings.append(f"系统不支持套接字选项{name}，已忽略")
+                    continue
+                try:
+                    probe.setsockopt(level, optname, value)
+                except OSError as error:
+                    self.warnings.append(f"无法设置套接字选项{name}={value!r} > {error}")
+                    continue
+                rtn.append((level, optname, value))
+        return tuple(rtn)
+
+    def apply(self, sock) -> None:
+        """应用于接受的连接或者已经建立的连接，连接已经断开时忽略"""
+        try:
+            for level, optname, value in self.options:
+                sock.setsockopt(level, optname, value)
+        except OSError:
+            pass
+
+    def listen(self, sock) -> None:
+        """应用于监听的套接字，接受的连接在Linux上会继承其中的大部分选项"""
+        for level, optname, value in self.options + self.listen_options:
+            sock.setsockopt(level, optname, value)
+
+    def socket(self, family: int) -> socket.socket:
+        """创建主动发起连接用的非阻塞套接字，在connect之前设置选项
+
+        缓冲区大小需要在握手之前设置才能影响窗口扩大因子
+        """
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.setblocking(False)
+            for level, optname, value in self.options + self.connect_options:
+                sock.setsockopt(level, optname, value)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    @staticmethod
+    def effective(sock) -> Dict[str, object]:
+        """读取套接字上实际生效的选项，内核可能会调整设置的值，例如缓冲区大小翻倍"""
+        rtn = {}
+        for name, level, optname in (
+            NODELAY,
+            KEEPALIVE,
+            KEEPIDLE,
+            KEEPINTVL,
+            KEEPCNT,
+            SNDBUF,
+            RCVBUF,
+            NOTSENT_LOWAT,
+            FASTOPEN,
+            FASTOPEN_CONNECT,
+        ):
+            if optname is None:
+                continue
+            try:
+                rtn[name] = sock.getsockopt(level, optname)
+            except OSError:
+                pass
+        name, level, optname = CONGESTION
+        if optname is not None:
+            try:
+                raw = sock.getsockopt(level, optname, CONGESTION_NAME_SIZE)
+                rtn[name] = raw.split(b"\0", 1)[0].decode("ascii")
+            except OSError:
+                pass
+        return rtn
+
+    def describe(self, sock=None) -> str:
+        """用于日志的实际生效值，sock为空时使用一个新建的主动连接套接字"""
+        if sock is not None:
+            values = self.effective(sock)
+        else:
+            with self.socket(socket.AF_INET) as probe:
+                values = self.effective(probe)
+        return " ".join(f"{name}={value}" for name, value in values.items())
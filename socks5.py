@@ -0,0 +1,188 @@
+"""
+Filename: socks5.py
+
+Socks5服务端的协商解析
+
+SocksParser是一个不做IO的状态机，每次传入已经收到的全部数据，一次解析尽可能多的阶段，
+返回需要回复给客户端的数据。客户端把认证和请求连在一起发送时，一次读取就能完成整个协商
+"""
+import socket
+from struct import Struct
+from typing import Tuple
+
+SOCKS_VERSION = 5
+AUTH_VERSION = 1  # 用户名密码认证的子协议版本
+METHOD_PASSWORD = 2  # 目前只兼容用户名密码方式
+NO_ACCEPTABLE_METHOD = 0xFF
+
+REQUEST_HEADER = Struct("!BBBB")  # 版本 | 命令 | 保留 | 地址类型
+PORT = Struct("!H")
+
+# 协商阶段
+GREETING, AUTH, REQUEST, DONE = range(4)
+
+
+class SocksError(Exception):
+    """Sock协议错误
+
+    reply: 关闭连接之前需要回复给客户端的数据
+    """
+
+    def __init__(self, msg: str = None, reply: bytes = b""):
+        super().__init__(msg)
+        self.message = msg
+        self.reply = reply
+
+    def __str__(self) -> str:
+        return f"SocksError: {self.message}"
+
+
+class SocksParser:
+    """Socks5协商的状态机
+
+    username, password: 允许的用户名和密码，按字节比较
+    协商完成后done为True，cmd, ip, domain, port为客户端的请求，
+    early为请求之后客户端提前发送的数据
+    """
+
+    __slots__ = (
+        "username",
+        "password",
+        "state",
+        "buffer",
+        "cmd",
+        "ip",
+        "domain",
+        "port",
+    )
+
+    def __init__(self, username: bytes, password: bytes) -> None:
+        self.username = username
+        self.password = password
+        self.state = GREETING
+        self.buffer = bytearray()  # 收到但还没有解析的数据
+        self.cmd = 0
+        self.ip = ""
+        self.domain = ""
+        self.port = 0
+
+    @property
+    def done(self) -> bool:
+        return self.state == DONE
+
+    @property
+    def early(self) -> bytes:
+        return bytes(self.buffer)
+
+    def feed(self, data: bytes) -> bytes:
+        """解析新收到的数据，返回需要回复的数据，数据不完整时返回已经能回复的部分
+
+        Raises:
+            SocksError: 协议错误或者身份验证失败，reply为需要回复的数据
+        """
+        self.buffer += data
+        reply = b""
+        while self.state != DONE:
+            # [RFC1928]
+            # https://www.quarkay.com/code/383/socks5-protocol-rfc-chinese-traslation
+            try:
+                if self.state == GREETING:
+                    consumed = self.__greeting()
+                elif self.state == AUTH:
+                    consumed = self.__auth()
+                else:
+                    consumed = self.__request()
+            except SocksError as error:
+                # 同一批数据中前面阶段的回复也要发出
+                error.reply = reply + error.reply
+                raise
+            if not consumed:
+                break  # 数据不完整，等待下一次读取
+            del self.buffer[:consumed]
+            if self.state == AUTH:
+                reply += bytes((SOCKS_VERSION, METHOD_PASSWORD))
+            elif self.state == REQUEST:
+                reply += bytes((AUTH_VERSION, 0))  # 0 表示正确
+        return reply
+
+    def __greeting(self) -> int:
+        buffer = self.buffer
+        if len(buffer) < 2:
+            return 0
+        version, nmethods = buffer[0], buffer[1]
+        if version != SOCKS_VERSION:
+            raise SocksError("不支持的Socks版本")
+        if nmethods == 0:
+            raise SocksError("Socks请求包协议头错误，认证方式的数量不能为0")
+        end = 2 + nmethods
+        if len(buffer) < end:
+            return 0
+        if METHOD_PASSWORD not in buffer[2:end]:
+            raise SocksError(
+                "不支持的身份验证方式", bytes((SOCKS_VERSION, NO_ACCEPTABLE_METHOD))
+            )
+        self.state = AUTH
+        return end
+
+    def __auth(self) -> int:
+        # [文档](https://www.jianshu.com/p/8001c40e5f83)
+        buffer = self.buffer
+        if len(buffer) < 2:
+            return 0
+        if buffer[0] != AUTH_VERSION:
+            raise SocksError("不支持的身份验证版本")
+        username_end = 2 + buffer[1]
+        if len(buffer) < username_end + 1:
+            return 0
+        password_end = username_end + 1 + buffer[username_end]
+        if len(buffer) < password_end:
+            return 0
+
+        if (
+            buffer[2:username_end] != self.username
+            or buffer[username_end + 1 : password_end] != self.password
+        ):
+            # !0 表示不正确
+            raise SocksError("身份验证失败", bytes((AUTH_VERSION, 0xFF)))
+        self.state = REQUEST
+        return password_end
+
+    def __request(self) -> int:
+        buffer = self.buffer
+        if len(buffer) < REQUEST_HEADER.size + 1:
+            return 0
+        version, cmd, _, address_type = REQUEST_HEADER.unpack_from(buffer)
+        if version != SOCKS_VERSION:
+            raise SocksError("不支持的Socks版本")
+
+        start = REQUEST_HEADER.size
+        if address_type == 1:  # IPv4
+            end = start + 4
+        elif address_type == 3:  # 域名
+            start += 1
+            end = start + buffer[start - 1]
+        elif address_type == 4:  # IPv6
+            end = start + 16
+        else:
+            raise SocksError(f"不支持的地址类型{address_type}")
+        if len(buffer) < end + PORT.size:
+            return 0
+
+        address = bytes(buffer[start:end])
+        if address_type == 1:
+            self.ip = socket.inet_ntoa(address)
+        elif address_type == 4:
+            self.ip = socket.inet_ntop(socket.AF_INET6, address)
+        else:
+            try:
+                self.domain = address.decode("utf-8")
+            except UnicodeDecodeError:
+                raise SocksError("目标域名不是有效的UTF-8")
+        self.cmd = cmd
+        self.port = PORT.unpack_from(buffer, end)[0]
+        self.state = DONE
+        return end + PORT.size
+
+    def result(self) -> Tuple[int, str, str, int]:
+        """返回 命令, 目标IP, 目标域名, 目标端口"""
+        return self.cmd, self.ip, self.domain, self.port
@@ -0,0 +1,155 @@
+"""
+Filename: timer.py
+
+哈希时间轮，统一管理所有连接的超时
+
+每个事件循环只有一个时间轮和一个定时器，连接活动时只更新最后活动时间，
+不需要为每次读取创建定时器
+"""
+import asyncio
+import math
+import weakref
+from typing import Any, Callable, List, Optional, Tuple
+
+TICK = 1.0  # 时间轮的精度，单位秒
+WHEEL_SIZE = 512  # 槽的数量，超出一圈的超时会在到期检查时重新放入
+
+
+class Deadline:
+    """时间轮中的一个超时项
+
+    超过timeout秒没有调用touch时，以args为参数调用callback，只调用一次。
+    timeout不大于0时不会触发
+    """
+
+    __slots__ = (
+        "wheel",
+        "timeout",
+        "last",
+        "due",
+        "callback",
+        "args",
+        "cancelled",
+        "expired",
+        "scheduled",
+    )
+
+    def __init__(
+        self,
+        wheel: "TimerWheel",
+        timeout: float,
+        callback: Callable[..., Any],
+        args: Tuple[Any, ...],
+    ) -> None:
+        self.wheel = wheel
+        self.timeout = timeout
+        self.last = wheel.now  # 最后活动时间
+        self.due = 0  # 所在槽的到期刻度
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.expired = False
+        self.scheduled = False  # 是否在时间轮中，只有在时间轮中的项计入count
+
+    def touch(self) -> None:
+        """记录一次活动，只更新时间戳"""
+        self.last = self.wheel.now
+
+    def reset(self, timeout: float) -> None:
+        """切换到新的超时时长，并重新开始计时"""
+        if self.cancelled or self.expired:
+            return
+        earlier = timeout > 0 and (self.timeout <= 0 or timeout < self.timeout)
+        self.timeout = timeout
+        self.last = self.wheel.now
+        if earlier:
+            # 原来的槽太晚或者不在时间轮中，放入更早的槽，原来的位置会在到期时被跳过
+            self.wheel.schedule(self, timeout)
+
+    def cancel(self) -> None:
+        if not self.cancelled and not self.expired:
+            self.cancelled = True
+            if self.scheduled:
+                self.scheduled = False
+                self.wheel.count -= 1
+
+
+class TimerWheel:
+    """哈希时间轮
+
+    每个刻度处理一个槽：已经超时的项触发回调，期间有过活动的项按剩余时间放入后面的槽。
+    没有任何超时项时停止计时
+    """
+
+    def __init__(self, tick: float = TICK, size: int = WHEEL_SIZE) -> None:
+        self.tick = tick
+        self.size = size
+        self.slots: List[List[Deadline]] = [[] for _ in range(size)]
+        self.cursor = 0  # 当前刻度
+        self.count = 0  # 在时间轮中的超时项数量
+        self.now = asyncio.get_running_loop().time()  # 最近一次刻度的时间
+        self._handle: Optional[asyncio.TimerHandle] = None
+
+    def watch(self, timeout: float, callback: Callable[..., Any], *args) -> Deadline:
+        """添加超时项"""
+        if self._handle is None:
+            self.now = asyncio.get_running_loop().time()
+        deadline = Deadline(self, timeout, callback, args)
+        if timeout > 0:
+            self.schedule(deadline, timeout)
+        return deadline
+
+    def schedule(self, deadline: Deadline, delay: float) -> None:
+        if not deadline.scheduled:
+            deadline.scheduled = True
+            self.count += 1
+        ticks = min(max(math.ceil(delay / self.tick), 1), self.size - 1)
+        deadline.due = self.cursor + ticks
+        self.slots[deadline.due % self.size].append(deadline)
+        if self._handle is None:
+            self._handle = asyncio.get_running_loop().call_later(
+                self.tick, self.__advance
+            )
+
+    def __advance(self) -> None:
+        loop = asyncio.get_running_loop()
+        self.now = loop.time()
+        self.cursor += 1
+        index = self.cursor % self.size
+        slot, self.slots[index] = self.slots[index], []
+
+        for deadline in slot:
+            if deadline.due != self.cursor or deadline.cancelled or deadline.expired:
+                continue
+            if deadline.timeout <= 0:
+                # 计时期间超时被关闭，移出时间轮
+                deadline.scheduled = False
+                self.count -= 1
+                continue
+            remaining = deadline.last + deadline.timeout - self.now
+            if remaining > 0:
+                self.schedule(deadline, remaining)
+            else:
+                deadline.expired = True
+                deadline.scheduled = False
+                self.count -= 1
+                loop.call_soon(deadline.callback, *deadline.args)
+
+        if self.count > 0:
+            self._handle = loop.call_later(self.tick, self.__advance)
+        else:
+            self._handle = None
+
+
+_wheels: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, TimerWheel]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_wheel() -> TimerWheel:
+    """返回当前事件循环的时间轮"""
+    loop = asyncio.get_running_loop()
+    wheel = _wheels.get(loop)
+    if wheel is None:
+        wheel = _wheels[loop] = TimerWheel()
+    return wheel
@@ -0,0 +1,380 @@
+"""
+Filename: tls.py
+
+TLS环境的构建和调优
+"""
+import asyncio
+import ctypes
+import hashlib
+import os
+import ssl
+import sys
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+import _ssl
+
+from aisle import SyncLogger
+
+# OpenSSL的SSL_CTX_callback_ctrl命令，Python的ssl模块没有暴露该接口
+SSL_CTRL_SET_TLSEXT_TICKET_KEY_CB = 72
+TICKET_NAME_SIZE = 16
+TICKET_SECRET_SIZE = 32  # HMAC-SHA256和AES-256的密钥长度
+TICKET_IV_SIZE = 16  # AES-256-CBC
+# supervisor通过该环境变量把票据密钥的种子传给所有服务端worker
+TICKET_SECRET_ENV = "PYXY_TICKET_SECRET"
+# 确认过PySSLContext内存布局的CPython版本范围，对象头之后紧跟SSL_CTX指针
+KNOWN_LAYOUT = ((3, 7), (3, 14))
+
+# int cb(SSL *s, unsigned char key_name[16], unsigned char *iv,
+#        EVP_CIPHER_CTX *ctx, HMAC_CTX *hctx, int enc)
+TicketKeyCallback = ctypes.CFUNCTYPE(
+    ctypes.c_int,
+    ctypes.c_void_p,
+    ctypes.c_void_p,
+    ctypes.c_void_p,
+    ctypes.c_void_p,
+    ctypes.c_void_p,
+    ctypes.c_int,
+)
+
+
+class _LibSSL:
+    """通过ctypes调用_ssl模块链接的libssl，仅在CPython上可用
+
+    SSL_CTX指针从SSLContext对象的内存中读取，依赖CPython内部的结构体布局，
+    只在确认过布局的版本上使用，并且读取后与ssl模块返回的选项核对，不一致时不使用
+    """
+
+    def __init__(self) -> None:
+        self.lib = None
+        self.tickets = False  # 是否可以设置会话票据密钥的回调
+        if sys.implementation.name != "cpython":
+            return
+        if not KNOWN_LAYOUT[0] <= sys.version_info[:2] < KNOWN_LAYOUT[1]:
+            return
+        if _ssl._SSLContext.__basicsize__ < object.__basicsize__ + ctypes.sizeof(
+            ctypes.c_void_p
+        ):
+            return
+        try:
+            lib = ctypes.CDLL(_ssl.__file__)
+            lib.SSL_CTX_get_options.restype = (
+                ctypes.c_uint64 if ssl.OPENSSL_VERSION_INFO >= (3,) else ctypes.c_ulong
+            )
+            lib.SSL_CTX_get_options.argtypes = [ctypes.c_void_p]
+            lib.SSL_CTX_set_ciphersuites.restype = ctypes.c_int
+            lib.SSL_CTX_set_ciphersuites.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+            self.lib = lib
+        except (OSError, AttributeError):
+            return
+        try:
+            lib.SSL_CTX_callback_ctrl.restype = ctypes.c_long
+            lib.SSL_CTX_callback_ctrl.argtypes = [
+                ctypes.c_void_p,
+                ctypes.c_int,
+                ctypes.c_void_p,
+            ]
+            lib.EVP_sha256.restype = ctypes.c_void_p
+            lib.EVP_sha256.argtypes = []
+            lib.EVP_aes_256_cbc.restype = ctypes.c_void_p
+            lib.EVP_aes_256_cbc.argtypes = []
+            lib.HMAC_Init_ex.restype = ctypes.c_int
+            lib.HMAC_Init_ex.argtypes = [
+                ctypes.c_void_p,
+                ctypes.c_char_p,
+                ctypes.c_int,
+                ctypes.c_void_p,
+                ctypes.c_void_p,
+            ]
+            for init in (lib.EVP_EncryptInit_ex, lib.EVP_DecryptInit_ex):
+                init.restype = ctypes.c_int
+                init.argtypes = [
+                    ctypes.c_void_p,
+                    ctypes.c_void_p,
+                    ctypes.c_void_p,
+                    ctypes.c_char_p,
+                    ctypes.c_void_p,
+                ]
+            self.tickets = True
+        except AttributeError:
+            pass  # libcrypto编译时去掉了已弃用的接口
+
+    def ctx_pointer(self, context: ssl.SSLContext) -> Optional[int]:
+        """PySSLContext结构体中紧跟对象头的就是SSL_CTX指针，核对失败时返回None"""
+        if self.lib is None:
+            return None
+        pointer = ctypes.c_void_p.from_address(id(context) + object.__basicsize__).value
+        if not pointer or self.lib.SSL_CTX_get_options(pointer) != int(context.options):
+            return None
+        return pointer
+
+    def set_ticket_key_callback(
+        self, context: ssl.SSLContext, callback: TicketKeyCallback
+    ) -> bool:
+        """设置会话票据密钥的回调，调用者需要保持callback的引用"""
+        pointer = self.ctx_pointer(context) if self.tickets else None
+        if pointer is None:
+            return False
+        return bool(
+            self.lib.SSL_CTX_callback_ctrl(
+                pointer,
+                SSL_CTRL_SET_TLSEXT_TICKET_KEY_CB,
+                ctypes.cast(callback, ctypes.c_void_p),
+            )
+        )
+
+    def init_ticket(
+        self,
+        cipher_ctx: int,
+        hmac_ctx: int,
+        hmac_key: bytes,
+        aes_key: bytes,
+        iv: int,
+        encrypt: bool,
+    ) -> bool:
+        """在回调中初始化票据的加密和HMAC上下文"""
+        init = self.lib.EVP_EncryptInit_ex if encrypt else self.lib.EVP_DecryptInit_ex
+        return bool(
+            self.lib.HMAC_Init_ex(
+                hmac_ctx, hmac_key, len(hmac_key), self.lib.EVP_sha256(), None
+            )
+        ) and bool(init(cipher_ctx, self.lib.EVP_aes_256_cbc(), None, aes_key, iv))
+
+    def set_ciphersuites(self, context: ssl.SSLContext, ciphersuites: str) -> bool:
+        pointer = self.ctx_pointer(context)
+        if pointer is None:
+            return False
+        return bool(
+            self.lib.SSL_CTX_set_ciphersuites(pointer, ciphersuites.encode("ascii"))
+        )
+
+
+LIBSSL = _LibSSL()
+
+
+class ResumableContext(ssl.SSLContext):
+    """可以复用TLS会话的客户端安全环境
+
+    同一个SockRelay的所有远程连接共享一个实例，缓存每个服务器最近的若干个会话，
+    新的连接优先恢复已缓存的会话（TLS1.3的会话票据或TLS1.2的会话ID），省去完整握手
+
+    cache_size: 每个服务器缓存的会话数量
+    ca_file: 可选，用于验证服务器证书的CA文件，为空则使用系统证书
+    """
+
+    def __new__(cls, cache_size: int = 8, ca_file: str = "", *args, **kwargs):
+        return super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+    def __init__(self, cache_size: int = 8, ca_file: str = "") -> None:
+        super().__init__()
+        self.minimum_version = ssl.TLSVersion.TLSv1_2
+        if ca_file:
+            self.load_verify_locations(cafile=ca_file)
+        else:
+            self.load_default_certs()
+
+        self.cache_size = cache_size
+        self.sessions: Dict[Optional[str], Deque[ssl.SSLSession]] = {}
+        self.resumed = 0  # 恢复会话的握手次数
+        self.full = 0  # 完整握手的次数
+
+    def wrap_bio(
+        self,
+        incoming: ssl.MemoryBIO,
+        outgoing: ssl.MemoryBIO,
+        server_side: bool = False,
+        server_hostname: str = None,
+        session: ssl.SSLSession = None,
+    ) -> ssl.SSLObject:
+        """asyncio通过该方法创建SSLObject，在这里注入缓存的会话"""
+        if session is None and not server_side:
+            cache = self.sessions.get(server_hostname)
+            if cache:
+                session = cache.pop()  # 会话票据只使用一次
+
+        return super().wrap_bio(
+            incoming,
+            outgoing,
+            server_side=server_side,
+            server_hostname=server_hostname,
+            session=session,
+        )
+
+    def record(self, ssl_object: Optional[ssl.SSLObject]) -> None:
+        """在连接收到服务器的数据之后调用，统计握手类型并缓存新的会话
+
+        TLS1.3的会话票据在握手完成之后才会到达，所以不能在握手结束时立即缓存
+        """
+        if ssl_object is None:
+            return
+
+        if ssl_object.session_reused:
+            self.resumed += 1
+        else:
+            self.full += 1
+
+        session = ssl_object.session
+        if session is None or self.cache_size <= 0:
+            return
+
+        cache = self.sessions.get(ssl_object.server_hostname)
+        if cache is None:
+            cache = self.sessions[ssl_object.server_hostname] = deque(
+                maxlen=self.cache_size
+            )
+        cache.append(session)
+
+
+def ticket_secret() -> bytes:
+    """服务端票据密钥的种子
+
+    多进程运行时由supervisor随机生成并通过环境变量传给所有worker，单独运行时随机生成。
+    种子只存在于服务端，不能由客户端也持有的general.key推导，否则任何客户端都能解密其他用户的票据
+    """
+    value = os.environ.get(TICKET_SECRET_ENV, "")
+    try:
+        secret = bytes.fromhex(value)
+    except ValueError:
+        secret = b""
+    return secret or os.urandom(TICKET_SECRET_SIZE)
+
+
+class ServerContext(ssl.SSLContext):
+    """服务端安全环境
+
+    从配置文件的[server]部分读取证书、密码套件和曲线，
+    会话票据密钥由服务端的种子和时间段推导，所有worker在同一时间段内使用相同的票据密钥，
+    因此reuse_port分配到任意worker的连接都可以恢复会话。
+    轮换后上一个时间段的密钥仍然用于解密，用它恢复的会话会换发当前密钥加密的新票据
+
+    config: 配置文件中的server部分
+    secret: 所有worker共享的票据密钥种子，见ticket_secret
+    """
+
+    def __new__(cls, config: Dict[str, Any], secret: bytes, *args, **kwargs):
+        return super().__new__(cls, ssl.PROTOCOL_TLS_SERVER)
+
+    def __init__(self, config: Dict[str, Any], secret: bytes) -> None:
+        super().__init__()
+        self.minimum_version = ssl.TLSVersion.TLSv1_2
+        self.secret = secret
+        self.rotation = config["ticket_rotation"]
+        self.resumed = 0  # 恢复会话的握手次数
+        self.full = 0  # 完整握手的次数
+        self.warnings = []  # 不支持的配置，由调用者输出日志
+
+        self.load_cert_chain(certfile=config["crt_file"], keyfile=config["key_file"])
+        if config["ecdsa_crt_file"]:
+            # OpenSSL为每种密钥类型保存一个证书，握手时根据客户端支持的签名算法选择
+            self.load_cert_chain(
+                certfile=config["ecdsa_crt_file"], keyfile=config["ecdsa_key_file"]
+            )
+
+        if config["ciphers"]:
+            self.set_ciphers(config["ciphers"])
+        if config["ciphersuites"]:
+            if not LIBSSL.set_ciphersuites(self, config["ciphersuites"]):
+                self.warnings.append("无法设置TLS1.3密码套件，使用默认值")
+        if config["ecdh_curve"]:
+            self.set_ecdh_curve(config["ecdh_curve"])
+
+        # 票据名称: (HMAC密钥, AES密钥)，包括当前和上一个时间段
+        self._ticket_keys: Dict[bytes, Tuple[bytes, bytes]] = {}
+        self._ticket_name = b""  # 当前时间段的票据名称，用于签发新的票据
+        self._ticket_callback: Optional[TicketKeyCallback] = None
+        if self.rotation > 0:
+            callback = TicketKeyCallback(self.__ticket_key)
+            if LIBSSL.set_ticket_key_callback(self, callback):
+                self._ticket_callback = callback  # 保持引用，否则回调会被回收
+            else:
+                self.warnings.append("无法设置会话票据密钥，worker之间不能恢复会话")
+        self._epoch = -1
+        self._rotate_handle: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def resumption_rate(self) -> float:
+        total = self.resumed + self.full
+        return self.resumed / total if total else 0.0
+
+    def ticket_keys(self, epoch: int) -> Tuple[bytes, bytes, bytes]:
+        """根据时间段推导票据的 名称, HMAC密钥, AES密钥"""
+        raw = hashlib.shake_256(
+            b"pyxy-ticket-key|" + self.secret + b"|" + str(epoch).encode("ascii")
+        ).digest(TICKET_NAME_SIZE + 2 * TICKET_SECRET_SIZE)
+        return (
+            raw[:TICKET_NAME_SIZE],
+            raw[TICKET_NAME_SIZE : TICKET_NAME_SIZE + TICKET_SECRET_SIZE],
+            raw[TICKET_NAME_SIZE + TICKET_SECRET_SIZE :],
+        )
+
+    def rotate(self) -> None:
+        """设置当前时间段的票据密钥，保留上一个时间段的密钥用于解密，并在下一个时间段开始时再次轮换"""
+        if self._ticket_callback is None:
+            return
+
+        now = time.time()
+        epoch = int(now // self.rotation)
+        if epoch != self._epoch:
+            current = self.ticket_keys(epoch)
+            previous = self.ticket_keys(epoch - 1)
+            self._ticket_keys = {
+                name: (hmac_key, aes_key) for name, hmac_key, aes_key in (current, previous)
+            }
+            self._ticket_name = current[0]
+            self._epoch = epoch
+
+        delay = (epoch + 1) * self.rotation - now
+        self._rotate_handle = asyncio.get_running_loop().call_later(delay, self.rotate)
+
+    def __ticket_key(
+        self,
+        ssl_pointer: int,
+        name_pointer: int,
+        iv_pointer: int,
+        cipher_ctx: int,
+        hmac_ctx: int,
+        encrypt: int,
+    ) -> int:
+        """OpenSSL的票据密钥回调，签发时使用当前的密钥，解密时按票据名称查找
+
+        返回1表示成功，2表示用上一个时间段的密钥解密成功、需要换发新票据，
+        0表示不签发票据或者找不到密钥（进行完整握手），-1表示错误
+        """
+        try:
+            if encrypt:
+                name = self._ticket_name
+                if not name:
+                    return 0
+                ctypes.memmove(name_pointer, name, TICKET_NAME_SIZE)
+                ctypes.memmove(iv_pointer, os.urandom(TICKET_IV_SIZE), TICKET_IV_SIZE)
+            else:
+                name = ctypes.string_at(name_pointer, TICKET_NAME_SIZE)
+                if name not in self._ticket_keys:
+                    return 0
+
+            hmac_key, aes_key = self._ticket_keys[name]
+            if not LIBSSL.init_ticket(
+                cipher_ctx, hmac_ctx, hmac_key, aes_key, iv_pointer, bool(encrypt)
+            ):
+                return -1
+            return 1 if encrypt or name == self._ticket_name else 2
+        except Exception:
+            return -1
+
+    def record(self, ssl_object: Optional[ssl.SSLObject]) -> None:
+        """统计握手类型"""
+        if ssl_object is None:
+            return
+        if ssl_object.session_reused:
+            self.resumed += 1
+        else:
+            self.full += 1
+
+    def report(self, logger: SyncLogger) -> None:
+        """输出本worker的会话恢复率"""
+        logger.info(
+            f"TLS会话恢复率 {self.resumption_rate:.1%} "
+            f"(恢复{self.resumed}次，完整握手{self.full}次)"
+        )
@@ -0,0 +1,295 @@
+"""
+Filename: udp.py
+
+Socks5 UDP ASSOCIATE的数据报转发
+
+一个UDP关联独占客户端和服务端之间的一条流（TLS连接或者多路复用的逻辑流），
+流中的每一帧是一个数据报: 长度(2字节) | 地址类型(1字节) | 地址 | 端口(2字节) | 数据
+地址和Socks5的UDP请求头相同，客户端发出时为目标地址，服务端发出时为数据报的来源地址。
+同一轮事件循环中收到的数据报合并为一次写入，减少TLS记录和多路复用帧的数量
+"""
+import abc
+import asyncio
+import socket
+from struct import Struct
+from typing import Dict, List, Optional, Set, Tuple
+
+import metrics
+from aisle import SyncLogger
+from resolver import Resolver
+from safe_block import ATYP_DOMAIN, PORT, DecryptError, pack_address, unpack_address
+from timer import Deadline, get_wheel
+
+UDP_VERSION = 1
+
+FRAME_HEADER = Struct("!H")
+MAX_FRAME = 65535  # 超过长度字段上限的数据报直接丢弃
+MAX_PENDING = 1048576  # 隧道来不及发送的数据超过该字节数时，丢弃新的数据报
+READ_SIZE = 65536
+
+SOCKS_UDP_HEADER = b"\0\0\0"  # 保留字段(2字节) | 分片序号(1字节)
+
+
+class DatagramTunnel:
+    """一个UDP关联在隧道中的一端
+
+    reader, writer: 隧道的流，可以是StreamReader/StreamWriter或者MuxStream
+    on_frame: 每收到一帧，以帧的内容（不含长度）为参数调用
+    deadline: 每次收发数据报时更新的空闲超时
+    """
+
+    __slots__ = ("reader", "writer", "on_frame", "deadline", "_batch", "_flushing")
+
+    def __init__(self, reader, writer, on_frame, deadline: Deadline) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.on_frame = on_frame
+        self.deadline = deadline
+        self._batch = bytearray()
+        self._flushing: Optional[asyncio.Future] = None
+
+    def send(self, body: bytes) -> None:
+        """把一个数据报加入待发送的批次，在下一轮事件循环中统一写入"""
+        if len(body) > MAX_FRAME:
+            metrics.UDP_DROPPED.labels("oversize").inc()
+            return
+        if len(self._batch) >= MAX_PENDING:
+            metrics.UDP_DROPPED.labels("tunnel").inc()
+            return
+        self._batch += FRAME_HEADER.pack(len(body))
+        self._batch += body
+        self.deadline.touch()
+        if self._flushing is None:
+            self._flushing = asyncio.ensure_future(self.__flush())
+
+    async def __flush(self) -> None:
+        try:
+            while self._batch and not self.writer.is_closing():
+                data, self._batch = self._batch, bytearray()
+                self.writer.write(bytes(data))
+                metrics.UDP_BATCHES.inc()
+                await self.writer.drain()
+        except (ConnectionError, OSError):
+            self.writer.close()
+        finally:
+            self._flushing = None
+
+    async def run(self) -> None:
+        """读取隧道中的帧，直到隧道关闭"""
+        buffer = bytearray()
+        while 1:
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                return
+            buffer += data
+            size = len(buffer)
+            offset = 0
+            while size - offset >= FRAME_HEADER.size:
+                end = offset + FRAME_HEADER.size + FRAME_HEADER.unpack_from(buffer, offset)[0]
+                if end > size:
+                    break
+                self.deadline.touch()
+                self.on_frame(bytes(buffer[offset + FRAME_HEADER.size : end]))
+                offset = end
+            del buffer[:offset]
+
+    def close(self) -> None:
+        if self._flushing is not None:
+            self._flushing.cancel()
+        self.writer.close()
+
+
+class Endpoint(asyncio.DatagramProtocol):
+    """本地的UDP套接字，把收到的数据报交给所属的关联"""
+
+    def __init__(self, association: "Association") -> None:
+        self.association = association
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        self.association.received(data, addr)
+
+    def error_received(self, exc: Exception) -> None:
+        # 目标端口不可达等ICMP错误，UDP本身不保证送达，忽略
+        metrics.UDP_DROPPED.labels("icmp").inc()
+
+
+class Association(abc.ABC):
+    """一个UDP关联，在UDP套接字和隧道之间转发数据报
+
+    idle_timeout: 两个方向都没有数据报超过该秒数时结束关联，设置为0则不限制
+    """
+
+    def __init__(self, logger: SyncLogger, idle_timeout: float) -> None:
+        self.logger = logger
+        self.idle_timeout = idle_timeout
+        self.transports: List[asyncio.DatagramTransport] = []
+        self.tunnel: Optional[DatagramTunnel] = None
+        self.deadline: Optional[Deadline] = None
+
+    async def bind(self, family: int, address: str) -> asyncio.DatagramTransport:
+        """打开一个UDP套接字，端口由系统分配"""
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: Endpoint(self), local_addr=(address, 0), family=family
+        )
+        self.transports.append(transport)
+        return transport
+
+    @property
+    def sockname(self) -> Tuple[str, int]:
+        """第一个UDP套接字的绑定地址"""
+        return self.transports[0].get_extra_info("sockname")[:2]
+
+    def attach(self, reader, writer) -> None:
+        """接上隧道，之后收到的数据报开始转发
+
+        客户端在回复Socks客户端之前调用，服务端在回复写入隧道之后调用，保证对端先收到回复再收到数据报
+        """
+        self.deadline = get_wheel().watch(self.idle_timeout, self.expired)
+        self.tunnel = DatagramTunnel(reader, writer, self.on_frame, self.deadline)
+
+    async def run(self) -> None:
+        """在隧道上转发，直到隧道关闭或者空闲超时"""
+        metrics.UDP_ASSOCIATIONS.inc()
+        try:
+            await self.tunnel.run()
+        finally:
+            metrics.UDP_ASSOCIATIONS.dec()
+            self.close()
+
+    def expired(self) -> None:
+        self.logger.info("UDP关联空闲超时")
+        metrics.CONNECTIONS_FAILED.labels("idle_timeout").inc()
+        self.close()
+
+    def close(self) -> None:
+        if self.deadline is not None:
+            self.deadline.cancel()
+        if self.tunnel is not None:
+            self.tunnel.close()
+        for transport in self.transports:
+            transport.close()
+        self.transports.clear()
+
+    @abc.abstractmethod
+    def received(self, data: bytes, addr: tuple) -> None:
+        """UDP套接字收到一个数据报"""
+
+    @abc.abstractmethod
+    def on_frame(self, body: bytes) -> None:
+        """隧道中收到一帧"""
+
+
+class ClientAssociation(Association):
+    """客户端的UDP关联，本地UDP端口和隧道之间转发
+
+    只接受来自Socks客户端地址的数据报，第一个数据报的来源端口作为回复的目的端口
+    """
+
+    def __init__(self, peer_address: str, logger: SyncLogger, idle_timeout: float):
+        super().__init__(logger, idle_timeout)
+        self.peer_address = peer_address
+        self.peer: Optional[tuple] = None
+        self.transport: Optional[asyncio.DatagramTransport] = None
+
+    async def open(self, address: str) -> Tuple[str, int]:
+        """在address上打开UDP端口，返回Socks响应中的绑定地址"""
+        family = socket.AF_INET6 if ":" in address else socket.AF_INET
+        self.transport = await self.bind(family, address)
+        return self.sockname
+
+    def received(self, data: bytes, addr: tuple) -> None:
+        if addr[0] != self.peer_address:
+            metrics.UDP_DROPPED.labels("source").inc()
+            return
+        if len(data) < 4 or data[2] != 0:
+            # 不支持分片，按RFC1928直接丢弃
+            metrics.UDP_DROPPED.labels("fragment").inc()
+            return
+        if self.tunnel is None:
+            return
+        self.peer = addr
+        metrics.UDP_UPLOAD.inc()
+        self.tunnel.send(data[3:])
+
+    def on_frame(self, body: bytes) -> None:
+        if self.peer is None or self.transport is None:
+            return
+        metrics.UDP_DOWNLOAD.inc()
+        self.transport.sendto(SOCKS_UDP_HEADER + body, self.peer)
+
+
+class ServerAssociation(Association):
+    """服务端的UDP关联，隧道和目标之间转发
+
+    IPv4和IPv6各使用一个UDP套接字，目标为域名时解析一次后缓存在关联中
+    """
+
+    def __init__(self, resolver: Resolver, logger: SyncLogger, idle_timeout: float):
+        super().__init__(logger, idle_timeout)
+        self.resolver = resolver
+        self.sockets: Dict[int, asyncio.DatagramTransport] = {}
+        self.domains: Dict[str, str] = {}
+        self.tasks: Set[asyncio.Task] = set()  # 事件循环只保存任务的弱引用
+
+    async def open(self) -> None:
+        self.sockets[socket.AF_INET] = await self.bind(socket.AF_INET, "0.0.0.0")
+        try:
+            self.sockets[socket.AF_INET6] = await self.bind(socket.AF_INET6, "::")
+        except OSError:
+            pass  # 系统不支持IPv6
+
+    def on_frame(self, body: bytes) -> None:
+        try:
+            address_type, host, offset = unpack_address(body, 0)
+            port = PORT.unpack_from(body, offset)[0]
+        except (DecryptError, ValueError, IndexError, UnicodeDecodeError, OSError):
+            metrics.UDP_DROPPED.labels("malformed").inc()
+            return
+        data = body[offset + PORT.size :]
+
+        if address_type == ATYP_DOMAIN:
+            ip = self.domains.get(host)
+            if ip is None:
+                task = asyncio.get_running_loop().create_task(
+                    self.__resolve_and_send(host, port, data)
+                )
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+                return
+            host = ip
+        self.sendto(data, host, port)
+
+    async def __resolve_and_send(self, domain: str, port: int, data: bytes) -> None:
+        try:
+            addresses = await self.resolver.resolve(domain)
+        except OSError as error:
+            self.logger.info(f"UDP目标解析失败 > {domain} {error}")
+            metrics.UDP_DROPPED.labels("dns").inc()
+            return
+        # 优先使用有可用套接字的地址族
+        for ip in addresses:
+            if (socket.AF_INET6 if ":" in ip else socket.AF_INET) in self.sockets:
+                self.domains[domain] = ip
+                self.sendto(data, ip, port)
+                return
+        metrics.UDP_DROPPED.labels("dns").inc()
+
+    def close(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        super().close()
+
+    def sendto(self, data: bytes, host: str, port: int) -> None:
+        transport = self.sockets.get(socket.AF_INET6 if ":" in host else socket.AF_INET)
+        if transport is None or transport.is_closing():
+            metrics.UDP_DROPPED.labels("family").inc()
+            return
+        metrics.UDP_UPLOAD.inc()
+        transport.sendto(data, (host, port))
+
+    def received(self, data: bytes, addr: tuple) -> None:
+        if self.tunnel is None:
+            return
+        host, port = addr[:2]
+        metrics.UDP_DOWNLOAD.inc()
+        self.tunnel.send(pack_address(host, False) + PORT.pack(port) + data)
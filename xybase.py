@@ -1,16 +1,18 @@
 from __future__ import annotations
-from typing import Any, Callable, Coroutine
-import gc
+from typing import Any, Callable, Coroutine, Dict, Optional, Tuple
 import asyncio
+import signal
 import sys
-import os
 import warnings
 from ssl import SSLError
 
-import psutil
-import objgraph  # TODO: 内存参考，正式版将会删除
-
 from safe_block import Key
+import metrics
+import xylog
+from xylog import INFO, WARNING
+import relay
+from timer import Deadline, get_wheel
+from shaper import Limiter, Shaper
 from aisle import LogMixin, SyncLogger
 
 ENABLE_UVLOOP = False
@@ -33,31 +35,147 @@ except ImportError as err:
     # TODO: pypy3.9暂未支持uvloop，参考链接 https://github.com/PyO3/pyo3/issues/2137
 
 
+HANDSHAKE_EXPIRED = "handshake expired"  # 握手超时取消处理协程时使用的消息
+
+
 class StreamBase(LogMixin):
     """一个异步处理多个流的基类"""
 
     def __init__(self, key: str, name: str = None, *args, **kwargs):
 
-        gc.disable()
-
         super().__init__(*args, **kwargs)
 
+        # 替换LogMixin创建的同步日志，日志等级由配置文件的general.log_level决定
+        self.logger: SyncLogger = xylog.get_logger(self.__class__.__name__)
         if name:
-            self.logger: SyncLogger = self.logger.get_child(name)
-
-        self.logger.set_level("INFO")  # Change Log level here!! 在这里更改日志等级！！
+            self.logger = self.logger.get_child(name)
 
         self.key = Key(key_string=key)
 
+        # 转发引擎，stream使用StreamReader/StreamWriter循环拷贝，protocol直接接管transport
+        self.relay_engine = "stream"
+        # stream引擎单次读取的大小范围，读取大小在该范围内自适应
+        self.chunk_min = 4096
+        self.chunk_max = 262144
+        # StreamReader的缓冲上限，写缓冲的高低水位
+        self.stream_limit = 262144
+        self.write_high_water = 262144
+        self.write_low_water = 65536
+        # 握手阶段、空闲和半关闭状态的超时秒数，设置为0则不限制
+        self.handshake_timeout = 10
+        # 服务端接受连接后等待第一个区块的秒数，之后按handshake_timeout计算
+        self.block_wait_timeout = 120
+        self.idle_timeout = 300
+        self.half_closed_timeout = 30
+        # UDP关联的空闲超时秒数
+        self.udp_idle_timeout = 60
+        # 收到SIGTERM后等待已有连接结束的最长秒数
+        self.drain_timeout = 30
+        # 带宽限制，默认不限制
+        self.shaper = Shaper()
+
         self.total_conn_count = 0  # 一共处理了多少连接
         self.current_conn_count = 0  # 目前还在保持的连接数
 
+    def configure_relay(self, general: Dict[str, Any]) -> None:
+        """从配置文件的general部分读取转发相关的设置"""
+        self.relay_engine = general["relay_engine"]
+        self.chunk_min = general["chunk_min"]
+        self.chunk_max = max(general["chunk_max"], self.chunk_min)
+        self.stream_limit = general["stream_limit"]
+        self.write_high_water = general["write_high_water"]
+        self.write_low_water = min(general["write_low_water"], self.write_high_water)
+        self.handshake_timeout = general["handshake_timeout"]
+        self.block_wait_timeout = general["block_wait_timeout"]
+        self.idle_timeout = general["idle_timeout"]
+        self.half_closed_timeout = general["half_closed_timeout"]
+        self.udp_idle_timeout = general["udp_idle_timeout"]
+        self.drain_timeout = general["drain_timeout"]
+        self.shaper = Shaper(
+            general["rate_limit"],
+            general["rate_limit_user"],
+            general["rate_limit_destination"],
+            general["rate_burst"],
+        )
+
+    async def serve_until_stopped(self, server: asyncio.AbstractServer) -> None:
+        """服务直到收到SIGTERM
+
+        收到后停止接受新的连接，等待已有的连接结束，最多等待drain_timeout秒
+        """
+        loop = asyncio.get_running_loop()
+        stopping = loop.create_future()
+
+        def stop() -> None:
+            if not stopping.done():
+                stopping.set_result(None)
+
+        try:
+            loop.add_signal_handler(signal.SIGTERM, stop)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows不支持
+
+        await stopping
+        server.close()
+        self.logger.warning(f"停止接受新连接，等待{self.current_conn_count}个连接结束")
+
+        deadline = loop.time() + self.drain_timeout
+        while self.current_conn_count > 0 and loop.time() < deadline:
+            await asyncio.sleep(0.5)
+
+    def limiters_for(
+        self, user: str, destination: str
+    ) -> Tuple[Optional[Limiter], Optional[Limiter]]:
+        """按用户和目标创建带宽限制，用于exchange_stream
+
+        user: 客户端为Socks认证的用户名，服务端为客户端在预协商中传来的用户名
+        """
+        if not self.shaper.enabled:
+            return None, None
+        return self.shaper.limiters(user, destination)
+
+    def watch_handshake(
+        self, *writers: asyncio.StreamWriter, timeout: float = None
+    ) -> Deadline:
+        """为当前的处理协程设置握手超时
+
+        超时后关闭writers并取消处理协程，握手完成后需要调用返回值的cancel方法
+        timeout: 可选，超时秒数，默认为handshake_timeout
+        """
+        return get_wheel().watch(
+            self.handshake_timeout if timeout is None else timeout,
+            self.__handshake_expired,
+            asyncio.current_task(),
+            writers,
+        )
+
+    def __handshake_expired(self, task: asyncio.Task, writers: tuple) -> None:
+        self.logger.event("failure", WARNING, "握手超时")
+        metrics.CONNECTIONS_FAILED.labels("handshake_timeout").inc()
+        for w in writers:
+            self.abort(w)
+        task.cancel(HANDSHAKE_EXPIRED)
+
+    def __relay_expired(self, *writers: asyncio.StreamWriter) -> None:
+        self.logger.event("timeout", INFO, "连接空闲超时")
+        for w in writers:
+            self.abort(w)
+
+    @staticmethod
+    def abort(w: asyncio.StreamWriter) -> None:
+        """立即关闭连接，丢弃未发送的数据"""
+        if isinstance(w, asyncio.StreamWriter):
+            w.transport.abort()
+        else:
+            w.close()
+
     async def exchange_stream(
         self,
         localReader: asyncio.StreamReader,
         localWriter: asyncio.StreamWriter,
         remoteReader: asyncio.StreamReader,
         remoteWriter: asyncio.StreamWriter,
+        limiters: Tuple[Optional[Limiter], Optional[Limiter]] = (None, None),
     ) -> None:
         """异步双工流交换
 
@@ -65,82 +183,129 @@ class StreamBase(LogMixin):
         localWriter: 本地写入流
         remoteReader: 远程读取流
         remoteWriter: 远程写入流
+        limiters: 可选，(本地到远程, 远程到本地)两个方向的带宽限制，由self.shaper.limiters创建，结束时释放
         """
 
         if not remoteWriter:
             self.logger.error("远程连接提前关闭")
             return
 
-        await asyncio.gather(
-            self.__copy(localReader, remoteWriter, debug="upload"),
-            self.__copy(remoteReader, localWriter, debug="download"),
-            return_exceptions=True,
+        for w in (localWriter, remoteWriter):
+            if isinstance(w, asyncio.StreamWriter):
+                w.transport.set_write_buffer_limits(
+                    self.write_high_water, self.write_low_water
+                )
+
+        deadline = get_wheel().watch(
+            self.idle_timeout, self.__relay_expired, localWriter, remoteWriter
         )
 
+        if (
+            self.relay_engine == "protocol"
+            and isinstance(localWriter, asyncio.StreamWriter)
+            and isinstance(remoteWriter, asyncio.StreamWriter)
+        ):
+            # 多路复用的逻辑流没有transport，只能使用stream引擎
+            await relay.pipe(
+                localReader,
+                localWriter,
+                remoteReader,
+                remoteWriter,
+                deadline=deadline,
+                half_closed_timeout=self.half_closed_timeout,
+                counters=(metrics.RELAY_UPLOAD, metrics.RELAY_DOWNLOAD),
+                limiters=limiters,
+            )
+        else:
+            await asyncio.gather(
+                self.__copy(
+                    localReader,
+                    remoteWriter,
+                    deadline,
+                    metrics.RELAY_UPLOAD,
+                    limiters[0],
+                ),
+                self.__copy(
+                    remoteReader,
+                    localWriter,
+                    deadline,
+                    metrics.RELAY_DOWNLOAD,
+                    limiters[1],
+                ),
+                return_exceptions=True,
+            )
+
+        deadline.cancel()
+        for limiter in limiters:
+            if limiter is not None:
+                limiter.close()
         self.logger.debug("双向流均已关闭")
 
     async def __copy(
         self,
         r: asyncio.StreamReader,
         w: asyncio.StreamWriter,
-        debug: str = None,
-        timeout: int = None,
+        deadline: Deadline,
+        counter: metrics.Value,
+        limiter: Optional[Limiter] = None,
     ) -> None:
         """异步流拷贝
 
         r: 源
         w: 目标
-        debug: 无视即可
-        timeout: 定义了连接多久之后会被回收，如果使用了uvloop则无视该参数
+        deadline: 两个方向共享的超时项，每次读到数据时更新，一个方向结束后切换为半关闭超时
+        counter: 该方向转发字节数的指标
+        limiter: 可选，带宽限制，每次读取不超过分到的份额，透支后等待唤醒再读取
+
+        每次读取取出缓冲中已有的全部数据（不超过读取大小），合并为一次写入。
+        连续读满时读取大小翻倍，直到chunk_max；读到的数据不足四分之一时减半，直到chunk_min。
+        写缓冲低于低水位时不可能处于暂停状态，跳过drain
         """
         # HACK: 减小循环内部逻辑使用量和变量数量，同时避免触发日志
-        if ENABLE_UVLOOP:
-            # 使用uvloop能大幅减小内存使用，将超时设置为TCP默认时间
-            while 1:
-                try:
-
-                    data = await r.read(4096)  # 不进行超时测试，减少事件调度
-
-                    if not data:
-                        break
-                    w.write(data)
-                    await w.drain()  # 不应节省
-
-                except Exception:
+        chunk_min, chunk_max = self.chunk_min, self.chunk_max
+        low_water = self.write_low_water
+        size = chunk_min
+        # 多路复用的逻辑流在drain中才会真正发送数据，每次都需要drain
+        transport = w.transport if isinstance(w, asyncio.StreamWriter) else None
+
+        while 1:
+            try:
+                if limiter is None:
+                    data = await r.read(size)
+                else:
+                    data = await r.read(min(size, limiter.share()))
+                if not data:
                     break
+                deadline.touch()
 
-        else:
-            # 性能可能较弱
-            timeout = timeout  # 防止使用原生事件循环导致的高内存占用
-            while 1:
-                try:
-
-                    data = await asyncio.wait_for(r.read(4096), timeout=timeout)
-
-                    # 不进行超时检测，会导致连接一直保持，直到某一方的下层连接超时断开（一般是60秒）
-                    # 例如www.baidu.com:80默认不会断开连接，导致大量空连接堆积造成性能下降
-                    # data = await r.read(4096)
-
-                    if not data:
-                        break
-                    # self.logger.debug(f'{r.at_eof()}')
+                w.write(data)
 
-                    w.write(data)
-                    await w.drain()  # 不应节省
+                n = len(data)
+                counter.value += n
+                if n >= size:
+                    if size < chunk_max:
+                        size = min(size << 1, chunk_max)
+                elif n < size >> 2 and size > chunk_min:
+                    size = max(size >> 1, chunk_min)
 
-                # except asyncio.TimeoutError:
-                #     # self.logger.debug(f'连接超时')
-                #     break
-
-                except Exception:
-                    # 可能有ConnectResetError
+                if transport is None:
+                    await w.drain()
+                elif transport.is_closing():
                     break
+                elif transport.get_write_buffer_size() > low_water:
+                    await w.drain()
+
+                if limiter is not None and not limiter.charge(n):
+                    await limiter.throttle()
 
-        self.logger.debug(f"开始拷贝流，debug：{debug}")
+            except Exception:
+                # 可能有ConnectResetError
+                break
 
+        deadline.reset(self.half_closed_timeout)
         await self.try_close(w)
 
-        self.logger.debug(f"拷贝流结束，debug：{debug}")
+        self.logger.debug("拷贝流结束")
         return
 
     @staticmethod
@@ -156,38 +321,26 @@ class StreamBase(LogMixin):
         """处理连接的装饰器
 
         接收一个用于连接处理的协程，一般名字叫handle。
-        在协程执行前自动增加连接计数，在协程执行后自动减少连接计数
+        在协程执行前自动增加连接计数，在协程执行后自动减少连接计数，连接数通过metrics输出。
+        因握手超时而取消的协程视为正常结束
         """
 
         async def handler(self: StreamBase, *args, **kwargs):
 
             self.total_conn_count += 1
             self.current_conn_count += 1
-            self.logger.info("开始处理新的连接")
-            self.logger.info(f"当前并发连接数: {self.current_conn_count}")
-
-            rtn = await coro(self, *args, **kwargs)
-
-            self.current_conn_count -= 1
-            self.logger.info("连接处理完毕")
-            self.logger.info(f"当前并发连接数: {self.current_conn_count}")
-
-            if self.current_conn_count == 0:
-
-                # 仅当当前连接数为0时，才释放内存，防止回收还在等待的协程
-                gc.collect()
-                self.logger.info("GC DONE")
-                self.logger.info("对象增量信息：")
-                print("-" * 20)
-                objgraph.show_growth(shortnames=False)
-                if sys.implementation.name == "pypy":
-                    self.logger.info(
-                        f"当前内存状态\n{gc.get_stats()}"
-                    )  # 该方法会调用一次gc.collect()
-                elif sys.implementation.name == "cpython":
-                    process = psutil.Process(os.getpid())
-                    memory_info = process.memory_info().rss  # in bytes
-                    self.logger.info(f"当前内存占用{memory_info / 1024 / 1024:.5}MB")
+            metrics.CONNECTIONS_ACCEPTED.inc()
+            metrics.CONNECTIONS_ACTIVE.inc()
+
+            try:
+                rtn = await coro(self, *args, **kwargs)
+            except asyncio.CancelledError as error:
+                if error.args != (HANDSHAKE_EXPIRED,):
+                    raise
+                rtn = None
+            finally:
+                self.current_conn_count -= 1
+                metrics.CONNECTIONS_ACTIVE.dec()
 
             return rtn
 
@@ -228,4 +381,4 @@ class StreamBase(LogMixin):
             pass
 
         except Exception as err:
-            self.logger.warning(f"在关闭连接时发生意外错误 > {type(err)} {err}")
+            self.logger.warning("在关闭连接时发生意外错误 > {} {}", type(err), err)
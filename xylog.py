@@ -0,0 +1,212 @@
+"""
+Filename: xylog.py
+
+异步日志
+
+日志记录放入队列，由后台线程格式化并输出，事件循环上只做等级判断和入队。
+消息使用str.format的模板和参数，只有真正输出时才格式化。
+按事件类型的日志可以设置采样率和每秒上限，高并发时避免日志占用过多的CPU
+"""
+from __future__ import annotations
+import atexit
+import queue
+import sys
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from aisle import SyncLogger
+from aisle.config import TIME_FORMAT
+
+import metrics
+
+DEBUG, INFO, WARNING, ERROR, CRITICAL = range(5)
+LEVEL_NAMES = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+LEVEL_COLORS = (37, 32, 33, 31, 35)  # 与aisle.SyncLogger相同的前景色
+
+MAX_PENDING = 65536  # 队列中最多等待输出的记录数，超过后丢弃新的记录
+
+LOG_DROPPED = metrics.REGISTRY.counter(
+    "pyxy_log_dropped_total", "被采样、限速或队列已满而丢弃的日志数", ("event",)
+)
+
+
+class _Sampler:
+    """一种事件的采样和限速状态
+
+    rate: 采样率，每round(1/rate)条保留一条
+    limit: 每秒最多输出的条数，0为不限制
+    """
+
+    __slots__ = ("every", "count", "limit", "tokens", "last")
+
+    def __init__(self, rate: float, limit: float) -> None:
+        self.every = max(round(1 / rate), 1) if rate > 0 else 0
+        self.count = 0
+        self.limit = limit
+        self.tokens = limit
+        self.last = time.monotonic()
+
+    def allow(self) -> bool:
+        if self.every == 0:
+            return False
+        self.count += 1
+        if self.every > 1 and self.count % self.every:
+            return False
+        if self.limit > 0:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.last) * self.limit, self.limit)
+            self.last = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+        return True
+
+
+class Pipeline:
+    """进程内唯一的日志队列和输出线程"""
+
+    def __init__(self) -> None:
+        self.level = INFO
+        self.sample_rates: Dict[str, float] = {}
+        self.rate_limit = 0.0
+        self.samplers: Dict[str, _Sampler] = {}
+        self.queue: "queue.SimpleQueue[Tuple]" = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def configure(self, config: Dict[str, Any]) -> None:
+        """从配置文件的general部分读取日志等级、采样率和限速"""
+        self.level = LEVEL_NAMES.index(config["log_level"].upper())
+        self.sample_rates = dict(config["log_sample"])
+        self.rate_limit = config["log_rate_limit"]
+        self.samplers.clear()
+
+    def sampler(self, event: str) -> _Sampler:
+        sampler = self.samplers.get(event)
+        if sampler is None:
+            sampler = self.samplers[event] = _Sampler(
+                self.sample_rates.get(event, 1.0), self.rate_limit
+            )
+        return sampler
+
+    def put(self, record: Tuple) -> None:
+        if self.queue.qsize() >= MAX_PENDING:
+            LOG_DROPPED.labels("overflow").inc()
+            return
+        self.queue.put(record)
+        if self._thread is None:
+            self.__start()
+
+    def __start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self.__run, name="xylog", daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def __run(self) -> None:
+        while 1:
+            record = self.queue.get()
+            lines = []
+            while record is not None:
+                lines.append(format_record(record))
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    record = None
+            try:
+                sys.__stdout__.write("\n".join(lines) + "\n")
+                sys.__stdout__.flush()
+            except (OSError, ValueError):
+                pass
+
+    def flush(self) -> None:
+        """等待队列中的记录输出完毕，最多等待一秒"""
+        deadline = time.monotonic() + 1
+        while self.queue.qsize() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.01)  # 输出线程可能还在写入最后一批
+
+
+PIPELINE = Pipeline()
+
+
+def format_record(record: Tuple) -> str:
+    created, level, name, msg, args = record
+    if args:
+        try:
+            msg = msg.format(*args)
+        except (IndexError, KeyError, ValueError):
+            msg = f"{msg} {args}"
+    return (
+        f"\033[{LEVEL_COLORS[level]}m"
+        f"|{time.strftime(TIME_FORMAT, time.localtime(created))}| "
+        f"[{name}] <{LEVEL_NAMES[level]:><9}> {msg}\033[0m"
+    )
+
+
+class AsyncLogger(SyncLogger):
+    """与aisle.SyncLogger接口相同的异步日志记录器
+
+    get_child只复制名字和等级，可以为每个连接创建
+    """
+
+    __slots__ = ("name", "_level")
+
+    def __init__(self, name: str = None, level: Optional[int] = None) -> None:
+        # 不调用SyncLogger.__init__，等级为None时使用PIPELINE的等级
+        self.name = name
+        self._level = level
+
+    def set_level(self, level_str: str = None) -> None:
+        self._level = LEVEL_NAMES.index(level_str) if level_str else None
+
+    def get_child(self, suffix: str) -> AsyncLogger:
+        return AsyncLogger(f"{self.name}.{suffix}", self._level)
+
+    def getChild(self, suffix: str) -> AsyncLogger:
+        return self.get_child(suffix)
+
+    def enabled(self, level: int) -> bool:
+        return level >= (PIPELINE.level if self._level is None else self._level)
+
+    def log(self, level: int, msg: str, *args: Any) -> None:
+        if level >= (PIPELINE.level if self._level is None else self._level):
+            PIPELINE.put((time.time(), level, self.name, msg, args))
+
+    def event(self, event: str, level: int, msg: str, *args: Any) -> None:
+        """记录一条按event类型采样和限速的日志"""
+        if level < (PIPELINE.level if self._level is None else self._level):
+            return
+        if not PIPELINE.sampler(event).allow():
+            LOG_DROPPED.labels(event).inc()
+            return
+        PIPELINE.put((time.time(), level, self.name, msg, args))
+
+    def debug(self, msg: str, *args: Any) -> None:
+        self.log(DEBUG, msg, *args)
+
+    def info(self, msg: str, *args: Any) -> None:
+        self.log(INFO, msg, *args)
+
+    def warning(self, msg: str, *args: Any) -> None:
+        self.log(WARNING, msg, *args)
+
+    def error(self, msg: str, *args: Any) -> None:
+        self.log(ERROR, msg, *args)
+
+    def critical(self, msg: str, *args: Any) -> None:
+        self.log(CRITICAL, msg, *args)
+
+
+def get_logger(name: str) -> AsyncLogger:
+    return AsyncLogger(name)
+
+
+def configure(config: Dict[str, Any]) -> None:
+    """在启动时调用，读取配置文件的general部分"""
+    PIPELINE.configure(config)